@@ -7,13 +7,42 @@ import matplotlib.pyplot as plt
 from copy import copy
 import inspect
 import builtins
+import ast
+import os
+import shutil
+import tempfile
+import weakref
+import operator
+import re
+import time
+import threading
+import hashlib
+from functools import lru_cache, reduce, update_wrapper
+from collections import OrderedDict
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from sandbox import Sandbox, SandboxError, code_names
 
 try:
     from logger import Logger
     logger = Logger(log_to_console=True)
-    log = logger.print_to_console
+    _log = logger.print_to_console
 except ImportError:
-    log = print
+    _log = print
+
+_log_state = threading.local()  # quiet is True on a thread that runs a program, see Calculator.run_program()
+
+
+def log(*args, **kwargs):
+    """ logs to the console, unless the calling thread is running a quiet program """
+    if not getattr(_log_state, 'quiet', False):
+        _log(*args, **kwargs)
+
+
+try:
+    import scipy.special as scipy_special  # optional, vectorized erf, erfc, gamma and lgamma for arrays
+except ImportError:
+    scipy_special = None
 
 # log the launch
 print(r"""
@@ -49,6 +78,1866 @@ log(f"matplotlib version: {matplotlib.__version__}")
 
 
 
+# ndarray methods that write into the array they are called on, like a.sort()
+_ARRAY_MUTATING_METHODS = {'fill', 'sort', 'partition', 'put', 'itemset', 'resize', 'setfield', 'byteswap'}
+
+# numpy functions that write into their first argument, like np.copyto(a, b)
+_NUMPY_MUTATING_FUNCTIONS = {'copyto', 'put', 'place', 'putmask', 'fill_diagonal', 'shuffle', 'put_along_axis'}
+
+
+def _freeze(value):
+    """ returns a read only view of a numpy array so it can be shared by the stack, the locals and the undo history
+    without copying it. Writes go through Calculator._thaw_arrays_written_by() which swaps in a private copy first
+    (copy on write). The view shares the data but not the flags, so the caller's own array stays writeable. An array
+    that is read only already and anything that is not an array is returned as is.
+    @param value: any python object
+    @return: value or a read only view of it """
+    if isinstance(value, np.ndarray) and value.flags.writeable:
+        value = value.view()
+        value.flags.writeable = False
+    return value
+
+
+def _base_name(node) -> str | None:
+    """ returns the variable name at the root of an ast target like a[0], a.real[1:] or a, else None """
+    while isinstance(node, (ast.Subscript, ast.Attribute, ast.Starred)):
+        node = node.value
+    return node.id if isinstance(node, ast.Name) else None
+
+
+def _names_written_in_place(tree, parameter_writes: dict = None) -> set:
+    """ returns the names that the code writes into (not re-binds), like a[0] = 1, a += 1, a.sort(),
+    np.copyto(a, b), np.add(a, 1, out=a) or f(a) where f is a user function that writes into its parameter
+    @param tree: the parsed code (from ast.parse)
+    @param parameter_writes: like {'function name': {indexes of the positional parameters the function writes to}}
+    @return: a set of names """
+    if parameter_writes is None:
+        parameter_writes = dict()
+    names = set()
+    for node in ast.walk(tree):
+        targets = []
+        if isinstance(node, (ast.Assign, ast.AugAssign, ast.AnnAssign)):
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            for target in targets:
+                for sub_target in ast.walk(target):
+                    if isinstance(sub_target, (ast.Subscript, ast.Attribute)):
+                        names.add(_base_name(sub_target))
+            if isinstance(node, ast.AugAssign):
+                names.add(_base_name(node.target))  # a += 1 is in place for arrays
+        elif isinstance(node, ast.Call):
+            func = node.func
+            if isinstance(func, ast.Attribute) and func.attr in _ARRAY_MUTATING_METHODS:
+                names.add(_base_name(func.value))
+            func_name = func.attr if isinstance(func, ast.Attribute) else getattr(func, 'id', None)
+            if func_name in _NUMPY_MUTATING_FUNCTIONS and len(node.args) > 0:
+                names.add(_base_name(node.args[0]))
+            for idx in parameter_writes.get(func_name, ()):
+                if idx < len(node.args):
+                    names.add(_base_name(node.args[idx]))
+            for keyword in node.keywords:
+                if keyword.arg == 'out':
+                    for out in ast.walk(keyword.value):
+                        if isinstance(out, ast.Name):
+                            names.add(out.id)
+    names.discard(None)
+    return names
+
+
+def _parameter_writes(function_string: str) -> dict:
+    """ returns the positional parameters each function in function_string writes into, the calculator uses this
+    to copy a read only array argument before the call instead of letting the function fail on it
+    @param function_string: python source with one or more function definitions
+    @return: like {'function name': {0, 2}} """
+    writes = dict()
+    try:
+        tree = ast.parse(function_string)
+    except SyntaxError:
+        return writes
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            params = [arg.arg for arg in node.args.posonlyargs + node.args.args]
+            written = _names_written_in_place(node)
+            positions = {idx for idx, param in enumerate(params) if param in written}
+            if len(positions) > 0:
+                writes[node.name] = positions
+    return writes
+
+
+_ASSIGNMENT_PATTERN = re.compile(r'\s*([A-Za-z_]\w*)\s*=(?!=)(.*)', re.DOTALL)  # like 'a = 1' or 'a=' but not 'a == 1'
+
+
+@lru_cache(maxsize=1024)
+def _classify_entry(text: str) -> tuple:
+    """ decides once what kind of input a string at X is, so enter_press() can go straight to the right handler
+    instead of trying each handler in turn. Only the text is looked at, names are checked against the locals and the
+    functions when the entry is used because those change. The result is cached per text.
+    @param text: the string at X
+    @return: a tuple (kind, payload), one of:
+        ('number', the number)              like '32', '1.5e3', 'inf'
+        ('name', the stripped name)         like 'a' or 'sin', could be a local, a function or anything in the namespace
+        ('assignment', (name, value text))  like 'a = 1' or 'a=' (value text is '' so Y gets assigned)
+        ('import', the stripped text)       like 'import os' or 'from os import path'
+        ('code', the text)                  anything else, goes to eval and failing that exec """
+    try:
+        return 'number', Calculator._convert_to_best_numeric(text)
+    except ValueError:
+        pass
+    stripped = text.strip()
+    if stripped.isidentifier():
+        return 'name', stripped
+    assignment = _ASSIGNMENT_PATTERN.fullmatch(text)
+    if assignment is not None:
+        return 'assignment', (assignment.group(1), assignment.group(2).strip())
+    first_word = stripped.split(' ', 1)[0]
+    if first_word in ('import', 'from'):
+        return 'import', stripped
+    return 'code', text
+
+
+def _same_entry(x, y) -> bool:
+    """ returns True if x and y are the same stack entry, enter puts the same object in X and Y so this is an identity
+    check. Numbers are compared by value, never compare arrays with == (elementwise, and O(n)) """
+    if x is y:
+        return True
+    return isinstance(x, int | float | complex) and type(x) is type(y) and x == y
+
+
+_POSITIONAL_KINDS = (inspect.Parameter.POSITIONAL_ONLY, inspect.Parameter.POSITIONAL_OR_KEYWORD)
+
+
+def _positional_arity(function) -> tuple | None:
+    """ returns the number of positional parameters a function takes from the stack as (required, optional).
+    *args and **kwargs are not counted, a numpy ufunc takes its nin inputs.
+    @param function: any callable
+    @return: (required, optional) or None if the signature can not be read or the function has a required keyword only
+             parameter (it can't be called with stack values alone) """
+    if isinstance(function, np.ufunc):
+        return function.nin, 0
+    try:
+        parameters = inspect.signature(function).parameters.values()
+    except (TypeError, ValueError):
+        return None
+    required = 0
+    optional = 0
+    for parameter in parameters:
+        if parameter.kind in _POSITIONAL_KINDS:
+            if parameter.default is inspect.Parameter.empty:
+                required += 1
+            else:
+                optional += 1
+        elif parameter.kind == inspect.Parameter.KEYWORD_ONLY and parameter.default is inspect.Parameter.empty:
+            return None
+    return required, optional
+
+
+def _python_loop_ufunc(function, otype=float):
+    """ returns a numpy function that calls a math function once per element, this is the fallback for math functions
+    that numpy does not have, it is a python loop but the result is still an array with a real dtype """
+    return np.vectorize(function, otypes=[otype])
+
+
+def _elementwise_shim(function, args: tuple):
+    """ probes a user function with a few elements of its array arguments. If it takes arrays as they are (it is
+    written with numpy broadcasting in mind, or it is meant for whole arrays) returns None and the function is called
+    directly. If it only works on scalars returns a wrapper that runs it once per element with np.frompyfunc (less
+    overhead than np.vectorize) and gives back an array with the dtype of the element results, not an object array
+    @param function: the user function
+    @param args: the arguments of the call, at least one is an array
+    @return: None or the elementwise wrapper """
+    samples = tuple(arg.reshape(-1)[:2] if isinstance(arg, np.ndarray) and arg.ndim > 0 else arg for arg in args)
+    try:
+        with np.errstate(all='ignore'):
+            function(*samples)
+        return None  # ------------------------------------------------------------------------------------------------>
+    except Exception:
+        pass
+    ufunc = np.frompyfunc(function, len(args), 1)
+    try:
+        otype = np.array(ufunc(*samples).tolist()).dtype
+    except Exception:
+        return None  # it does not work per element either, calling it directly reports the error ------------------->
+
+    def elementwise(*arguments):
+        result = ufunc(*arguments)
+        if not isinstance(result, np.ndarray):
+            return result  # ------------------------------------------------------------------------------------------>
+        if otype.kind in 'fc':
+            try:
+                return result.astype(otype)  # ints and floats fit in a float (or complex) array without loss ----->
+            except (TypeError, ValueError):
+                pass
+        typed = np.array(result.tolist())  # picks the dtype from all the results, ints and floats give float64
+        return typed if typed.shape == result.shape and typed.dtype.kind in 'biufc' else result
+
+    elementwise.__wrapped__ = function
+    return elementwise
+
+
+# the numpy version of each function in the one arg math table, these run one C loop over an array
+_NUMPY_ONE_ARG = {'acos': np.arccos, 'acosh': np.arccosh, 'asin': np.arcsin, 'asinh': np.arcsinh,
+                  'atan': np.arctan, 'atanh': np.arctanh, 'ceil': np.ceil, 'cos': np.cos, 'cosh': np.cosh,
+                  'degrees': np.degrees, 'exp': np.exp, 'expm1': np.expm1, 'fabs': np.fabs, 'floor': np.floor,
+                  'log1p': np.log1p, 'log2': np.log2, 'log10': np.log10, 'radians': np.radians, 'sin': np.sin,
+                  'sinh': np.sinh, 'sqrt': np.sqrt, 'tan': np.tan, 'tanh': np.tanh, 'trunc': np.trunc,
+                  'isnan': np.isnan, 'isinf': np.isinf, 'isfinite': np.isfinite, 'frexp': np.frexp, 'modf': np.modf,
+                  'exp2': np.exp2, 'cbrt': np.cbrt,
+                  'ulp': lambda x: np.spacing(np.abs(x)),
+                  'factorial': np.frompyfunc(math.factorial, 1, 1),  # exact python ints, they outgrow int64 fast
+                  }
+if scipy_special is not None:
+    _NUMPY_ONE_ARG.update({'erf': scipy_special.erf, 'erfc': scipy_special.erfc, 'gamma': scipy_special.gamma,
+                           'lgamma': scipy_special.gammaln})
+else:
+    _NUMPY_ONE_ARG.update({name: _python_loop_ufunc(getattr(math, name))
+                           for name in ('erf', 'erfc', 'gamma', 'lgamma')})
+
+# math returns python ints for these and numpy returns floats, lists of numbers keep going through math for them
+_INT_RESULT_ONE_ARG = frozenset({'ceil', 'floor', 'trunc'})
+
+
+# the numpy version of each function in the two arg math table, called like function(Y, X) with broadcasting
+_NUMPY_TWO_ARG = {'atan2': np.arctan2, 'copysign': np.copysign, 'fmod': np.fmod, 'gcd': np.gcd, 'hypot': np.hypot,
+                  'ldexp': np.ldexp, 'nextafter': np.nextafter,
+                  'pow': np.float_power,  # math.pow always returns a float
+                  'remainder': _python_loop_ufunc(math.remainder),  # IEEE remainder, np.remainder is the modulo
+                  'isclose': lambda y, x: np.isclose(y, x, rtol=1e-09, atol=0.0),  # the math.isclose tolerances
+                  'comb': np.frompyfunc(math.comb, 2, 1),  # exact python ints
+                  'perm': np.frompyfunc(math.perm, 2, 1),
+                  }
+
+
+# the two value stack operations, called like operation(Y, X), numpy arrays broadcast
+_STACK_OPERATIONS = {'+': operator.add, '-': operator.sub, '*': operator.mul, '/': operator.truediv,
+                     '**': operator.pow, '@': operator.matmul, '//': operator.floordiv, '%': operator.mod,
+                     '&': operator.and_, '|': operator.or_, '^': operator.xor, '<<': operator.lshift,
+                     '>>': operator.rshift}
+
+# iterable math functions that take two iterables, Y and X
+_TWO_ITERABLE_FUNCS = {'dist', 'sumprod'}
+# the iterable functions that take a lone number on X as a one item iterable, like '5 fsum'
+_ONE_ITEM_ITERABLE_FUNCS = {'fsum', 'prod'}
+
+
+def _exact_iterable_function(function: str, x, y=None):
+    """ runs an iterable math function with the math library (exactly rounded fsum, python int prod, ...)
+    @param x: the iterable in X
+    @param y: the iterable in Y for dist and sumprod """
+    if function == 'dist':
+        return math.dist(y, x)
+    if function == 'sumprod':
+        if hasattr(math, 'sumprod'):  # python 3.12+
+            return math.sumprod(y, x)
+        return math.fsum(a * b for a, b in zip(y, x, strict=True))
+    if function in ('gcd', 'lcm'):
+        return getattr(math, function)(*x)
+    if function == 'isqrt':
+        return _like_container(np.array([math.isqrt(item) for item in x], dtype=object), x)
+    return getattr(math, function)(x)
+
+
+def _array_iterable_function(function: str, x: np.ndarray, y: np.ndarray = None):
+    """ runs an iterable math function as a numpy reduction, one C loop over the array. Integer products that could
+    overflow int64 and lcm (it grows too fast for int64) use python ints so the result is still exact
+    @param x: the array in X
+    @param y: the array in Y for dist and sumprod """
+    if function == 'fsum':
+        return np.sum(x, dtype=np.result_type(x.dtype, np.float64))  # pairwise summation
+    if function == 'dist':
+        return np.linalg.norm(np.subtract(y, x, dtype=np.float64))
+    if function == 'sumprod':
+        return np.dot(y.ravel(), x.ravel())
+    if function == 'prod':
+        if x.dtype.kind in 'biu' and np.prod(np.abs(x), dtype=np.float64) >= 2.0 ** 62:
+            return math.prod(x.ravel().tolist())
+        return np.prod(x)
+    if function == 'gcd':
+        return np.gcd.reduce(x, axis=None)
+    if function == 'lcm':
+        return math.lcm(*x.ravel().tolist())
+    if function == 'isqrt':
+        if x.dtype.kind not in 'biu':
+            raise TypeError(f"isqrt needs integers, not '{x.dtype}'")
+        if np.any(x < 0):
+            raise ValueError("isqrt() argument must be nonnegative")
+        root = np.floor(np.sqrt(x, dtype=np.float64)).astype(np.int64)
+        root -= root * root > x  # the float sqrt can be one off for large ints
+        root += (root + 1) * (root + 1) <= x
+        return root
+    raise ValueError(f"no array version of: '{function}'")
+
+
+def _numeric_levels(values: list) -> np.ndarray | None:
+    """ returns the values as an int64 or float64 array if they are all python ints / floats (not bools), else None.
+    This is one pass over the values to find the dtype and one np.fromiter to fill the array """
+    dtype = np.int64
+    for value in values:
+        value_type = type(value)
+        if value_type is float:
+            dtype = np.float64
+        elif value_type is not int:
+            return None
+    try:
+        return np.fromiter(values, dtype=dtype, count=len(values))
+    except OverflowError:  # python ints that don't fit in int64
+        return None
+
+
+def _typed_levels(values: list) -> list:
+    """ returns the levels with the typed numbers (numeric strings like '2' or '1.5') converted to numbers, anything
+    else is kept as it is """
+    levels = []
+    for value in values:
+        if isinstance(value, str):
+            try:
+                value = Calculator._convert_to_best_numeric(value)
+            except ValueError:
+                pass
+        levels.append(value)
+    return levels
+
+
+def _scalar_levels(values: list) -> np.ndarray | None:
+    """ returns python (or numpy) numbers and numeric strings as one array, or None if a value is not a number. The
+    dtype comes from a single pass over the values: all ints gives int64 (float64 if they don't fit), any float gives
+    float64 and any complex gives complex128 """
+    array = _numeric_levels(values)
+    if array is not None:
+        return array  # the common case, all python ints / floats
+    numbers = []
+    dtype = np.int64
+    for value in values:
+        if isinstance(value, str):
+            try:
+                value = Calculator._convert_to_best_numeric(value)
+            except ValueError:
+                return None  # ---------------------------------------------------------------------------------------->
+        elif not isinstance(value, (int, float, complex, np.number)) or isinstance(value, np.timedelta64):
+            return None  # -------------------------------------------------------------------------------------------->
+        if isinstance(value, (complex, np.complexfloating)):
+            dtype = np.complex128
+        elif isinstance(value, (float, np.floating)) and dtype is not np.complex128:
+            dtype = np.float64
+        numbers.append(value)
+    try:
+        return np.fromiter(numbers, dtype=dtype, count=len(numbers))
+    except OverflowError:  # python ints that don't fit in int64
+        return np.fromiter(numbers, dtype=np.float64, count=len(numbers))
+
+
+def _levels_to_matrix(values: list) -> np.ndarray:
+    """ stacks levels that are arrays, lists or tuples of the same shape into one array with a new first axis, so 1D
+    levels become the rows of a 2D matrix. Each level is converted once (not each element) and np.stack copies the
+    rows into a preallocated buffer. Raises a ValueError if the shapes don't match or a level is not numeric """
+    rows = [np.asarray(value) for value in values]
+    if any(row.ndim == 0 for row in rows):
+        raise ValueError("the levels must all be arrays, lists or tuples")
+    shapes = {row.shape for row in rows}
+    if len(shapes) != 1:
+        raise ValueError(f"the levels must all have the same shape, found: {sorted(shapes)}")
+    if any(row.dtype.kind not in 'biufc' for row in rows):
+        raise ValueError(f"the levels must all be numeric, found dtypes: {sorted({str(row.dtype) for row in rows})}")
+    return np.stack(rows)
+
+
+def _levels_to_array(values: list) -> np.ndarray:
+    """ returns the stack levels as a numpy array: numbers (and numeric strings) become a 1D int64, float64 or
+    complex128 array, arrays / lists / tuples of the same shape are stacked into an array with one more dimension and
+    anything else becomes an array of strings. Raises a ValueError for containers of different shapes """
+    array = _scalar_levels(values)
+    if array is not None:
+        return array  # ----------------------------------------------------------------------------------------------->
+    if all(isinstance(value, (np.ndarray, list, tuple)) for value in values):
+        return _levels_to_matrix(values)  # --------------------------------------------------------------------------->
+    return np.array([str(value) for value in values], dtype=str)
+
+
+# stack wide reductions like {'sum': (numpy reduction, reduction of levels that are not all numbers)}, these are the
+# stack_sum, ... buttons and the right click 'Reduce stack' menu, in this order
+_STACK_REDUCTIONS = {'sum': (np.sum, lambda levels: reduce(operator.add, levels)),
+                     'prod': (np.prod, lambda levels: reduce(operator.mul, levels)),
+                     'mean': (np.mean, lambda levels: reduce(operator.add, levels) / len(levels)),
+                     'min': (np.min, lambda levels: reduce(np.minimum, levels)),
+                     'max': (np.max, lambda levels: reduce(np.maximum, levels))}
+
+
+def _as_numeric_array(x) -> np.ndarray | None:
+    """ returns a list, tuple or set of numbers as an array, or None if it is not all numbers (then the math functions
+    are used one item at a time, like before) """
+    try:
+        array = np.asarray(list(x) if isinstance(x, set) else x)
+    except (ValueError, TypeError):  # ragged lists and the like
+        return None
+    return array if array.dtype.kind in 'biufc' else None
+
+
+def _like_container(result, container):
+    """ returns the array result as the same container type as the input (list, tuple or set) with python numbers.
+    Functions like frexp return a tuple of arrays, those become a container of tuples like the math version """
+    if isinstance(result, tuple):
+        items = list(zip(*(part.tolist() for part in result)))
+    else:
+        items = result.tolist()
+    if isinstance(container, tuple):
+        return tuple(items)
+    if isinstance(container, set):
+        return set(items)
+    return items
+
+
+class _StackNode:
+    """ a single cell of the persistent stack. Nodes are never modified after they are created, so a node (and
+    everything below it) can be shared between the live stack and any number of undo / redo snapshots. numpy arrays
+    are made read only on the way in so nothing can change them behind the snapshots back """
+    __slots__ = ('value', 'below', 'depth', '__weakref__')
+
+    def __init__(self, value, below=None):
+        self.value = _freeze(value)
+        self.below = below
+        self.depth = 1 if below is None else below.depth + 1
+
+
+def _depth(chain) -> int:
+    """ returns the number of nodes in a chain, None is an empty chain """
+    return 0 if chain is None else chain.depth
+
+
+def _chain(values, chain=None):
+    """ pushes values onto chain one at a time and returns the new head, so the last value ends up at the head """
+    for value in values:
+        chain = _StackNode(value, chain)
+    return chain
+
+
+def _chain_values(chain) -> list:
+    """ returns the values of a chain, head first """
+    values = []
+    while chain is not None:
+        values.append(chain.value)
+        chain = chain.below
+    return values
+
+
+def _chain_split(chain, idx: int):
+    """ walks idx nodes down the chain, returns the values above idx (head first) and the node at idx """
+    above = []
+    for _ in range(idx):
+        above.append(chain.value)
+        chain = chain.below
+    return above, chain
+
+
+def _chain_rebuild(above: list, chain):
+    """ re-builds the values in above (head first) on top of chain and returns the new head (path copying) """
+    for value in reversed(above):
+        chain = _StackNode(value, chain)
+    return chain
+
+
+class _StackSnapshot:
+    """ an immutable version of the stack made of two chains, like a functional deque. The front chain holds the
+    levels from X down, the back chain holds the levels from the bottom of the stack up. The nodes are shared with
+    the older and newer snapshots """
+    __slots__ = ('front', 'back')
+
+    def __init__(self, front=None, back=None):
+        self.front = front
+        self.back = back
+
+    def __len__(self):
+        return _depth(self.front) + _depth(self.back)
+
+    def is_push_of(self, other) -> bool:
+        """ returns True if this snapshot is other with one value pushed on X, a pointer compare
+        @param other: a _StackSnapshot """
+        return self.front is not None and self.front.below is other.front and self.back is other.back
+
+
+_EMPTY_SNAPSHOT = _StackSnapshot()
+
+# the front chain is kept at least this deep so X, Y, Z, T and the rest of the display rows are a short walk away
+_STACK_MIN_FRONT_DEPTH = 8
+
+
+class CalcStack:
+    """ a list like handle on a persistent (immutable, structurally shared) double ended stack, index 0 is X.
+
+    The handle is mutable so the calculator can keep using pop(0), insert(0, value), stack[idx], etc. but a change
+    never copies the stack, it builds new nodes on top of the nodes that are already there. Grabbing a snapshot is
+    just grabbing a pointer, so saving the stack for undo costs the same for 1 item as it does for 100,000 items.
+
+    The levels live in two chains (see _StackSnapshot): X end in the front chain, bottom end in the back chain.
+    Cost: push / pop / replace at X and at the bottom are O(1) so roll up and roll down are O(1), when one chain runs
+    low the levels are split between the chains again, that is O(n) but only every n/2 operations. Reading level n
+    walks min(n, depth - n) nodes, the display rows near X are always in the front chain. Changing a level in the
+    middle re-builds the nodes between it and the nearest end (path copying), the rest are shared. """
+    __slots__ = ('_snap',)
+
+    def __init__(self, iterable=None):
+        """ @param iterable: optional initial values, iterable[0] ends up at X """
+        self._snap = _EMPTY_SNAPSHOT
+        if iterable is not None:
+            self._snap = self._balanced(list(iterable))
+
+    @staticmethod
+    def _balanced(values: list) -> _StackSnapshot:
+        """ builds a snapshot from values (X first), the top half goes in the front chain, the rest in the back """
+        if len(values) == 0:
+            return _EMPTY_SNAPSHOT
+        mid = max((len(values) + 1) // 2, min(len(values), _STACK_MIN_FRONT_DEPTH))
+        return _StackSnapshot(_chain(reversed(values[:mid])), _chain(values[mid:]))
+
+    def _set(self, front, back):
+        """ stores the new chains, re-balances them if the front chain got too short """
+        length = _depth(front) + _depth(back)
+        if _depth(front) < min(length, _STACK_MIN_FRONT_DEPTH):
+            self._snap = self._balanced(_chain_values(front) + _chain_values(back)[::-1])
+        elif length == 0:
+            self._snap = _EMPTY_SNAPSHOT
+        else:
+            self._snap = _StackSnapshot(front, back)
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """ returns a new stack handle that starts from a snapshot taken with snapshot() """
+        stack = cls()
+        stack._snap = snapshot if snapshot is not None else _EMPTY_SNAPSHOT
+        return stack
+
+    def snapshot(self) -> _StackSnapshot:
+        """ returns the immutable version of the stack, this is an O(1) pointer grab. The same object is returned
+        until the stack changes so snapshots can be compared with 'is' """
+        return self._snap
+
+    def __len__(self):
+        return len(self._snap)
+
+    def __iter__(self):
+        """ iterates from X to the bottom of the stack """
+        chain = self._snap.front
+        while chain is not None:
+            yield chain.value
+            chain = chain.below
+        yield from reversed(_chain_values(self._snap.back))
+
+    def __reversed__(self):
+        return reversed(list(self))
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def __eq__(self, other):
+        if isinstance(other, (CalcStack, list)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def _index(self, idx: int, for_insert=False) -> int:
+        """ normalizes a (possibly negative) list style index """
+        length = len(self)
+        if idx < 0:
+            idx += length
+        if for_insert:
+            return min(max(idx, 0), length)
+        if idx < 0 or idx >= length:
+            raise IndexError('stack index out of range')
+        return idx
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return list(self)[idx]
+        idx = self._index(idx)
+        front_depth = _depth(self._snap.front)
+        if idx < front_depth:
+            return _chain_split(self._snap.front, idx)[1].value
+        return _chain_split(self._snap.back, len(self) - 1 - idx)[1].value
+
+    def __setitem__(self, idx, value):
+        idx = self._index(idx)
+        front, back = self._snap.front, self._snap.back
+        if idx < _depth(front):
+            above, node = _chain_split(front, idx)
+            self._set(_chain_rebuild(above, _StackNode(value, node.below)), back)
+        else:
+            above, node = _chain_split(back, len(self) - 1 - idx)
+            self._set(front, _chain_rebuild(above, _StackNode(value, node.below)))
+
+    def insert(self, idx: int, value):
+        """ inserts value at idx, like list.insert() """
+        idx = self._index(idx, for_insert=True)
+        front, back = self._snap.front, self._snap.back
+        if idx == 0:
+            self._snap = _StackSnapshot(_StackNode(value, front), back)
+        elif idx < _depth(front) or (idx == _depth(front) and idx <= _depth(back)):
+            above, node = _chain_split(front, idx)
+            self._set(_chain_rebuild(above, _StackNode(value, node)), back)
+        else:
+            above, node = _chain_split(back, len(self) - idx)
+            self._set(front, _chain_rebuild(above, _StackNode(value, node)))
+
+    def append(self, value):
+        """ puts value at the bottom of the stack """
+        self.insert(len(self), value)
+
+    def pop(self, idx=-1):
+        """ removes and returns the value at idx, like list.pop() """
+        idx = self._index(idx)
+        if self._snap.back is None and idx >= _STACK_MIN_FRONT_DEPTH and idx == len(self) - 1:
+            # pushes only grow the front chain, split it once so the next pops at the bottom are O(1) (roll up)
+            self._snap = self._balanced(list(self))
+        front, back = self._snap.front, self._snap.back
+        if idx < _depth(front):
+            above, node = _chain_split(front, idx)
+            self._set(_chain_rebuild(above, node.below), back)
+        else:
+            above, node = _chain_split(back, len(self) - 1 - idx)
+            self._set(front, _chain_rebuild(above, node.below))
+        return node.value
+
+    def extend_top(self, values):
+        """ pushes values onto X one at a time, like calling insert(0, value) for each value but in one pass
+        @param values: an iterable, the last value ends up at X """
+        self._snap = _StackSnapshot(_chain(values, self._snap.front), self._snap.back)
+        if self._snap.front is None and self._snap.back is None:
+            self._snap = _EMPTY_SNAPSHOT
+
+    def clear(self):
+        self._snap = _EMPTY_SNAPSHOT
+
+    def copy(self):
+        """ returns a new handle on the same nodes, O(1) """
+        return CalcStack.from_snapshot(self._snap)
+
+
+def _approximate_nbytes(value) -> int:
+    """ returns the approximate memory footprint of value in bytes. numpy arrays report their buffer size (nbytes),
+    containers are walked so their contents are counted (each object once), everything else uses sys.getsizeof
+    @param value: any python object
+    @return: the approximate size in bytes """
+    if type(value) in (int, float, complex, str, bool):  # most stack levels, skip the walk
+        return sys.getsizeof(value)
+    total = 0
+    seen = set()
+    to_visit = [value]
+    while len(to_visit) > 0:
+        item = to_visit.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        if isinstance(item, np.memmap) and item.filename is not None:
+            total += sys.getsizeof(item, 0)  # the data is paged in from disk on demand, count the header only
+        elif isinstance(item, np.ndarray):
+            total += item.nbytes
+            if item.dtype == object:
+                to_visit.extend(item.flat)
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            total += sys.getsizeof(item, 0)
+            to_visit.extend(item)
+        elif isinstance(item, dict):
+            total += sys.getsizeof(item, 0)
+            to_visit.extend(item.keys())
+            to_visit.extend(item.values())
+        else:
+            try:
+                total += sys.getsizeof(item)
+            except TypeError:
+                pass  # some extension types can't report their size, ignore them
+    return total
+
+
+def _format_nbytes(nbytes: int) -> str:
+    """ formats a byte count for the message field, like '12.3 MB' """
+    size = float(nbytes)
+    for unit in ('B', 'kB', 'MB', 'GB'):
+        if size < 1000:
+            return f"{size:0.1f} {unit}"
+        size /= 1000
+    return f"{size:0.1f} TB"
+
+
+def _nodes_not_in(chain, other):
+    """ yields the nodes of the persistent stack chain that are not shared with the chain other, this only walks the
+    nodes above the first shared node so it costs O(number of changed levels), not O(stack depth)
+    @param chain: the top _StackNode of a snapshot (or None)
+    @param other: the top _StackNode of the snapshot to compare to (or None) """
+    depth = 0 if chain is None else chain.depth
+    other_depth = 0 if other is None else other.depth
+    while depth > other_depth:
+        yield chain
+        chain = chain.below
+        depth -= 1
+    while other_depth > depth:
+        other = other.below
+        other_depth -= 1
+    while chain is not other:
+        yield chain
+        chain = chain.below
+        other = other.below
+
+
+def _snapshot_nodes_not_in(snapshot, other):
+    """ yields the nodes of both chains of a stack snapshot that are not shared with the snapshot other
+    @param snapshot: a _StackSnapshot (or None)
+    @param other: the _StackSnapshot to compare to (or None) """
+    snapshot = _EMPTY_SNAPSHOT if snapshot is None else snapshot
+    other = _EMPTY_SNAPSHOT if other is None else other
+    yield from _nodes_not_in(snapshot.front, other.front)
+    yield from _nodes_not_in(snapshot.back, other.back)
+
+
+def _remove_file(path):
+    """ removes a spill file, if the file is still memory mapped (on Windows) it is left for the directory cleanup """
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class _SpilledArray:
+    """ stands in for a numpy array that was written to disk by the undo history. The file is removed when the last
+    snapshot that references it is gone, the array comes back as a read only memory map so only the pages that are
+    actually used get read """
+    __slots__ = ('path', 'nbytes', '_loaded', '__weakref__')
+
+    def __init__(self, array: np.ndarray, path: str):
+        np.save(path, array, allow_pickle=False)
+        self.path = path
+        self.nbytes = array.nbytes
+        self._loaded = None
+        weakref.finalize(self, _remove_file, path)
+
+    def load(self) -> np.ndarray:
+        """ returns the memory mapped array, the same array is returned for every stack level that referenced it """
+        if self._loaded is None:
+            self._loaded = np.load(self.path, mmap_mode='r')
+        return self._loaded
+
+    def __repr__(self):
+        return f"<spilled array: {self.path}, {_format_nbytes(self.nbytes)}>"
+
+
+class StackHistory:
+    """ the undo history of stack snapshots with a length limit, a memory budget and a disk spill tier.
+
+    Snapshots share nodes, so the footprint is counted per distinct value: each value referenced by the history is
+    counted once, no matter how many snapshots (or how many stack levels, think 'dup') point at it. Adding or removing
+    a snapshot only looks at the levels that differ from its neighbor so the bookkeeping stays O(1) for normal
+    operations. When the footprint is over the budget the oldest snapshots are evicted, the newest is always kept.
+
+    The newest 'hot_length' snapshots stay in RAM. Older (cold) snapshots get their large numpy arrays written to a
+    temp directory as .npy files, unless a hot snapshot still uses the array (writing it would not free anything).
+    If the user undoes back to a cold snapshot the arrays are memory mapped back in. """
+
+    def __init__(self, max_length=100, max_bytes=1_000_000_000, hot_length=10, spill_min_bytes=16_000_000):
+        """ @param max_length: the maximum number of snapshots to keep
+        @param max_bytes: the approximate memory budget for the values referenced by the snapshots
+        @param hot_length: the number of newest snapshots that are never spilled to disk
+        @param spill_min_bytes: arrays smaller than this stay in RAM, set to None to turn off spilling """
+        self.max_length = max_length
+        self.max_bytes = max_bytes
+        self.hot_length = hot_length
+        self.spill_min_bytes = spill_min_bytes
+        self.nbytes = 0  # approximate footprint of all the values referenced by the history
+        self.spilled_nbytes = 0  # bytes written to the spill directory
+        self._snapshots = []
+        self._value_refs = dict()  # like {id(value): [reference count, nbytes]}
+        self._cooled = 0  # snapshots[:_cooled] have been through the spill pass
+        self._cooled_nodes = weakref.WeakKeyDictionary()  # like {original node: cold node or None if unchanged}
+        # like {cold node: depth} the depth of the deepest spilled node in the chain from the cold node down, a chain
+        # head that is not in here has nothing spilled so undoing to it does not touch the chain
+        self._spill_depths = weakref.WeakKeyDictionary()
+        self._spilled_arrays = dict()  # like {id(array): (weakref to the array, weakref to the _SpilledArray)}
+        self._spill_dir = None
+
+    def __len__(self):
+        return len(self._snapshots)
+
+    def __getitem__(self, idx):
+        return self._snapshots[idx]
+
+    def _add_refs(self, nodes):
+        value_refs = self._value_refs  # stack wide operations add every level at once, keep the loop tight
+        added = 0
+        for node in nodes:
+            value = node.value
+            ref = value_refs.get(id(value))
+            if ref is None:
+                ref = [0, _approximate_nbytes(value)]
+                value_refs[id(value)] = ref
+                added += ref[1]
+            ref[0] += 1
+        self.nbytes += added
+
+    def _remove_refs(self, nodes):
+        for node in nodes:
+            ref = self._value_refs[id(node.value)]
+            ref[0] -= 1
+            if ref[0] == 0:
+                del self._value_refs[id(node.value)]
+                self.nbytes -= ref[1]
+
+    def append(self, snapshot) -> int:
+        """ adds a snapshot and evicts the oldest snapshots that don't fit the length limit or the memory budget
+        @param snapshot: the immutable stack, from CalcStack.snapshot()
+        @return: the number of evicted snapshots """
+        previous = self._snapshots[-1] if len(self._snapshots) > 0 else None
+        self._add_refs(_snapshot_nodes_not_in(snapshot, previous))
+        self._snapshots.append(snapshot)
+
+        evicted = 0
+        while len(self._snapshots) > 1 and (len(self._snapshots) > self.max_length or self.nbytes > self.max_bytes):
+            if self._cool_next() is True:
+                continue  # spilling the next cold snapshot may be enough to get under the budget
+            oldest = self._snapshots.pop(0)
+            self._remove_refs(_snapshot_nodes_not_in(oldest, self._snapshots[0]))
+            self._cooled = max(self._cooled - 1, 0)
+            evicted += 1
+
+        while self._cool_next() is True:
+            pass
+        return evicted
+
+    def pop(self):
+        """ removes and returns the newest snapshot, spilled arrays are memory mapped back in """
+        newest = self._snapshots.pop(-1)
+        previous = self._snapshots[-1] if len(self._snapshots) > 0 else None
+        self._remove_refs(_snapshot_nodes_not_in(newest, previous))
+        if len(self._snapshots) < self._cooled:
+            self._cooled = len(self._snapshots)
+            newest = self._warm(newest)
+        return newest
+
+    def clear(self):
+        self._snapshots = []
+        self._value_refs = dict()
+        self.nbytes = 0
+        self._cooled = 0
+
+    def footprint_message(self) -> str:
+        """ returns a short description of the history size for the message field """
+        message = (f"History Length: '{len(self._snapshots)}', "
+                   f"History Size: '{_format_nbytes(self.nbytes)}' of '{_format_nbytes(self.max_bytes)}'")
+        if self.spilled_nbytes > 0:
+            message += f", Spilled to disk: '{_format_nbytes(self.spilled_nbytes)}'"
+        return message
+
+    def _cool_next(self) -> bool:
+        """ runs the spill pass on the oldest snapshot that is outside the hot window and has not been cooled yet
+        @return: True if a snapshot was cooled, False if there was nothing to do """
+        if self.spill_min_bytes is None or self._cooled >= len(self._snapshots) - self.hot_length:
+            return False
+        idx = self._cooled
+        self._cooled += 1
+        snapshot = self._snapshots[idx]
+        hot_ids = []  # filled on first use, finding the hot arrays walks the hot snapshots
+        front = self._cool_chain(snapshot.front, hot_ids)
+        back = self._cool_chain(snapshot.back, hot_ids)
+        if front is not snapshot.front or back is not snapshot.back:
+            self._replace_snapshot(idx, _StackSnapshot(front, back))
+        return True
+
+    def _cool_chain(self, chain, hot_ids: list):
+        """ returns the cold version of one chain of a snapshot, nodes that an earlier spill pass already looked at
+        are re-used so this normally only walks a few levels
+        @param hot_ids: an empty list or a list holding the set from _hot_array_ids() """
+        pending = []
+        node = chain
+        while node is not None and node not in self._cooled_nodes:
+            pending.append(node)
+            node = node.below
+        if node is not None and self._cooled_nodes[node] is not None:
+            node = self._cooled_nodes[node]
+        spill_depth = self._spill_depths.get(node, 0) if node is not None else 0
+
+        for original in reversed(pending):
+            value = original.value
+            if isinstance(value, np.ndarray) and value.nbytes >= self.spill_min_bytes:
+                if len(hot_ids) == 0:
+                    hot_ids.append(self._hot_array_ids())
+                if id(value) not in hot_ids[0]:
+                    value = self._spill_array(value)
+            if value is original.value and node is original.below:
+                self._cooled_nodes[original] = None
+                node = original
+            else:
+                node = _StackNode(value, node)
+                self._cooled_nodes[original] = node
+                if spill_depth == 0 and isinstance(value, _SpilledArray):
+                    spill_depth = node.depth  # the pending nodes go bottom up, the first spilled one is the deepest
+                if spill_depth > 0:
+                    self._spill_depths[node] = spill_depth
+        return node
+
+    def _hot_array_ids(self) -> set:
+        """ returns the ids of the large arrays that are referenced by the snapshots in the hot window """
+        ids = set()
+        visited = set()
+        for snapshot in self._snapshots[-self.hot_length:]:
+            for node in (snapshot.front, snapshot.back):
+                while node is not None and id(node) not in visited:
+                    visited.add(id(node))
+                    if isinstance(node.value, np.ndarray):
+                        ids.add(id(node.value))
+                    node = node.below
+        return ids
+
+    def _spill_array(self, array: np.ndarray) -> _SpilledArray:
+        """ writes the array to the spill directory, an array is only written once no matter how many levels and
+        snapshots reference it """
+        refs = self._spilled_arrays.get(id(array))
+        if refs is not None and refs[0]() is array and refs[1]() is not None:
+            return refs[1]()
+
+        if self._spill_dir is None:
+            self._spill_dir = tempfile.mkdtemp(prefix='pycalc_undo_')
+            weakref.finalize(self, shutil.rmtree, self._spill_dir, True)
+        path = os.path.join(self._spill_dir, f"{id(array)}_{len(self._spilled_arrays)}.npy")
+        spilled = _SpilledArray(array, path)
+        self.spilled_nbytes += spilled.nbytes
+        weakref.finalize(spilled, self._forget_spilled, id(array), spilled.nbytes)
+        self._spilled_arrays[id(array)] = (weakref.ref(array), weakref.ref(spilled))
+        return spilled
+
+    def _forget_spilled(self, array_id: int, nbytes: int):
+        """ called when the last cold snapshot that used a spilled array is gone """
+        self.spilled_nbytes -= nbytes
+        refs = self._spilled_arrays.get(array_id)
+        if refs is not None and refs[1]() is None:
+            del self._spilled_arrays[array_id]
+
+    def _replace_snapshot(self, idx: int, snapshot):
+        """ swaps the snapshot at idx for its cold version and moves the value references to match """
+        previous = self._snapshots[idx - 1] if idx > 0 else None
+        following = self._snapshots[idx + 1] if idx + 1 < len(self._snapshots) else None
+        # add before remove so values that are in both versions keep their reference count above zero
+        self._add_refs(_snapshot_nodes_not_in(snapshot, previous))
+        if following is not None:
+            self._add_refs(_snapshot_nodes_not_in(following, snapshot))
+        self._remove_refs(_snapshot_nodes_not_in(self._snapshots[idx], previous))
+        if following is not None:
+            self._remove_refs(_snapshot_nodes_not_in(following, self._snapshots[idx]))
+        self._snapshots[idx] = snapshot
+
+    def _warm(self, snapshot):
+        """ returns the snapshot with the spilled arrays memory mapped back in. A snapshot with nothing spilled is
+        returned as is, otherwise only the nodes down to the deepest spilled one are re-built """
+        front = self._warm_chain(snapshot.front)
+        back = self._warm_chain(snapshot.back)
+        if front is snapshot.front and back is snapshot.back:
+            return snapshot  # ---------------------------------------------------------------------------------------->
+        return _StackSnapshot(front, back)
+
+    def _warm_chain(self, chain):
+        """ returns the chain with the spilled arrays loaded, the nodes below the deepest spilled node are shared """
+        spill_depth = self._spill_depths.get(chain, 0) if chain is not None else 0
+        if spill_depth == 0:
+            return chain  # ------------------------------------------------------------------------------------------->
+        above, below = _chain_split(chain, chain.depth - spill_depth + 1)
+        return _chain_rebuild([value.load() if isinstance(value, _SpilledArray) else value for value in above], below)
+
+
+class _NotArithmetic(Exception):
+    """ raised by the arithmetic evaluator for code it does not handle, the caller falls back to eval() """
+
+
+# the operators the arithmetic evaluator handles, like {ast node type: function}
+_ARITHMETIC_BINARY = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv,
+                      ast.FloorDiv: operator.floordiv, ast.Mod: operator.mod, ast.Pow: operator.pow,
+                      ast.MatMult: operator.matmul, ast.BitAnd: operator.and_, ast.BitOr: operator.or_,
+                      ast.BitXor: operator.xor, ast.LShift: operator.lshift, ast.RShift: operator.rshift}
+_ARITHMETIC_UNARY = {ast.UAdd: operator.pos, ast.USub: operator.neg, ast.Invert: operator.invert,
+                     ast.Not: operator.not_}
+_ARITHMETIC_COMPARE = {ast.Eq: operator.eq, ast.NotEq: operator.ne, ast.Lt: operator.lt, ast.LtE: operator.le,
+                       ast.Gt: operator.gt, ast.GtE: operator.ge}
+
+# the functions the arithmetic evaluator calls (numpy ufuncs are in too), with code execution turned off these are
+# also the only functions that can be called by name from the stack
+_ARITHMETIC_FUNCTIONS = frozenset(
+    [abs, round, min, max, pow, divmod, sum, int, float, complex, bool, len] +
+    [value for value in vars(math).values() if callable(value)] +
+    list(_NUMPY_ONE_ARG.values()) + list(_NUMPY_TWO_ARG.values()) +
+    [np.sum, np.prod, np.mean, np.median, np.std, np.var, np.min, np.max, np.cumsum, np.cumprod, np.diff, np.dot,
+     np.cross, np.array, np.arange, np.linspace, np.zeros, np.ones, np.round, np.clip, np.sort])
+
+
+def _is_arithmetic_function(function) -> bool:
+    """ returns True if function is a math function (see _ARITHMETIC_FUNCTIONS) or a numpy ufunc """
+    if isinstance(function, np.ufunc):
+        return True
+    try:
+        return function in _ARITHMETIC_FUNCTIONS
+    except TypeError:  # not hashable, so not a function
+        return False
+
+
+def _is_dotted_name(source: str) -> bool:
+    """ returns True for a plain name like 'x' or 'np.pi', a lookup that is cheaper done here than in the sandbox and
+    that may give a function or module the sandbox can't send back """
+    return all(part.isidentifier() for part in source.strip().split('.'))
+
+
+def _arithmetic_constant(value):
+    """ returns an evaluator that always returns value, the value is kept on the function for constant folding """
+    def constant(namespace):
+        return value
+    constant.value = value
+    return constant
+
+
+def _fold(function, *operands):
+    """ returns the constant evaluator for function applied to constant operands, or None if an operand is not a
+    constant or the function raised (then the error is raised at evaluation time, like eval) """
+    for operand in operands:
+        if not hasattr(operand, 'value'):
+            return None
+    values = [operand.value for operand in operands]
+    try:
+        if function in (operator.pow, operator.lshift) and not abs(values[1]) <= 64:
+            return None  # don't build a huge int while compiling, 9**9**9 only runs if the expression is evaluated
+        return _arithmetic_constant(function(*values))
+    except Exception:
+        return None
+
+
+def _compile_arithmetic(node):
+    """ turns the ast of an expression into a tree of small functions that evaluate it in a namespace, so plain math
+    like '(3.3*4.7)/(1+2)' or 'a*sin(t)' skips compile() and eval(). Handles numbers, names, module attributes
+    (np.pi), the arithmetic / bit operators, comparisons, list and tuple displays and calls of math functions with
+    positional arguments, constant parts are folded. Names are looked up when the expression is evaluated, an
+    attribute of something that is not a module or a call of something that is not a math function raises
+    _NotArithmetic at that point
+    @param node: an ast expression node
+    @return: a function like evaluate(namespace) -> value
+    @raise _NotArithmetic: for any other kind of expression """
+    builder = _ARITHMETIC_NODES.get(type(node))
+    if builder is None:
+        raise _NotArithmetic(f"expression: '{type(node).__name__}'")
+    return builder(node)
+
+
+def _arithmetic_number(node):
+    if node.value is not None and type(node.value) not in (int, float, complex, bool):
+        raise _NotArithmetic(f"constant: '{node.value!r}'")
+    return _arithmetic_constant(node.value)
+
+
+def _arithmetic_name(node):
+    name = node.id
+
+    def lookup(namespace):
+        try:
+            return namespace[name]
+        except KeyError:
+            pass
+        try:
+            return getattr(builtins, name)
+        except AttributeError:
+            raise NameError(f"name '{name}' is not defined") from None
+    return lookup
+
+
+def _arithmetic_attribute(node):
+    if node.attr.startswith('_'):
+        raise _NotArithmetic(f"private attribute: '{node.attr}'")
+    owner = _compile_arithmetic(node.value)
+    attribute = node.attr
+
+    def module_attribute(namespace):
+        module = owner(namespace)
+        if not isinstance(module, types.ModuleType):
+            raise _NotArithmetic(f"attribute of a '{type(module).__name__}': '{attribute}'")
+        return getattr(module, attribute)
+    return module_attribute
+
+
+def _arithmetic_binary(node):
+    function = _ARITHMETIC_BINARY.get(type(node.op))
+    if function is None:
+        raise _NotArithmetic(f"operator: '{type(node.op).__name__}'")
+    left = _compile_arithmetic(node.left)
+    right = _compile_arithmetic(node.right)
+    return _fold(function, left, right) or (lambda namespace: function(left(namespace), right(namespace)))
+
+
+def _arithmetic_unary(node):
+    function = _ARITHMETIC_UNARY[type(node.op)]
+    operand = _compile_arithmetic(node.operand)
+    return _fold(function, operand) or (lambda namespace: function(operand(namespace)))
+
+
+def _arithmetic_compare(node):
+    if not all(type(op) in _ARITHMETIC_COMPARE for op in node.ops):
+        raise _NotArithmetic("comparison: 'is' or 'in'")
+    functions = [_ARITHMETIC_COMPARE[type(op)] for op in node.ops]
+    operands = [_compile_arithmetic(operand) for operand in [node.left] + node.comparators]
+    if len(functions) == 1:
+        function, left, right = functions[0], operands[0], operands[1]
+        return lambda namespace: function(left(namespace), right(namespace))  # --------------------------------------->
+
+    def chained_compare(namespace):
+        left = operands[0](namespace)
+        result = True
+        for function, operand in zip(functions, operands[1:]):
+            right = operand(namespace)
+            result = function(left, right)
+            if not result:
+                return result
+            left = right
+        return result
+    return chained_compare
+
+
+def _arithmetic_display(node):
+    if any(type(item) is ast.Starred for item in node.elts):
+        raise _NotArithmetic("starred item")
+    items = [_compile_arithmetic(item) for item in node.elts]
+    container = list if type(node) is ast.List else tuple
+    return lambda namespace: container([item(namespace) for item in items])
+
+
+def _arithmetic_call(node):
+    if len(node.keywords) > 0 or any(type(argument) is ast.Starred for argument in node.args):
+        raise _NotArithmetic("call with keyword or starred arguments")
+    callee = _compile_arithmetic(node.func)
+    arguments = [_compile_arithmetic(argument) for argument in node.args]
+
+    def math_function(namespace):
+        function = callee(namespace)
+        if not _is_arithmetic_function(function):
+            raise _NotArithmetic(f"call of: '{function}'")
+        return function
+
+    if len(arguments) == 1:  # most calls, like sqrt(a), skip building the argument list
+        argument = arguments[0]
+        return lambda namespace: math_function(namespace)(argument(namespace))  # ------------------------------------->
+    return lambda namespace: math_function(namespace)(*[argument(namespace) for argument in arguments])
+
+
+# the ast nodes the arithmetic evaluator handles, like {node type: function that builds the evaluator}
+_ARITHMETIC_NODES = {ast.Constant: _arithmetic_number, ast.Name: _arithmetic_name,
+                     ast.Attribute: _arithmetic_attribute, ast.BinOp: _arithmetic_binary,
+                     ast.UnaryOp: _arithmetic_unary, ast.Compare: _arithmetic_compare, ast.List: _arithmetic_display,
+                     ast.Tuple: _arithmetic_display, ast.Call: _arithmetic_call}
+
+
+# elementwise expressions over arrays of at least this many elements are run in chunks (see _FusedPlan)
+_FUSED_MIN_SIZE = 1 << 18
+_FUSED_CHUNK = 1 << 15  # elements per chunk, the step buffers (256 KB each for float64) stay in the cpu cache
+
+# the elementwise steps a fused plan handles, like {ast node type: (ufunc for arrays, function for scalars)}, the ufunc
+# is what the ndarray operator calls. Pow keeps operator.pow, ndarray ** has fast paths (a**2 is np.square)
+_FUSED_OPERATORS = {ast.Add: (np.add, operator.add), ast.Sub: (np.subtract, operator.sub),
+                    ast.Mult: (np.multiply, operator.mul), ast.Div: (np.true_divide, operator.truediv),
+                    ast.FloorDiv: (np.floor_divide, operator.floordiv), ast.Mod: (np.remainder, operator.mod),
+                    ast.Pow: (None, operator.pow), ast.BitAnd: (np.bitwise_and, operator.and_),
+                    ast.BitOr: (np.bitwise_or, operator.or_), ast.BitXor: (np.bitwise_xor, operator.xor),
+                    ast.LShift: (np.left_shift, operator.lshift), ast.RShift: (np.right_shift, operator.rshift),
+                    ast.USub: (np.negative, operator.neg), ast.UAdd: (np.positive, operator.pos),
+                    ast.Invert: (np.invert, operator.invert), ast.Eq: (np.equal, operator.eq),
+                    ast.NotEq: (np.not_equal, operator.ne), ast.Lt: (np.less, operator.lt),
+                    ast.LtE: (np.less_equal, operator.le), ast.Gt: (np.greater, operator.gt),
+                    ast.GtE: (np.greater_equal, operator.ge)}
+
+
+class _FusedPlan:
+    """ an elementwise expression like 'a*b + c*np.sin(d)' as a list of ufunc steps that is run over the arrays in
+    chunks. Every step writes into a small preallocated buffer, so the only full size array is the result, eval()
+    makes a full size temporary for every step. numpy releases the GIL in the ufunc loops so the chunks can be split
+    over a thread pool. The names are looked up on every run, a run returns None (use the normal evaluator) unless
+    the arrays are large, numeric, contiguous and all the same shape """
+    __slots__ = ('names', 'steps')
+
+    def __init__(self, node):
+        """ @param node: the ast of the expression
+        @raise _NotArithmetic: if the expression is not elementwise math over names and numbers """
+        self.names = []  # the names the expression reads, like ['a', 'b', 'c', 'd']
+        self.steps = []  # like [(ufunc, scalar function, [argument refs])], a call has the callee path as the ufunc
+        if self._add(node)[0] != 'step':
+            raise _NotArithmetic("nothing to fuse")
+
+    def _add(self, node) -> tuple:
+        """ adds the steps for node, returns the reference to its value like ('name', 0), ('step', 2) or
+        ('constant', 2.5) """
+        node_type = type(node)
+        if node_type is ast.Constant and type(node.value) in (int, float, complex):
+            return 'constant', node.value  # -------------------------------------------------------------------------->
+        if node_type is ast.Name:
+            if node.id not in self.names:
+                self.names.append(node.id)
+            return 'name', self.names.index(node.id)  # --------------------------------------------------------------->
+        if node_type is ast.BinOp and type(node.op) in _FUSED_OPERATORS:
+            arguments = [self._add(node.left), self._add(node.right)]
+            functions = _FUSED_OPERATORS[type(node.op)]
+        elif node_type is ast.UnaryOp and type(node.op) in _FUSED_OPERATORS:
+            arguments = [self._add(node.operand)]
+            functions = _FUSED_OPERATORS[type(node.op)]
+        elif node_type is ast.Compare and len(node.ops) == 1 and type(node.ops[0]) in _FUSED_OPERATORS:
+            arguments = [self._add(node.left), self._add(node.comparators[0])]
+            functions = _FUSED_OPERATORS[type(node.ops[0])]
+        elif node_type is ast.Call and len(node.keywords) == 0 and 0 < len(node.args) < 3:
+            path = []
+            callee = node.func
+            while type(callee) is ast.Attribute:
+                path.insert(0, callee.attr)
+                callee = callee.value
+            if type(callee) is not ast.Name:
+                raise _NotArithmetic("call of an expression")
+            arguments = [self._add(argument) for argument in node.args]
+            functions = (tuple([callee.id] + path), None)
+        else:
+            raise _NotArithmetic(f"not elementwise: '{node_type.__name__}'")
+        self.steps.append((functions[0], functions[1], arguments))
+        return 'step', len(self.steps) - 1
+
+    def run(self, namespace: dict, pool=None, threads=1, check=None):
+        """ evaluates the plan in the namespace
+        @param namespace: the names to evaluate in
+        @param pool: an optional concurrent.futures executor to run the chunks on
+        @param threads: the number of workers in pool
+        @param check: an optional callable run before each chunk, it raises to stop, like Calculator._check_cancelled
+        @return: the result array, or None if the operands are not a fit (small, not numeric, different shapes ...) """
+        values = []
+        shape = None
+        for name in self.names:
+            value = namespace.get(name, namespace)
+            if value is namespace:
+                return None  # ---------------------------------------------------------------------------------------->
+            if isinstance(value, np.ndarray) and value.ndim > 0:
+                if value.dtype.kind not in 'biufc' or not value.flags.c_contiguous or shape not in (None, value.shape):
+                    return None  # ------------------------------------------------------------------------------------>
+                shape = value.shape
+                value = value.reshape(-1)
+            elif not isinstance(value, (int, float, complex, np.number, np.ndarray)):  # a 0-d array is a scalar
+                return None  # ---------------------------------------------------------------------------------------->
+            values.append(value)
+        if shape is None or math.prod(shape) < _FUSED_MIN_SIZE:
+            return None  # -------------------------------------------------------------------------------------------->
+
+        # resolve the callees, and work out the steps that only see scalars once (python rules, like eval)
+        steps = []
+        scalars = dict()  # like {step index: value}
+        for index, (ufunc, scalar_function, arguments) in enumerate(self.steps):
+            if isinstance(ufunc, tuple):  # a call, like ('np', 'sin')
+                path = ufunc
+                ufunc = namespace.get(path[0], getattr(builtins, path[0], None))
+                for attribute in path[1:]:
+                    ufunc = getattr(ufunc, attribute, None)
+                if not isinstance(ufunc, np.ufunc) or ufunc.nout != 1 or ufunc.nin != len(arguments):
+                    return None  # ------------------------------------------------------------------------------------>
+                scalar_function = ufunc
+            steps.append((ufunc, arguments))
+            if not any(self._is_array(reference, values, scalars) for reference in arguments):
+                try:
+                    scalars[index] = scalar_function(*[self._value(reference, values, scalars, 0, 1)
+                                                       for reference in arguments])
+                except Exception:
+                    return None  # let eval report it ------------------------------------------------------------>
+
+        # run the first element to find the dtype of every step, any error is left to eval
+        try:
+            with np.errstate(all='ignore'):
+                dtypes = [getattr(result, 'dtype', None) for result in self._run_chunk(steps, values, scalars, 0, 1)]
+        except Exception:
+            return None  # -------------------------------------------------------------------------------------------->
+
+        result = np.empty(shape, dtype=dtypes[-1])
+        flat = result.reshape(-1)
+        starts = range(0, flat.size, _FUSED_CHUNK)
+
+        def work(worker_starts):
+            buffers = [None if dtype is None else np.empty(_FUSED_CHUNK, dtype=dtype) for dtype in dtypes[:-1]]
+            for start in worker_starts:
+                if check is not None:
+                    check()
+                stop = min(start + _FUSED_CHUNK, flat.size)
+                self._run_chunk(steps, values, scalars, start, stop, buffers, flat[start:stop])
+
+        if pool is None or threads < 2:
+            work(starts)
+        else:
+            list(pool.map(work, [starts[worker::threads] for worker in range(threads)]))  # list() raises errors
+        return result
+
+    @staticmethod
+    def _is_array(reference: tuple, values: list, scalars: dict) -> bool:
+        kind, key = reference
+        if kind == 'name':
+            return isinstance(values[key], np.ndarray) and values[key].ndim > 0
+        return kind == 'step' and key not in scalars
+
+    @staticmethod
+    def _value(reference: tuple, values: list, scalars: dict, start: int, stop: int, results=None):
+        """ returns the value of a reference for the chunk start:stop """
+        kind, key = reference
+        if kind == 'constant':
+            return key
+        if kind == 'name':
+            value = values[key]
+            return value[start:stop] if isinstance(value, np.ndarray) and value.ndim > 0 else value
+        return scalars[key] if key in scalars else results[key]
+
+    def _run_chunk(self, steps, values, scalars, start, stop, buffers=None, out=None) -> list:
+        """ runs the array steps for the elements start:stop, step results go in buffers (the last one in out),
+        without buffers every step allocates (used to find the dtypes)
+        @return: the results of all the steps """
+        results = [None] * len(steps)
+        last = len(steps) - 1
+        for index, (ufunc, arguments) in enumerate(steps):
+            if index in scalars:
+                continue
+            inputs = [self._value(reference, values, scalars, start, stop, results) for reference in arguments]
+            target = None
+            if buffers is not None:
+                target = out if index == last else buffers[index][:stop - start]
+            if ufunc is None:  # pow, see _FUSED_OPERATORS
+                result = operator.pow(*inputs)
+                if target is not None:
+                    target[...] = result
+                    result = target
+            else:
+                result = ufunc(*inputs, out=target)
+            results[index] = result
+        return results
+
+
+class CodeCache:
+    """ an LRU cache of compiled code objects keyed by (source text, mode). The eval/exec paths see the same few
+    strings over and over ('x', 'a*2', 'np.sin(t)' on every stack operation ...), compiling them once skips the parse
+    on every later use. Mode 'parse' caches the ast tree (used by the copy on write check) and mode 'arithmetic' the
+    evaluators for plain math (_compile_arithmetic and _FusedPlan). Syntax errors are cached too, a statement typed
+    at X is tried with eval first and that failure would otherwise be re-parsed every time """
+
+    def __init__(self, max_length=512):
+        """ @param max_length: the number of code objects to keep, the least recently used is dropped first """
+        self.max_length = max_length
+        self.hits = 0
+        self.misses = 0
+        self._code = OrderedDict()  # like {(source, mode): code object, ast tree or SyntaxError}
+
+    def __len__(self):
+        return len(self._code)
+
+    def compile(self, source: str, mode='eval'):
+        """ returns the code object for source, compiles it on a miss
+        @param source: the python source text
+        @param mode: 'eval', 'exec', 'parse' or 'arithmetic' (the evaluator from _compile_arithmetic and the
+                     _FusedPlan or None)
+        @raise SyntaxError: if the source does not compile in this mode
+        @raise _NotArithmetic: in 'arithmetic' mode if the source is not plain math """
+        key = (source, mode)
+        code = self._code.get(key)
+        if code is not None:
+            self.hits += 1
+            self._code.move_to_end(key)
+        else:
+            self.misses += 1
+            try:
+                if mode == 'parse':
+                    code = ast.parse(source.strip())
+                elif mode == 'arithmetic':
+                    expression = self._expression(source)
+                    code = (_compile_arithmetic(expression), self._fused_plan(expression))
+                elif mode == 'eval':
+                    code = compile(source.strip(' \t'), '<calc>', mode)  # eval() strips spaces and tabs too
+                else:
+                    code = compile(source, '<calc>', mode)
+            except (SyntaxError, _NotArithmetic) as ex:
+                code = ex
+            except RecursionError as ex:
+                if mode != 'arithmetic':
+                    raise
+                code = _NotArithmetic(f"expression is nested too deep: {ex}")  # eval() may still take it
+            self._code[key] = code
+            self.trim()
+        if isinstance(code, (SyntaxError, _NotArithmetic)):
+            raise code.with_traceback(None)
+        return code
+
+    def _expression(self, source: str):
+        """ returns the ast of source as an expression, re-using the cached 'parse' tree (the copy on write check
+        parses everything that reaches eval, so an expression typed at X is only parsed once)
+        @raise _NotArithmetic: if source is a statement """
+        tree = self.compile(source, 'parse')
+        if len(tree.body) != 1 or type(tree.body[0]) is not ast.Expr or ';' in source:
+            raise _NotArithmetic("not an expression")
+        return tree.body[0].value
+
+    @staticmethod
+    def _fused_plan(expression):
+        """ returns the _FusedPlan for an expression, or None if it is not elementwise math """
+        try:
+            return _FusedPlan(expression)
+        except _NotArithmetic:
+            return None
+
+    def trim(self):
+        """ drops the least recently used code objects until the cache fits max_length """
+        while len(self._code) > self.max_length:
+            self._code.popitem(last=False)
+
+    def clear(self):
+        self._code.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats_message(self) -> str:
+        """ returns a short description of the cache for the message field """
+        total = self.hits + self.misses
+        rate = 100 * self.hits / total if total > 0 else 0.0
+        return f"Code Cache: '{len(self._code)}' of '{self.max_length}', Hits: '{self.hits}', " \
+               f"Misses: '{self.misses}', Hit Rate: '{rate:0.1f}%'"
+
+
+def _memo_key(value):
+    """ returns a hashable key for a function argument, numpy arrays are keyed by dtype, shape and a hash of their
+    content, lists and tuples by their items. The type is part of the key so f(1) and f(1.0) are cached apart
+    @raise TypeError: if the value can't be keyed (a dict, an object array, ...) """
+    if isinstance(value, np.ndarray):
+        if value.dtype.hasobject:
+            raise TypeError("object arrays can't be keyed by content")
+        digest = hashlib.blake2b(np.ascontiguousarray(value).view(np.uint8).data, digest_size=16).digest()
+        return np.ndarray, value.dtype.str, value.shape, digest  # ---------------------------------------------------->
+    if isinstance(value, (list, tuple)):
+        return type(value), tuple(_memo_key(item) for item in value)  # ----------------------------------------------->
+    hash(value)
+    return type(value), value
+
+
+class _MemoizedFunction:
+    """ wraps a pure user function (the result only depends on the arguments) with an LRU cache of its results, so
+    a slow function called again with the same values from the stack returns at once. The cached results are frozen
+    (read only arrays) like the stack values, a caller can't change a cached result. Calls with an argument that
+    can't be keyed go straight to the function """
+
+    def __init__(self, function, max_length=128):
+        """ @param function: the user function
+        @param max_length: the number of results to keep, the least recently used is dropped first """
+        update_wrapper(self, function)  # the name, docstring and signature (for the arity) of the function
+        self.function = function
+        self.max_length = max_length
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._results = OrderedDict()  # like {argument key: result}
+
+    def __call__(self, *args, **kwargs):
+        return self.call(self.function, args, kwargs)
+
+    def call(self, function, args: tuple, kwargs=None):
+        """ returns the cached result for the arguments, or calls function (the wrapped function or an elementwise
+        version of it, see _elementwise_shim) and caches the result """
+        try:
+            key = _memo_key(args) if not kwargs else (_memo_key(args), _memo_key(sorted(kwargs.items())))
+        except TypeError:
+            self.misses += 1
+            return function(*args, **(kwargs or {}))  # --------------------------------------------------------------->
+        try:
+            result = self._results[key]
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            self._results.move_to_end(key)
+            return result  # ------------------------------------------------------------------------------------------>
+        self.misses += 1
+        result = _freeze(function(*args, **(kwargs or {})))
+        self._results[key] = result
+        while len(self._results) > self.max_length:
+            self._results.popitem(last=False)
+            self.evictions += 1
+        return result
+
+    def clear(self):
+        self._results.clear()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats_message(self) -> str:
+        """ returns a short description of the cache for the message field """
+        total = self.hits + self.misses
+        rate = 100 * self.hits / total if total > 0 else 0.0
+        return f"Function Cache '{self.__name__}': '{len(self._results)}' of '{self.max_length}', " \
+               f"Hits: '{self.hits}', Misses: '{self.misses}', Evictions: '{self.evictions}', Hit Rate: '{rate:0.1f}%'"
+
+
+_PROGRAM_OPEN = {'(': ')', '[': ']', '{': '}'}
+
+
+def program_tokens(text: str) -> list:
+    """ splits the text of an RPN program into the tokens for Calculator.run_program(). Tokens are separated by white
+    space, white space inside brackets or quotes is part of the token so 'np.sum(x, axis=0)' is one token, and a '#'
+    outside of them starts a comment that runs to the end of the line. Like: '3 enter 4 *  # twelve'
+    @param text: the program text
+    @return: a list of token strings """
+    tokens = []
+    token = []
+    closers = []  # the brackets that are still open
+    quote = None
+    comment = False
+    for char in text:
+        if comment:
+            if char == '\n':
+                comment = False
+            continue
+        if quote is not None:
+            token.append(char)
+            if char == quote:
+                quote = None
+        elif char in '\'"':
+            token.append(char)
+            quote = char
+        elif char in _PROGRAM_OPEN:
+            token.append(char)
+            closers.append(_PROGRAM_OPEN[char])
+        elif closers and char == closers[-1]:
+            token.append(char)
+            closers.pop()
+        elif closers:
+            token.append(char)
+        elif char == '#':
+            comment = True
+        elif char.isspace():
+            if token:
+                tokens.append(''.join(token))
+                token = []
+        else:
+            token.append(char)
+    if token:
+        tokens.append(''.join(token))
+    return tokens
+
+
+def _open_brackets(text: str) -> int:
+    """ returns the number of brackets still open in typed text, brackets in quotes don't count, so 'f(1)' is 0 and
+    'f(1, [2' is 2 """
+    closers = []
+    quote = None
+    for char in text:
+        if quote is not None:
+            if char == quote:
+                quote = None
+        elif char in '\'"':
+            quote = char
+        elif char in _PROGRAM_OPEN:
+            closers.append(_PROGRAM_OPEN[char])
+        elif closers and char == closers[-1]:
+            closers.pop()
+    return len(closers)
+
+
+# the constant buttons, the value is put on the stack as text like the user typed it
+_CONSTANTS = {'pi': '3.14159265', 'π': '3.14159265', 'euler': '2.71828182', 'ℇ': '2.71828182', 'phi': '1.61803398',
+              'jackpot': '777'}
+
+# the buttons a macro can be compiled from, the code is formatted with X and Y, see _compile_macro()
+_MACRO_BINARY = {name: f'{{y}} {name} {{x}}' for name in ('+', '-', '*', '/', '**', '@', '//', '%', '&', '|', '^',
+                                                           '<<', '>>')}
+_MACRO_BINARY.update({'x^y': '{y} ** {x}', 'xʸ': '{y} ** {x}'})
+_MACRO_UNARY = {'x^2': '{x} ** 2', 'x²': '{x} ** 2', 'negate': '-{x}', '+/-': '-{x}', '±': '-{x}', '1/x': '1 / {x}',
+                'recip': '1 / {x}', 'e^x': 'np.exp({x})', 'eˣ': 'np.exp({x})', 'ln': 'np.log({x})',
+                'log10': 'np.log10({x})', 'log': 'np.log10({x})', '√': 'np.sqrt({x})'}
+_MACRO_SWAP = {'swap', 'swap_x_y', 'x<->y', 'x⟷y'}
+_MACRO_ARGUMENTS = ('x', 'y', 'z', 't')  # the argument names for the stack levels the macro takes, X first
+
+
+class _MacroValue:
+    """ a value on the stack of the macro compiler, code is the python expression for it. A duplicate is the same
+    object twice, like enter puts the same object in X and Y """
+    __slots__ = ('code',)
+
+    def __init__(self, code=None):
+        self.code = code
+
+
+def _math_button_code(function: str, table: dict, arguments: str) -> str:
+    """ returns the code for a math library button, the numpy ufunc when there is one so a macro works on arrays """
+    ufunc = table.get(function)
+    if isinstance(ufunc, np.ufunc) and getattr(np, ufunc.__name__, None) is ufunc:
+        return f'np.{ufunc.__name__}({arguments})'
+    if isinstance(ufunc, np.ufunc) and ufunc.__name__ == f'{function} (vectorized)':
+        # a python loop over the math function, like factorial for exact ints
+        return f'np.frompyfunc(math.{function}, {ufunc.nin}, {ufunc.nout})({arguments})'
+    return f'math.{function}({arguments})'
+
+
+_MACRO_UNARY['!'] = _math_button_code('factorial', _NUMPY_ONE_ARG, '{x}')  # the ! button is the factorial button
+
+
+def _macro_number(number) -> str:
+    """ returns the code for a number, in brackets when it is negative so -3 ** 2 can't happen """
+    code = repr(number) if math.isfinite(abs(number)) else f"complex('{number}')"
+    return f'({code})' if code.startswith('-') else code
+
+
+def _macro_literal(text: str, names: set) -> str:
+    """ returns the code for text typed into X, adds the variables it reads to names
+    @raise ValueError: if the text is not an expression, like an assignment or an import """
+    kind, payload = _classify_entry(text)
+    if kind == 'number':
+        return _macro_number(payload)
+    try:
+        tree = ast.parse(text.strip(), mode='eval')
+    except SyntaxError:
+        raise ValueError(f"'{text}' is not an expression") from None
+    names.update(node.id for node in ast.walk(tree) if isinstance(node, ast.Name))
+    return f'({text.strip()})'
+
+
+def _compile_macro(name: str, tokens: list, math_arity: dict, buttons: set, functions: dict, variables: set) -> str:
+    """ compiles the tokens of a macro into the text of one python function, the stack is followed symbolically so
+    each button becomes one line of code and nothing is looked up, logged or saved to the history when it runs. The
+    stack levels the macro reads below the values it puts on the stack become the arguments, X first, like user
+    functions are called. The tokens are handled like Calculator.run_program() does: typed text is evaluated by the
+    next button, enter duplicates a number and the next typed entry replaces the duplicate, enter on the name of a
+    button or a user function calls it.
+    @param name: the function name
+    @param tokens: the recorded tokens, strings or numbers that were put on the stack
+    @param math_arity: like {'sin': 1, 'atan2': 2} the math library buttons
+    @param buttons: all the button names, the ones not handled here can't be compiled
+    @param functions: like {'name': 2} the user functions and the number of arguments they take from the stack
+    @param variables: the names of the variables, a typed variable name is a value even if it is a function name
+    @return: the function text for Calculator.add_user_function()
+    @raise ValueError: if a token can't be compiled or the macro does not leave exactly one value """
+    if not name.isidentifier():
+        raise ValueError(f"'{name}' is not a valid function name")
+    stack = []  # _MacroValue, X first
+    arguments = []
+    lines = []
+    names = set()  # variables read by typed expressions
+    typed = None  # text typed into X, stack[0] is the value it becomes
+    last = None
+
+    def take(count):
+        # the values that are missing are the levels below, they become the arguments
+        while len(stack) < count:
+            argument = _MACRO_ARGUMENTS[len(arguments)] if len(arguments) < len(_MACRO_ARGUMENTS) else \
+                f'a{len(arguments)}'
+            arguments.append(argument)
+            stack.append(_MacroValue(argument))
+
+    def evaluate_typed():
+        nonlocal typed
+        if typed is not None:
+            stack[0].code = _macro_literal(typed, names)
+            typed = None
+
+    def operation(template, count):
+        evaluate_typed()
+        take(count)
+        values = [stack.pop(0).code for _ in range(count)]
+        variable = f'v{len(lines) + 1}'
+        lines.append(f'{variable} = ' + template.format(x=values[0] if values else '', y=values[-1] if values else '',
+                                                         args=', '.join(values)))
+        stack.insert(0, _MacroValue(variable))
+
+    for token in tokens:
+        call = False  # True when enter calls the function named in X
+        if isinstance(token, int | float | complex) and not isinstance(token, bool):
+            evaluate_typed()
+            stack.insert(0, _MacroValue(_macro_number(token)))
+            last = 'user_entry'
+            continue
+        if not isinstance(token, str):
+            raise ValueError(f"a value of type '{type(token).__name__}' can't be compiled")
+        if typed is not None and _open_brackets(typed) > 0:
+            typed += token  # a bracket still open in X means buttons are typed too
+            continue
+        if token == 'enter' and typed is not None:
+            kind, payload = _classify_entry(typed)
+            if kind == 'name' and payload not in variables and (payload in buttons or payload in functions):
+                stack.pop(0)  # enter calls the function named in X
+                typed = None
+                token = payload
+                call = True
+        if token == 'enter':
+            if typed is not None:
+                number = _classify_entry(typed)[0] == 'number'
+                evaluate_typed()
+                if number:
+                    stack.insert(0, stack[0])
+            else:
+                take(1)
+                stack.insert(0, stack[0])
+            last = 'enter'
+        elif token in _CONSTANTS:
+            evaluate_typed()
+            stack.insert(0, _MacroValue(_CONSTANTS[token]))
+        elif token in _MACRO_SWAP:
+            evaluate_typed()
+            take(2)
+            stack[0], stack[1] = stack[1], stack[0]
+            last = 'function'
+        elif token in ('drop', 'clear'):
+            evaluate_typed()
+            take(1)
+            stack.pop(0)
+            last = 'function'
+        elif token == 'dup':
+            evaluate_typed()
+            take(1)
+            stack.insert(0, stack[0])
+            last = 'function'
+        elif token in _MACRO_BINARY:
+            operation(_MACRO_BINARY[token], 2)
+            last = 'function'
+        elif token in _MACRO_UNARY:
+            operation(_MACRO_UNARY[token], 1)
+            last = 'function'
+        elif math_arity.get(token) == 1:
+            operation(_math_button_code(token, _NUMPY_ONE_ARG, '{x}'), 1)
+            last = 'function'
+        elif math_arity.get(token) == 2:
+            operation(_math_button_code(token, _NUMPY_TWO_ARG, '{y}, {x}'), 2)
+            last = 'function'
+        elif call and token in functions:
+            operation(f'{token}({{args}})', functions[token])
+            last = 'function'
+        elif token in buttons and token != 'e':  # watch out for Euler
+            raise ValueError(f"the button '{token}' can't be compiled")
+        elif typed is not None:
+            typed += token
+        else:
+            if last == 'enter' and len(stack) > 1 and stack[0] is stack[1]:
+                stack[0] = _MacroValue()  # the typed entry replaces the duplicate
+            else:
+                stack.insert(0, _MacroValue())
+            typed = token
+            last = 'user_entry'
+    evaluate_typed()
+
+    if len(stack) != 1:
+        raise ValueError(f"the macro leaves '{len(stack)}' values on the stack, a function returns one")
+    clashes = names & (set(arguments) | {line.split(' = ')[0] for line in lines})
+    if clashes:
+        raise ValueError(f"the macro reads the variable(s) {sorted(clashes)} that the compiled code uses")
+    text = ' '.join(str(token) for token in tokens).replace('\\', '\\\\').replace('"', '\\"')
+    body = '\n'.join(f'    {line}' for line in lines + [f'return {stack[0].code}'])
+    return f'def {name}({", ".join(arguments)}):\n    """ macro: {text} """\n{body}\n'
+
+
+class OperationCancelled(BaseException):
+    """ raised after Calculator.cancel() at the next check between tokens or chunks, where the calculator state is
+    whole. It is a BaseException (like KeyboardInterrupt) so the 'except Exception' handlers of the calculator don't
+    turn it into an error message and carry on """
+
+
+# code that reads from these libraries has to run on the thread of the window, see Calculator._run_evaluation()
+_GUI_LIBRARIES = frozenset({'matplotlib', 'tkinter', 'plots'})
+
+
+def _from_gui_library(value) -> bool:
+    """ True if value is a module, class or function of a gui library, or an object made by one (like a figure) """
+    module = value.__name__ if isinstance(value, types.ModuleType) else getattr(value, '__module__', None)
+    if not isinstance(module, str):
+        module = type(value).__module__
+    return module.split('.')[0] in _GUI_LIBRARIES
+
+
+def _reads_gui(reads, namespace: dict) -> bool:
+    """ returns True if the code object or function reads a gui library, the user functions it calls are followed
+    @param reads: a code object, a function or None
+    @param namespace: the namespace the code runs in """
+    if reads is None:
+        return False  # ----------------------------------------------------------------------------------------------->
+    function = getattr(reads, '__wrapped__', reads)  # a pure user function is wrapped by its result cache
+    if isinstance(function, types.FunctionType) and function.__globals__ is namespace:
+        reads = function.__code__
+    if not isinstance(reads, types.CodeType):
+        return _from_gui_library(function)  # ------------------------------------------------------------------------->
+    names = code_names(reads)
+    seen = set()
+    while names:
+        name = names.pop()
+        seen.add(name)
+        if name not in namespace:
+            continue
+        value = namespace[name]
+        function = getattr(value, '__wrapped__', value)
+        if isinstance(function, types.FunctionType) and function.__globals__ is namespace:
+            names |= code_names(function.__code__) - seen
+        elif _from_gui_library(value):
+            return True  # -------------------------------------------------------------------------------------------->
+    return False
+
+
+class BackgroundJob:
+    """ runs a calculator action, like the long eval of an enter press, on a worker thread so a UI can keep drawing
+    while it runs. The caller owns the calculator until done() is True, then calls finish() or result() on its own
+    thread. cancel() is cooperative, see Calculator.cancel(): a program or a chunked array expression stops at the
+    next token or chunk and an evaluation in the sandbox is stopped by killing the child, other code runs to its end.
+    A cancelled job puts the stack back to what it was before the action started, variables it already assigned are
+    kept """
+
+    def __init__(self, calculator, action, label: str = ''):
+        """ @param calculator: the Calculator the action changes
+        @param action: a callable with no arguments
+        @param label: a name for the messages, like 'enter' """
+        self.label = label
+        self.error = None  # the exception if the action raised one
+        self._calculator = calculator
+        self._snapshot = calculator.stack_snapshot()
+        self._result = None
+        self._cancel_requested = False
+        calculator.cancel(False)  # a cancel of an earlier job does not stop this one
+        self._start = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, args=(action,), name=f'pycalc job {label}', daemon=True)
+        self._thread.start()
+
+    def _run(self, action):
+        try:
+            self._result = action()
+        except OperationCancelled:
+            pass
+        except Exception as ex:
+            self.error = ex
+        finally:
+            self._calculator.cancel(False)  # a late cancel must not stop the next action
+
+    def elapsed(self) -> float:
+        """ returns the seconds since the job started """
+        return time.perf_counter() - self._start
+
+    def wait(self, timeout: float = None) -> bool:
+        """ waits for the job to end
+        @param timeout: seconds to wait, None waits until done
+        @return: True if the job is done """
+        self._thread.join(timeout)
+        return self.done()
+
+    def done(self) -> bool:
+        return not self._thread.is_alive()
+
+    def cancel(self) -> bool:
+        """ asks the action to stop, see the class doc
+        @return: True if the job was still running """
+        if self.done():
+            return False  # ------------------------------------------------------------------------------------------->
+        self._cancel_requested = True
+        self._calculator.cancel()
+        return True
+
+    def result(self):
+        """ call once the job is done, for an action that is part of a calculator action running on the caller's thread
+        @return: what the action returned
+        @raise OperationCancelled: if the job was cancelled, the caller puts the stack back
+        @raise Exception: what the action raised """
+        if self._cancel_requested:
+            raise OperationCancelled(f"'{self.label}' was cancelled after '{self.elapsed():0.1f}' s")
+        if self.error is not None:
+            raise self.error
+        return self._result
+
+    def finish(self) -> str:
+        """ call once the job is done, restores the stack if the job was cancelled
+        @return: the message for the message field """
+        if self._cancel_requested:
+            message = f"Cancelled: '{self.label}' after '{self.elapsed():0.1f}' s, the stack was restored"
+            self._calculator.restore_stack_snapshot(self._snapshot, message)
+            return message  # ----------------------------------------------------------------------------------------->
+        if self.error is not None:
+            return f"Error: '{self.label}' failed with: {self.error}"
+        return self._calculator.return_message()
+
+
 class Calculator:
     """ A class that implements the backend of an RPN style calculator with the ability to perform RPN style operations
     on numbers AND python objects. The primary interface is the 'user_entry(input: any)' method which can handle most
@@ -77,20 +1966,46 @@ class Calculator:
     def __init__(self):
         """ initializes the calculator object with the default values for the stack, locals, and exec_globals """
         # print the version of python
-        self._stack = []
+        self._stack = CalcStack()
         self._last_stack_operation = None
         self._stack_history_length = 100 # units are in number of saved stacks, not a memory size
-        self._stack_history = [] # a list of stacks, use the update_stack_history() method to prevent mem runaway
+        self._stack_history_max_bytes = 1_000_000_000  # approximate memory budget for the values held by the history
+        # the stack snapshots, use the update_stack_history() method to add to it
+        self._stack_history = StackHistory(self._stack_history_length, self._stack_history_max_bytes)
+        self._stack_redo_history = [] # a list of (snapshot, expected current snapshot) tuples, filled by undo
         self._message = None
+        self._code_cache = CodeCache()  # compiled eval/exec strings, use the _eval() and _exec() methods
         self._locals = dict()
         self._exec_globals = dict()
+        # names from the builtins, math, imports and user functions layers of _exec_globals, a variable can't use them
+        self._reserved_names = set()
         self._math = math
         self._button_functions = dict() # a dict of all the pre-defined calculator 'button' functions, like sqrt, sin, .
         self._imported_libs = set() # a set of all imported libraries
         self._imported_functions = set() # a set of all imported functions
+        self._library_symbols = dict() # like {'linspace': ('np', 'np.linspace', <function>)} built on import
+        self._function_arity = dict() # like {<function>: (required, optional)} positional counts, see _arity()
         self._user_functions = dict() # a dict of all user defined functions like {'name': '<function def text>'}
+        self._user_function_param_writes = dict() # like {'name': {0}} user functions that write into a parameter
+        self._user_function_shims = weakref.WeakKeyDictionary() # like {<function>: elementwise wrapper or None}
+        self._pure_user_functions = set() # names of the user functions whose results are cached, see _MemoizedFunction
+        self._function_cache_length = 128 # results kept per pure user function
         self._all_functions = set() # a set of all possible functions that can be called including buttons and imports
         self._setting_invert_lists = True  # when using stack to list/array this flips the direction of the list
+        self._setting_exact_iterables = False  # when True prod, fsum, dist ... use the math library, not numpy
+        self._setting_elementwise_lists = False  # when True + - * / ... work per item on lists of numbers
+        self._setting_allow_code_execution = True  # when False typed text is only evaluated as plain math
+        self._setting_fused_threads = 1  # threads for the chunked evaluation of large array expressions
+        self._fused_pool = None  # the thread pool for the chunks, see setting_fused_threads()
+        self._record_history = True  # False while run_program() runs, no undo snapshots are taken
+        self._program_errors = 0  # tokens that reported an error in the last program run, see return_program_errors()
+        self._macro_tokens = None  # the tokens of the macro being recorded, see macro_record_start()
+        self._macros = dict()  # like {'name': [tokens]} the macros compiled into user functions
+        self._sandbox = None  # a Sandbox when typed code and user functions run in a child, see setting_sandbox()
+        self._definitions = dict()  # like {'name': source} the latest import or def per name, a sandbox child runs them
+        self._cancel_requested = threading.Event()  # set by cancel(), checked between tokens and chunks
+        self._evaluation_runner = None  # runs the long evaluations, see setting_evaluation_runner()
+        self._evaluating = False  # True while the runner runs an evaluation, the ones nested in it run directly
 
         # use the awesome math lib to grab some pre-defined math methods ....  mathods?
         math_lib_functions = dir(math)
@@ -155,7 +2070,15 @@ class Calculator:
                                     '*': lambda: self.stack_operation('*'),
                                     '/': lambda: self.stack_operation('/'),
                                     '**': lambda: self.stack_operation('**'),
-                                    '!': lambda: self.stack_function_press('factorial'),
+                                    '@': lambda: self.stack_operation('@'),
+                                    '//': lambda: self.stack_operation('//'),
+                                    '%': lambda: self.stack_operation('%'),
+                                    '&': lambda: self.stack_operation('&'),
+                                    '|': lambda: self.stack_operation('|'),
+                                    '^': lambda: self.stack_operation('^'),
+                                    '<<': lambda: self.stack_operation('<<'),
+                                    '>>': lambda: self.stack_operation('>>'),
+                                    '!': lambda: self.one_arg_function_press('factorial'),
                                     'x^2': lambda: self.raise_pow_2(),
                                     'x²': lambda: self.raise_pow_2(),
                                     'x^y': lambda: self.raise_pow_x(),
@@ -164,14 +2087,6 @@ class Calculator:
                                     'eˣ': lambda: self.raise_pow_e(),
                                     '√': lambda: self.stack_operation('sqrt'),
 
-                                    # constants
-                                    'pi': lambda: self._constant_press('3.14159265'),
-                                    'π': lambda: self._constant_press('3.14159265'),
-                                    'euler': lambda: self._constant_press('2.71828182'),
-                                    'ℇ': lambda: self._constant_press('2.71828182'),
-                                    'phi': lambda: self._constant_press('1.61803398'),
-                                    'jackpot': lambda: self._constant_press('777'),
-
                                     # stack operations
                                     'swap': lambda: self.swap_x_y(),
                                     'drop': lambda: self.clear_stack_level(0),
@@ -188,12 +2103,19 @@ class Calculator:
                                     'iterable_to_stack': lambda: self.iterable_to_stack(),
                                     'stack_to_list': lambda: self.stack_to_list(),
                                     'stack_to_array': lambda: self.stack_to_array(),
+                                    'stack_to_matrix': lambda: self.stack_to_matrix(),
                                     'roll_up': lambda: self.roll_up(),
                                     'roll_down': lambda: self.roll_down(),
                                     'enter': lambda: self.enter_press(),
                                     'clear': lambda: self.clear_stack_level(),
                                     'delete': lambda: self.delete_last_char(),
                                     'undo': lambda: self.undo_last_action(pop_last_history=True),
+                                    'redo': lambda: self.redo_last_undo(),
+                                    'history': lambda: self.history_info(),
+                                    'code_cache': lambda: self.code_cache_info(),
+                                    'function_cache': lambda: self.function_cache_info(),
+                                    'stack_map': lambda: self.stack_map(),
+                                    'stack_reduce': lambda: self.stack_reduce(),
 
                                     # wrappers for the math library that expose more natural language functions like ln
                                     'ln': lambda: self.natural_log(),
@@ -206,7 +2128,16 @@ class Calculator:
                                     'show_plot': lambda: self.show_plot(),
                                 }
 
-        self._button_functions = built_in_functions | one_args | two_args | iterable_args
+        # stack_sum, stack_prod, ... one for each of the stack wide reductions
+        built_in_functions |= {f'stack_{reduction}': lambda reduction=reduction: self.stack_reduce(reduction)
+                               for reduction in _STACK_REDUCTIONS}
+
+        # constants
+        constants = {item: lambda value=value: self._constant_press(value) for item, value in _CONSTANTS.items()}
+
+        self._button_functions = built_in_functions | constants | one_args | two_args | iterable_args
+        # like {'sin': 1, 'atan2': 2} the math library buttons, for _compile_macro()
+        self._math_function_arity = {item: 1 for item in one_arg_math_funcs} | {item: 2 for item in two_arg_math_funcs}
         self._all_functions = set(self._button_functions.keys()) | self._user_functions.keys()
 
         # add the math functions to the exec_globals so they can be used in eval and exec
@@ -215,6 +2146,7 @@ class Calculator:
         # py_operators = {str(op).replace('__', ''): getattr(operator, op) for op in dir(operator)}
         self._exec_globals.update(py_builtins)
         # self._exec_globals.update(py_operators)
+        self._reserved_names.update(math.__dict__, py_builtins, {'__builtins__'})
 
         # finally, load up numpy, and matplotlib because they are distributed with python and supercharge the calculator
         self.user_entry('import math as math')
@@ -235,16 +2167,62 @@ class Calculator:
         """
         self._message = None
         if pop_last_history:
-            _removed_A = self._stack_history.pop(-1)  # removes the 'undo'
-            _removed_B = self._stack_history.pop(-1)  # removes the 'enter'
+            _removed_A = self._stack_history.pop()  # removes the 'undo'
+            _removed_B = self._stack_history.pop()  # removes the 'enter'
         if len(self._stack_history) > 0:
-            self._stack = self._stack_history.pop(-1)
-            self._message = f"Undo: restored stack to previous state. History Length: '{len(self._stack_history)}'"
+            undone = self._stack.snapshot()
+            self._stack = CalcStack.from_snapshot(self._stack_history.pop())
+            # remember what was undone, redo is only valid as long as the stack is still the one we restored
+            self._stack_redo_history.append((undone, self._stack.snapshot()))
+            self._message = f"Undo: restored stack to previous state. {self._stack_history.footprint_message()}"
 
         else:
             self._message = f"Error: no history to undo"
         log(self._message)
-        log(f"STACK: {self._stack}")
+        log(f"STACK: '{len(self._stack)}' levels, top: {list(islice(self._stack, 3))}")  # not the whole stack, O(1)
+
+    def redo_last_undo(self):
+        """ re-applies the last undo. Redo is available until the stack is changed by something other than undo or
+        redo, snapshots are shared nodes so checking for that is a pointer comparison, not a compare of the stacks """
+        self._message = None
+        current = self._stack.snapshot()
+
+        # typing 'redo' and pressing enter saves a history entry with 'redo' on X before the name is popped, drop it
+        if len(self._stack_history) > 0:
+            last = self._stack_history[-1]
+            if last.is_push_of(current) and str(last.front.value).strip() == 'redo':
+                self._stack_history.pop()
+
+        if len(self._stack_redo_history) > 0 and self._stack_redo_history[-1][1] is current:
+            redo_snapshot, _expected = self._stack_redo_history.pop(-1)
+            self._update_stack_history()
+            self._stack = CalcStack.from_snapshot(redo_snapshot)
+            self._message = f"Redo: restored stack to undone state. {self._stack_history.footprint_message()}"
+        else:
+            self._stack_redo_history.clear()  # the stack changed since the last undo, the redo entries are stale
+            self._message = f"Error: nothing to redo"
+        log(self._message)
+
+    def history_info(self):
+        """ puts the undo history length and approximate memory footprint in the message field """
+        self._message = f"History: {self._stack_history.footprint_message()}"
+        log(self._message)
+
+    def code_cache_info(self):
+        """ puts the compiled code cache size and hit rate in the message field """
+        self._message = self._code_cache.stats_message()
+        log(self._message)
+
+    def function_cache_info(self):
+        """ puts the result cache stats of the pure user functions in the message field """
+        stats = self.return_function_cache_stats()
+        self._message = ', '.join(stats.values()) if len(stats) > 0 else "Function Cache: no pure user functions"
+        log(self._message)
+
+    def return_function_cache_stats(self) -> dict:
+        """ returns the cache stats of the pure user functions like {'name': 'Function Cache 'name': ... Hits ...'} """
+        return {name: function.stats_message() for name, function in self._exec_globals.items()
+                if name in self._pure_user_functions and isinstance(function, _MemoizedFunction)}
 
     """ -------------------------------- Math Wrapper Functions -------------------------------- """
 
@@ -524,9 +2502,9 @@ class Calculator:
 
                     if self._last_stack_operation == 'enter' and len(self._stack) > 1:
                         # in this case you might have a duplicate in X and Y so replace X instead of shifting up
-                        if self._stack[0] == self._stack[1]:
+                        if _same_entry(self._stack[0], self._stack[1]):
                             if user_input in self._button_functions and user_input != 'e':  # watch out for Euler:
-                                self._button_functions[user_input]()
+                                self._press_button(user_input)
                                 return  # ----------------------------------------------------------------------------->
                             else:
                                 self.stack_put(user_input, shift_up=False)
@@ -534,7 +2512,7 @@ class Calculator:
                                 return  # ----------------------------------------------------------------------------->
 
                     if user_input in self._button_functions and user_input != 'e':  # watch out for Euler:
-                        self._button_functions[user_input]()
+                        self._press_button(user_input)
                         return  # ------------------------------------------------------------------------------------->
                     else:
                         self.stack_put(user_input)
@@ -552,7 +2530,7 @@ class Calculator:
                     break
             else:
                 if user_input in self._button_functions and user_input != 'e': # watch out for Euler:
-                    self._button_functions[user_input]()
+                    self._press_button(user_input)
                     return # ------------------------------------------------------------------------------------->
 
             # if not in the function dict, its a string entry
@@ -578,80 +2556,266 @@ class Calculator:
         # if not a string, then put it on the stack whatever it is and feel the power of dynamic typing
         else:
             # log(f"User Entry: not a string: {user_input}")
+            if self._macro_tokens is not None:
+                self._record_macro(user_input)
             self.stack_put(user_input)
 
         # do some housekeeping for the calc object
         self._last_stack_operation = 'user_entry'
         # self._print_stack()   # for debugging
 
+    def run_program(self, tokens, clear_stack: bool = False, stack: list = None, quiet: bool = True) -> list:
+        """ runs a stream of RPN tokens without the UI, each token is handled like the UI hands it to user_entry()
+        and the token 'enter' presses enter, like: ['3', 'enter', '4', '*']. The undo history is turned off while the
+        program runs, the message field reports the throughput and any error from the tokens, the number of tokens
+        that reported an error is kept for return_program_errors().
+        @param tokens: an iterable of tokens or the program text, see program_tokens()
+        @param clear_stack: if True start from an empty stack, variables and functions are kept
+        @param stack: if given start from these values instead, X first
+        @param quiet: if True nothing is logged on this thread while the program runs, other threads still log
+        @return: the final stack as a list, X first """
+        if isinstance(tokens, str):
+            tokens = program_tokens(tokens)
+        if clear_stack or stack is not None:
+            self._stack = CalcStack(stack)
+            self._last_stack_operation = None
+        count = 0
+        errors = 0
+        first_error = None
+        saved_quiet = getattr(_log_state, 'quiet', False)
+        saved_record_history = self._record_history  # a nested run must not turn the history back on
+        _log_state.quiet = quiet or saved_quiet
+        self._record_history = False
+        start = time.perf_counter()
+        try:
+            for token in tokens:
+                self._check_cancelled()
+                count += 1
+                if token == 'enter':
+                    self.enter_press()
+                else:
+                    self.user_entry(token)
+                if self._message is not None and self._message.startswith('Error'):
+                    errors += 1
+                    if first_error is None:
+                        first_error = f"token {count} '{token}': {self._message}"
+        finally:
+            seconds = time.perf_counter() - start
+            _log_state.quiet = saved_quiet
+            self._record_history = saved_record_history
+            self._program_errors = errors
+        rate = count / seconds if seconds > 0 else 0.0
+        self._message = f"Program: '{count}' tokens in '{seconds * 1000:0.3f}' ms, '{rate:,.0f}' tokens/s"
+        if errors > 0:
+            self._message += f", '{errors}' error(s), first: {first_error}"
+        return list(self._stack)
+
+    def run_program_on_csv(self, tokens, input_path: str, output_path: str, columns: list = None, levels: int = 1,
+                           header: bool = False, delimiter: str = ',', chunk_rows: int = 65_536,
+                           fmt: str = '%.17g') -> int:
+        """ runs an RPN program on every row of a numeric CSV file. The file is read chunk_rows rows at a time, each
+        selected column is pushed as a numpy array (the last column ends up in X) and the program runs once per
+        chunk, so the per token overhead is paid per chunk and not per row. The top stack levels are appended to the
+        output CSV, X in the first column. Memory is bounded by the chunk size, not the file size.
+        @param tokens: an iterable of tokens or the program text, see program_tokens()
+        @param input_path: the CSV file to read
+        @param output_path: the CSV file to write, one row per input row
+        @param columns: the column indexes (or header names) to push, None for all columns
+        @param levels: number of stack levels written per row
+        @param header: if True the first line of the input holds the column names
+        @param delimiter: the column separator
+        @param chunk_rows: rows per chunk
+        @param fmt: the number format of the output, the default reads back to the same float
+        @return: the number of rows written, on failure an error message is stored to the message field and
+                 return_program_errors() is more than 0 """
+        if isinstance(tokens, str):
+            tokens = program_tokens(tokens)
+        rows = 0
+        self._program_errors = 0
+        start = time.perf_counter()
+        with open(input_path, 'r', newline='') as source, open(output_path, 'w', newline='') as target:
+            if header:
+                names = [name.strip() for name in source.readline().rstrip('\r\n').split(delimiter)]
+                if columns is not None:
+                    try:
+                        columns = [names.index(column) if isinstance(column, str) else column for column in columns]
+                    except ValueError as ex:
+                        self._program_errors += 1
+                        self._message = f"Error: CSV column not found: {ex}"
+                        log(self._message)
+                        return rows  # -------------------------------------------------------------------------------->
+                target.write(delimiter.join('XYZ'[level] if level < 3 else f'level_{level}'
+                                            for level in range(levels)) + '\n')
+            while True:
+                self._check_cancelled()  # the rows written so far stay in the output
+                lines = list(islice(source, chunk_rows))
+                if not lines:
+                    break
+                try:
+                    data = np.loadtxt(lines, delimiter=delimiter, usecols=columns, ndmin=2)
+                except ValueError as ex:
+                    self._program_errors += 1
+                    self._message = f"Error: CSV rows {rows + 1} to {rows + len(lines)}: {ex}"
+                    log(self._message)
+                    return rows  # ------------------------------------------------------------------------------------>
+                if len(data) == 0:  # only blank lines
+                    continue
+                stack = self.run_program(tokens, stack=[_freeze(column) for column in data.T[::-1]])
+                if self._program_errors > 0:
+                    self._message = f"Error: CSV rows {rows + 1} to {rows + len(data)}: {self._message}"
+                    log(self._message)
+                    return rows  # ------------------------------------------------------------------------------------>
+                if len(stack) < levels:
+                    self._program_errors += 1
+                    self._message = f"Error: CSV program left '{len(stack)}' stack level(s), '{levels}' are needed"
+                    log(self._message)
+                    return rows  # ------------------------------------------------------------------------------------>
+                try:
+                    result = np.column_stack([np.broadcast_to(np.asarray(value, dtype=float), (len(data),))
+                                              for value in stack[:levels]])
+                except (ValueError, TypeError) as ex:
+                    self._program_errors += 1
+                    self._message = f"Error: CSV program result is not one number per row: {ex}"
+                    log(self._message)
+                    return rows  # ------------------------------------------------------------------------------------>
+                np.savetxt(target, result, fmt=fmt, delimiter=delimiter)
+                rows += len(data)
+        seconds = time.perf_counter() - start
+        rate = rows / seconds if seconds > 0 else 0.0
+        self._message = f"CSV: '{rows}' rows in '{seconds:0.3f}' s, '{rate:,.0f}' rows/s"
+        log(self._message)
+        return rows
+
+    def _press_button(self, name: str):
+        """ calls a button function, records it first when a macro is being recorded. What the button does itself
+        is part of the button, it is not recorded """
+        if self._macro_tokens is None:
+            self._button_functions[name]()
+            return  # ------------------------------------------------------------------------------------------------->
+        self._record_macro(name)
+        tokens, self._macro_tokens = self._macro_tokens, None
+        try:
+            self._button_functions[name]()
+        finally:
+            self._macro_tokens = tokens
+
+    def _record_macro(self, token=None):
+        """ adds a token to the macro being recorded. Text typed into X is recorded when it is used (by the token)
+        and not per key press, so editing it with delete is not recorded
+        @param token: the button name, 'enter' or a value put on the stack, None to only record the typed text """
+        if len(self._stack) > 0 and isinstance(self._stack[0], str) and self._last_stack_operation == 'user_entry':
+            typed = self._stack[0]
+            self._macro_tokens.append(typed)
+            self._last_stack_operation = 'recorded'  # the typed text is not recorded twice
+            if token == 'enter' and typed in self._button_functions and typed != 'e':
+                # enter calls the button named in X, the button token alone does the same
+                return  # --------------------------------------------------------------------------------------------->
+        if token is not None:
+            self._macro_tokens.append(token)
+
+    def macro_record_start(self):
+        """ starts recording a macro, the typed entries, buttons and enter presses are recorded until
+        macro_record_stop() """
+        self._macro_tokens = []
+        self._message = 'Recording macro, stop the recording to compile it into a function'
+        log(self._message)
+
+    def macro_record_stop(self, name: str = None) -> list:
+        """ stops recording a macro and compiles it into a user function if a name is given, see compile_macro()
+        @param name: the function name or None to only return the tokens
+        @return: the recorded tokens, they can be run with run_program() """
+        if self._macro_tokens is None:
+            self._message = "Error: no macro is being recorded"
+            log(self._message)
+            return []  # ---------------------------------------------------------------------------------------------->
+        self._record_macro()
+        tokens, self._macro_tokens = self._macro_tokens, None
+        self._message = f"Recorded macro: {' '.join(str(token) for token in tokens)}"
+        log(self._message)
+        if name is not None:
+            self.compile_macro(name, tokens)
+        return tokens
+
+    def compile_macro(self, name: str, tokens):
+        """ compiles the tokens of a macro into one python function and adds it as a user function, so it gets a
+        button and can be saved like the other user functions. The compiled function runs the whole macro as one code
+        object without messages or undo snapshots and works on arrays with the numpy ufuncs. The stack levels the
+        macro reads become the arguments, X first, see _compile_macro()
+        @param name: the function name
+        @param tokens: the recorded tokens or the program text, see program_tokens() """
+        if isinstance(tokens, str):
+            tokens = program_tokens(tokens)
+        tokens = list(tokens)
+        try:
+            functions = dict()  # like {'name': 2} the user functions and the stack values they take
+            for function in self._user_functions:
+                arity = self._arity(self._exec_globals.get(function))
+                if arity is not None:
+                    functions[function] = arity[0]
+            function_string = _compile_macro(name, tokens, self._math_function_arity, set(self._button_functions),
+                                             functions, set(self._locals))
+        except ValueError as ex:
+            self._message = f"Error: cant compile macro: '{name}' with error: '{ex}'"
+            log(self._message)
+            raise Exception(self._message)
+        self.add_user_function(function_string)
+        self._macros[name] = tokens
+        self._message = f"Compiled macro: '{name}' from '{len(tokens)}' tokens"
+        log(self._message)
+
     def one_arg_function_press(self, function):
         """ uses the math library to perform a function on the stack value and put the result back on the stack.
-        These functions require one argument, so the stack must have at least one value on it in Y """
+        These functions require one argument, so the stack must have at least one value on it in Y.
+        Numbers use the math library (exact int semantics, like factorial), numpy arrays and lists / tuples / sets of
+        numbers use the matching numpy ufunc (see _NUMPY_ONE_ARG) so the whole array is done in one C loop """
         self._message = None
         if len(self._stack) > 0:
             x = self._stack.pop(0)
             try:
-                x = self._convert_to_best_numeric(x)
-                result = getattr(self._math, function)(x)
-                self.stack_put(result)
-                self._message = f"Function: {function}({x}) = {result}"
-
-            except Exception as ex:
-                # check if object is iterable
-                try:
-                    _iterable = iter(x)
-                    # need to write a methoid that handles iterables in a good way
-
-                    if isinstance(x, list|tuple|set):
-                        result = []
-
+                if isinstance(x, np.ndarray | np.generic):
+                    result = _NUMPY_ONE_ARG[function](x)
+                elif isinstance(x, list | tuple | set):
+                    array = _as_numeric_array(x) if function not in _INT_RESULT_ONE_ARG else None
+                    if array is not None:
+                        result = _like_container(_NUMPY_ONE_ARG[function](array), x)
+                    else:
                         # apply the function for each item in the list
-                        for item in x:
-                            result.append(getattr(self._math, function)(item))
-
-                        # set the result to the correct type
-                        if isinstance(x, tuple):
-                            result = tuple(result)
-                        elif isinstance(x, set):
-                            result = set(result)
-                        else:
-                            pass  # return a list
-
-                    elif isinstance(x, np.ndarray):
-                        try:
-                            result = getattr(x, f'np.{function}')() # function like 'sin'
-                            print(result)
-                        except Exception as ex:
-                            result = ex
-                            print(ex)
-
-                    # end method returns result
-
-                    # result = getattr(self._math, function)(x)
-                    self.stack_put(result)
-                    self._message = f"Function: {function}({x}) = {result}"
-
-                except TypeError as ex: # it's not iterable and it's not a number so put it back on the stack
-
-                    self.stack_put(x)
-                    self._message = f"Error: cannot perform function: '{function}' on non-number: '{x}' with error: '{ex}'"
-                    log(self._message)
-                    raise Exception(self._message)
+                        result = [getattr(self._math, function)(item) for item in x]
+                        if isinstance(x, tuple | set):  # set the result to the correct type
+                            result = type(x)(result)
+                else:
+                    x = self._convert_to_best_numeric(x)
+                    result = getattr(self._math, function)(x)
+            except Exception as ex:
+                self.stack_put(x)
+                self._message = f"Error: cannot perform function: '{function}' on: '{x}' with error: '{ex}'"
+                log(self._message)
+                raise Exception(self._message)
+            self.stack_put(result)
+            self._message = f"Function: {function}({x}) = {result}"
         else:
-            self._message = f"Error: not enough values on the stack to perform the operation: '{self._stack[0]}'"
+            self._message = f"Error: not enough values on the stack to perform the operation: '{function}'"
 
         log(self._message)
 
     def two_arg_function_press(self, function):
         """ uses the math library to perform a function on the stack value and put the result back on the stack.
-        These functions require two arguments, so the stack must have at least two values on it in Y and Z """
+        These functions require two arguments, so the stack must have at least two values on it in Y and Z.
+        If X or Y is a numpy array, list or tuple the matching numpy ufunc is used (see _NUMPY_TWO_ARG) with full
+        broadcasting, like hypot(I, Q) for arrays of I and Q. A list or tuple result keeps the container type """
         self._message = None
         if len(self._stack) > 1:
             x = self._stack.pop(0)
             y = self._stack.pop(0)
+            vectorized = isinstance(x, np.ndarray | np.generic | list | tuple) or \
+                         isinstance(y, np.ndarray | np.generic | list | tuple)
             try:
-                x = self._convert_to_best_numeric(x)
-                y = self._convert_to_best_numeric(y)
+                if vectorized:
+                    x_arg = self._two_arg_operand(x)
+                    y_arg = self._two_arg_operand(y)
+                else:
+                    x = self._convert_to_best_numeric(x)
+                    y = self._convert_to_best_numeric(y)
             except ValueError:
                 self.stack_put(y)
                 self.stack_put(x)
@@ -660,7 +2824,12 @@ class Calculator:
                 raise Exception(self._message)
             else:
                 try:
-                    result = getattr(math, function)(y, x)
+                    if vectorized:
+                        result = _NUMPY_TWO_ARG[function](y_arg, x_arg)
+                        if not isinstance(x, np.ndarray | np.generic) and not isinstance(y, np.ndarray | np.generic):
+                            result = _like_container(np.asarray(result), y if isinstance(y, list | tuple) else x)
+                    else:
+                        result = getattr(math, function)(y, x)
                 except Exception as ex:
                     self.stack_put(y)
                     self.stack_put(x)
@@ -674,23 +2843,58 @@ class Calculator:
             self._message = f"Error: not enough values on the stack to perform an operation: '{function}'"
             log(self._message)
 
+    def _two_arg_operand(self, value):
+        """ returns an operand for a numpy two arg function, arrays are used as is, lists and tuples must hold only
+        numbers and anything else must convert to a number
+        @raise ValueError: if the value is not numeric """
+        if isinstance(value, np.ndarray | np.generic):
+            return value
+        if isinstance(value, list | tuple):
+            array = _as_numeric_array(value)
+            if array is None:
+                raise ValueError(f"Cannot convert '{value}' to an array of numbers")
+            return array
+        return self._convert_to_best_numeric(value)
+
     def iterable_function_press(self, function):
-        """ uses the math library to perform a function on the stack value and put the result back on the stack"""
+        """ uses the math library to perform a function on the stack value and put the result back on the stack.
+        If X is a numpy array, list, tuple or set the function runs on the whole iterable, arrays and lists of numbers
+        use numpy reductions (pairwise sum for fsum, np.linalg.norm for dist, ...), the exact iterables setting uses
+        the math library instead when bit exact results are needed. dist and sumprod use the iterables in Y and X """
         self._message = None
-        if len(self._stack) > 0:
-            x = self._stack.pop(0)
+        needed = 2 if function in _TWO_ITERABLE_FUNCS else 1
+        if len(self._stack) >= needed:
+            popped = [self._stack.pop(0) for arg in range(needed)]  # like [x] or [x, y]
+            x = popped[0]
             try:
-                x = self._convert_to_best_numeric(x)
+                if isinstance(x, np.ndarray | list | tuple | set):
+                    result = self._iterable_function(function, *popped)
+                else:
+                    # typed numbers are strings, like '16' for isqrt
+                    args = [value if isinstance(value, np.ndarray | list | tuple | set) else
+                            self._convert_to_best_numeric(value) for value in popped]
+                    x = args[0]
+                    if function in _ONE_ITEM_ITERABLE_FUNCS:
+                        args = [args]
             except ValueError:
-                self.stack_put(x)
+                for arg in reversed(popped):
+                    self.stack_put(arg)
                 self._message = f"Error: cannot perform function: '{function}' on non-number: '{x}'"
                 log(self._message)
                 raise Exception(self._message)
+            except Exception as ex:
+                for arg in reversed(popped):
+                    self.stack_put(arg)
+                self._message = f"Error: function: '{function}' failed with: '{ex}'"
+                log(self._message)
+                raise Exception(self._message)
             else:
                 try:
-                    result = getattr(math, function)(x)
+                    if not isinstance(x, np.ndarray | list | tuple | set):
+                        result = getattr(math, function)(*args[::-1])
                 except Exception as ex:
-                    self.stack_put(x)
+                    for arg in reversed(popped):
+                        self.stack_put(arg)
                     self._message = f"Error: function: '{function}' failed with: '{ex}'"
                     log(self._message)
                     raise Exception(self._message)
@@ -701,6 +2905,27 @@ class Calculator:
             self._message = f"Error: not enough values on the stack to perform an operation: '{function}'"
             log(self._message)
 
+    def _iterable_function(self, function: str, x, y=None):
+        """ runs an iterable math function on X (and Y for dist and sumprod), see iterable_function_press() """
+        if self._setting_exact_iterables is False:
+            x_array = x if isinstance(x, np.ndarray) else _as_numeric_array(x)
+            y_array = None
+            if y is not None:
+                y_array = y if isinstance(y, np.ndarray) else _as_numeric_array(y)
+            if x_array is not None and (y is None or y_array is not None):
+                result = _array_iterable_function(function, x_array, y_array)
+                if isinstance(x, list | tuple | set):
+                    if isinstance(result, np.ndarray):  # isqrt keeps the container type
+                        return _like_container(result, x)
+                    if isinstance(result, np.generic):
+                        return result.item()  # a python number for a python list
+                return result
+        if isinstance(x, np.ndarray):
+            x = x.ravel().tolist()
+        if isinstance(y, np.ndarray):
+            y = y.ravel().tolist()
+        return _exact_iterable_function(function, x, y)
+
     def roll_up(self):
         """ rolls the stack by popping the last value and inserting it a X"""
         self._message = None
@@ -800,7 +3025,7 @@ class Calculator:
         """
         # self._update_stack_history() # if changing the stack save the state first, um this captures every keypress
         if shift_up:
-            self._stack = self._stack[:position] + [value] + self._stack[position:]
+            self._stack.insert(position, value)
         else:
             if len(self._stack) == 0 and position ==0:
                 self._stack.append(value)
@@ -813,269 +3038,362 @@ class Calculator:
                 log(self._message)
 
     def enter_press(self):
-        """ do something reasonable when the user presses enter. Returns on first success or fatal error """
+        """ do something reasonable when the user presses enter. X is classified once (see _classify_entry()) and the
+        matching handler is called directly, so the time to handle enter does not depend on how many other handlers
+        would have failed first. Returns on first success or fatal error """
+        if self._macro_tokens is not None:
+            self._record_macro('enter')
         self._update_stack_history()
         self._message = None
 
         if len(self._stack) > 0:  # else do nothing
+            kind, payload = self._classify_x()
 
             # .........................................
             #   Handle recalling a local variable
             # .........................................
             # if the only thing in X is a local variable name, then recall the value of that variable to X
-            x_ref = self._stack[0]
-            if isinstance(x_ref, str): # its python so keys can be anything, but if it's a string, strip it
-                x_ref = x_ref.strip()
-
-                if x_ref in self._locals:
-                    self._stack.pop(0) # clear the name from the stack
-                    self.stack_put(self._locals[x_ref])
-                    self._last_stack_operation = 'recall'
-                    return # ------------------------------------------------------------------------------------------>
+            if kind == 'name' and payload in self._locals:
+                self._stack.pop(0) # clear the name from the stack
+                self.stack_put(self._locals[payload])
+                self._last_stack_operation = 'recall'
+                return # ---------------------------------------------------------------------------------------------->
 
             # .........................................
             #   Handle variable assignment
             # .........................................
-            # if an '=' char is found in X then it is most likely an assignment
-            if self._last_stack_operation != 'assignment':  # you have to press enter after an assignment
-
-                if isinstance(self._stack[0], str):
-                    if '=' in self._stack[0]:
-                        x_temp = self._stack.pop(0)
-                        try:
-
-                            assignment_list = x_temp.split('=')  # like ['a', '1']
-                            # we want something like ['a', '1'], not  ['a', ''] for this case
-                            if assignment_list[1] != '':
-                                var_key = assignment_list[0].strip()
-                                var_value = assignment_list[1].strip()
-
-                                # if the var_value can be a number, then convert it, else it can be anything else
-                                try:
-                                    var_value = self._convert_to_best_numeric(var_value)
-                                except Exception as ex:
-                                    pass # this is the case that var_value is NOT a number, but that is ok
-
-                            # if 'a=' is on the stack @X, and Y is anything (except empty),
-                            # then assign Y to the name in X
-                            elif len(self._stack) > 0:
-                                # check the stack and assign Y to the name in X
-                                # we popped X so now grab what is in position 0
-                                var_key = assignment_list[0].strip()
-                                var_value = self._stack.pop(0)
-
-                            else:  # nothing in Y so just assign the name to None
-                                var_key = assignment_list[0].strip()
-                                var_value = None
-
-                            illegal_namespace = set(self._locals) ^ set(self._exec_globals)
-
-                            if var_key in illegal_namespace:
-                                self._message = f"Error: cant assign variable to built in: '{var_key}'"
-                                self.stack_put(var_value)
-                                self.stack_put(var_key)
-                                self._last_stack_operation = 'error'
-                                log(self._message)
-                                return # ------------------------------------------------------------------------------>
-                            self._locals.update({var_key: var_value})
-                            # exec adds a __builtins__ to the locals so keep a clean copy of locals and an _exec_globals
-                            # for passing to exec, if you want you can modify globals here
-                            for key, value in self._locals.items():
-                                self._exec_globals.update({key: value})
-                            self.stack_put(var_value)
-                            self._message = f"Assignment: {var_key} = {var_value}"
-                            self._last_stack_operation = 'assignment'
-                            log(self._message)
-                            return  # --------------------------------------------------------------------------------->
-
-                        except Exception as ex:
-                            self._message = f"Error: assignment '{x_temp}' failed with: {ex}"
-                            self.stack_put(x_temp)
-                            log(self._message)
+            # like 'a = 1' or 'a=' with the value in Y
+            if kind == 'assignment':
+                if self._last_stack_operation != 'assignment':  # you have to press enter after an assignment
+                    self._assign_x(*payload)
+                    return # ------------------------------------------------------------------------------------------>
+                kind = 'code'
 
             # .........................................
             # handle pushing X to Y
             # .........................................
             # if the only thing in X is a number, then duplicate the number in X into X so that X is in both X and Y
-            try:
-                x = self._stack.pop(0)
-                number = self._convert_to_best_numeric(x)  # this will raise an exception if x is not a number
-                self.stack_put(number, shift_up=True)
+            if kind == 'number':
+                self._stack.pop(0)
+                self.stack_put(payload, shift_up=True)
                 self._duplicate_x_value_in_y_position()
                 return # ---------------------------------------------------------------------------------------------->
-            except Exception as ex:
-                self._message = f"Error in enter_press: roll up: {ex}"
-                self.stack_put(x)
 
             # .........................................
             #   Handle function calls
             # .........................................
-            x_str = str(self._stack[0])
-            if x_str in self._all_functions:
-                # since the math library has poor support for signature inspect,
-                # we have to handle the functions explicitly
-                if x_str in self._button_functions:
-                    # at this point X is like 'sin' or 'cos' so pop the name and call the button function
-                    function = self._stack.pop(0) # the button functions expect the argument in X not the name
-                    try:
-                        self._button_functions[function]()
-                        return  # ------------------------------------------------------------------------------------->
-                    except Exception as ex:
-                        self._message = f"Error in enter_press: function: '{function}' failed with: {ex}"
-                        self.stack_put(function)
-
-                # it failed to exe the button try the imported functions this is the case for something like 'sin'
-                # it is a button but also in the imported methods for numpy
-
-                # at this point X is like 'sin' or 'cos' so pop the name and call the math function
-                function = self._stack.pop(0) # the math functions expect the argument in X not the name
-
-                args=[]
-                if x_str in self._user_functions:
-                    try:
-                        sig = inspect.signature(eval(function, self._exec_globals))  # like: <Signature (x, y, z=3)>
-
-                        # not sure how to handle the signatures with kwargs in this context since we are pulling
-                        # off the stack. What to do? Should we pull more values off the stack to fill the
-                        # kwargs positionally?
-                        # that sounds like a very bad idea, lets just ignore the kwargs, if the user needs to call with
-                        # kwargs they must enter the entire function like: 'function(x, y, z=3)' into X
-                        sig_str = str(sig)
-                        sig_list = sig_str.split(',')
-                        required_params = [p.replace('(', '') for p in sig_list if '=' not in p]
-                        required_args_count = len(required_params)
-                        if len(self._stack) < required_args_count:
-                            self._message = (f"Error: not enough values on the stack to "
-                                             f"perform the operation: '{function}'")
-                            self.stack_put(function)
-                            return  # -------------------------------------------------------------------------------->
-                        args = [self._stack.pop(0) for arg in range(required_args_count)]
-                        args = tuple(args)
-
-                        result = eval(x_str, self._exec_globals, )(*args)
-                        self._message = f"Evaluated: {x_str}{args} to {result}"
-                        self.stack_put(result)
-                        self._last_stack_operation = 'function'
-                        log(self._message)
-                        return  # ----------------------------------------------------------------------------->
-                    except Exception as ex:
-                        pass  # try the next lib
+            if kind == 'name' and payload in self._all_functions:
+                if self._call_function_at_x(payload) is True:
+                    return # ------------------------------------------------------------------------------------------>
 
-                # Y = self._stack.pop(0)
-                for lib in self._imported_libs:
-                    keys = dir(eval(lib))
-                    if x_str in keys:
-                        try:
-                            exc_str = f'{lib}.{x_str}'
-                            sig = inspect.signature(eval(exc_str, self._exec_globals))  # like: <Signature (x, y, z=3)>
-                            sig_str = str(sig)
-                            sig_list = sig_str.split(',')
-                            required_params = [p.replace('(', '') for p in sig_list if '=' not in p]
-                            required_args_count = len(required_params)
-                            if len(self._stack) < required_args_count:
-                                self._message = (f"Error: not enough values on the stack to "
-                                                 f"perform the operation: '{function}'")
-                                self.stack_put(function)
-                                return  # ----------------------------------------------------------------------------->
-                            args = [self._stack.pop(0) for arg in range(required_args_count)]
-                            args = tuple(args)
-                            result = eval(exc_str, self._exec_globals, )(args)
-                            self._message = f"Evaluated: {exc_str}{args} to {result}"
-                            self.stack_put(result)
-                            self._last_stack_operation = 'function'
-                            log(self._message)
-                            return  # --------------------------------------------------------------------------------->
-                        except Exception as ex:
-                            pass # try the next lib
-                # no dice, restore the stack
-                for arg in args:
-                    self.stack_put(arg)
-                self.stack_put(function)
+            # .........................................
+            #   Handle imports
+            # .........................................
+            if kind == 'import':
+                self._import_x()
+                log(self._message)
+                return # ---------------------------------------------------------------------------------------------->
 
             # .........................................
             #   Handle eval and exec
             # .........................................
-            # if you made it this far with no success, try x=eval(x) and failing that exe(x), this is the last try
-            x_temp = self._stack.pop(0)
+            # if you made it this far, try x=eval(x) and failing that exec(x), this is the last try
+            self._eval_or_exec_x()
+            log(self._message)
 
-            # first try eval --------------------------
-            try:
-                result = eval(x_temp, self._exec_globals) # this works on input like 'np.arrange(10)'
-                self._message = f"Evaluated: {x_temp} to {result}"
-                result_type = type(result)
-                result_type_str = str(result_type)
-
-                good = {"<class 'type'>", "<class 'builtin_function_or_method'>", "<class 'function'>"}
-                if result_type_str in good:
-                    # in this case the user probably wants to apply the builtin functon to Y
-                    Y = self._stack.pop(0)
-                    try:
-                        result = eval(x_temp, self._exec_globals)(Y)  # this works on input like 'np.arrange(Y)'
-                        self._message = f"Evaluated: {x_temp}({Y}) to {result}"
-                    except Exception as ex:
-                        self._message = f"Error in enter_press: eval: '{x_temp}({Y})' with exceptions ex: {ex}"
-                        self.stack_put(Y)
+    def _classify_x(self) -> tuple:
+        """ returns the (kind, payload) of the value in X, see _classify_entry(). Numbers that are not strings are
+        ('number', X), anything else that is not a string is ('value', X) and goes to eval like any other code """
+        x = self._stack[0]
+        if isinstance(x, str):
+            return _classify_entry(x)
+        if isinstance(x, int | float | complex):
+            return 'number', x
+        return 'value', x
+
+    def _assign_x(self, var_key: str, var_value: str):
+        """ handles an assignment in X like 'a = 1', if the value text is empty Y gets assigned to the name
+        @param var_key: the name to assign to
+        @param var_value: the text to the right of the '=', like '1' """
+        x_temp = self._stack.pop(0)
+        try:
+            if var_value != '':
+                # if the var_value can be a number, then convert it, else it can be anything else
+                try:
+                    var_value = self._convert_to_best_numeric(var_value)
+                except Exception as ex:
+                    pass # this is the case that var_value is NOT a number, but that is ok
+
+            # if 'a=' is on the stack @X, and Y is anything (except empty),
+            # then assign Y to the name in X
+            elif len(self._stack) > 0:
+                # check the stack and assign Y to the name in X
+                # we popped X so now grab what is in position 0
+                var_value = self._stack.pop(0)
+
+            else:  # nothing in Y so just assign the name to None
+                var_value = None
+
+            if var_key in self._reserved_names:
+                self._message = f"Error: cant assign variable to built in: '{var_key}'"
+                self.stack_put(var_value)
+                self.stack_put(var_key)
+                self._last_stack_operation = 'error'
+                log(self._message)
+                return # ---------------------------------------------------------------------------------------------->
+            self._set_local(var_key, var_value)
+            self.stack_put(var_value)
+            self._message = f"Assignment: {var_key} = {var_value}"
+            self._last_stack_operation = 'assignment'
 
-                self._last_stack_operation = 'eval'
-                self.stack_put(result)
+        except Exception as ex:
+            self._message = f"Error: assignment '{x_temp}' failed with: {ex}"
+            self.stack_put(x_temp)
+        log(self._message)
 
-            # next try exec --------------------------
+    def _set_local(self, key: str, value):
+        """ stores a user variable. The locals are the top layer of the namespace, exec adds a __builtins__ to the
+        dict it is given so the locals are kept clean and _exec_globals (exec needs a real dict for its globals, not
+        a chained mapping) gets the same one key, assigning a variable never touches the other names """
+        value = _freeze(value)
+        self._locals[key] = value
+        self._exec_globals[key] = value
+        self._forget_in_sandbox([key])
+
+    def _call_function_at_x(self, x_str: str) -> bool:
+        """ calls the function named in X with its arguments from the stack
+        @param x_str: the function name, like 'sin' or a user function name
+        @return: True if the entry was handled (this includes errors that were reported), False to fall back to eval
+        """
+        # since the math library has poor support for signature inspect,
+        # we have to handle the functions explicitly
+        if x_str in self._button_functions:
+            # at this point X is like 'sin' or 'cos' so pop the name and call the button function
+            function = self._stack.pop(0) # the button functions expect the argument in X not the name
+            try:
+                self._button_functions[function]()
+                return True  # ---------------------------------------------------------------------------------------->
             except Exception as ex:
+                self._message = f"Error in enter_press: function: '{function}' failed with: {ex}"
+                self.stack_put(function)
 
-                if 'import' not in str(x_temp):
-                    try:
-                        exec(x_temp, self._exec_globals)  # this works on input like 'import os' with no return value
-                        self._last_stack_operation = 'exec'
-                        self._message = f"Executed: {x_temp}"
-                    except Exception as ey:
-                        self._message = f"Error in enter_press: exec: '{x_temp}' with exceptions ex: {ex}: ey: {ey}"
-                        self.stack_put(x_temp)
-                        # todo: set a flag to dup X on enter error, this is a string that cant be parsed ..
-                        # but maybe the user wants to use it as a string
-                        self._last_stack_operation = 'error'
-
-                # ------- Handle Imports -------
-                else: # import is in X, like 'import os', 'from os import path', or 'import numpy as np'
-                    try:
-                        # figure out what was imported and track all imported functions and libraries
-                        imported_name = None
-                        imported_lib = None
-                        imported_list = x_temp.split(' ')
-                        if len(imported_list) == 2:                 # like 'import os'
-                            imported_lib = imported_list[1]
-                        elif len(imported_list) == 4:
-                            if imported_list[3].strip() == '*':  # like 'from os import *'
-                                imported_lib = imported_list[1]
-                            elif imported_list[2].strip() == 'as':    # like 'import numpy as np'
-                                imported_lib = imported_list[3]
-                            else:                                  # like 'from os import path' single import
-                                imported_name = imported_list[3]
-
-                        if imported_lib is not None:
-                            exec(f'{x}', self._exec_globals)  # do the actual import
-                            self._message = f"Imported lib: '{imported_lib}'"
-
-                        if imported_name is not None:
-                            if imported_name not in self._exec_globals:
-                                exec(f'{x}', self._exec_globals)  # do the actual import
-                                self._all_functions.add(imported_lib)
-                                self._message = f"Imported name: '{imported_name}'"
-                            else:
-                                self._message = f"Warning: '{imported_name}' already in namespace, did not import."
-                    except Exception as ex:
-                        self._message = f"Error in enter_press: import: '{x_temp}' with exceptions ex: {ex}"
-                        self.stack_put(x_temp)
-                        self._last_stack_operation = 'error'
+        # it failed to exe the button try the imported functions this is the case for something like 'sin'
+        # it is a button but also in the imported methods for numpy
 
-                    # # print all the imported functions
-                    # print(f'--------------------------------------------------------------')
-                    # print(f"Imported functions count: {len(self._all_functions)}")
-                    # for func in self._all_functions:
-                    #     print(func)
-                    # print(f'--------------------------------------------------------------')
+        # at this point X is like 'sin' or 'cos' so pop the name and call the math function
+        function = self._stack.pop(0) # the math functions expect the argument in X not the name
 
+        if x_str in self._user_functions:
+            user_function = self._exec_globals.get(x_str)
+            try:
+                self._allowed_function(user_function)  # like stack map, user functions are code
+            except PermissionError as ex:
+                self._message = f"Error: '{x_str}' can't be called from the stack: {ex}"
+                self.stack_put(function)
+                log(self._message)
+                return True  # ---------------------------------------------------------------------------------------->
+            param_writes = self._user_function_param_writes.get(x_str, ())
+            if self._call_with_stack_args(function, user_function, x_str, param_writes, vectorize=True) is True:
+                return True  # ---------------------------------------------------------------------------------------->
+
+        # library functions, like 'geomspace' after 'from numpy import geomspace', one lookup in the symbol index
+        symbol = self._library_symbols.get(x_str)
+        if symbol is not None:
+            _lib, exc_str, library_function = symbol
+            if self._setting_allow_code_execution is False and not _is_arithmetic_function(library_function):
+                pass  # falls back to eval, which reports that the function can't be called
+            elif self._call_with_stack_args(function, library_function, exc_str) is True:
+                return True  # ---------------------------------------------------------------------------------------->
+
+        # no dice, restore the stack
+        self.stack_put(function)
+        return False
+
+    def _call_with_stack_args(self, name: str, function, label: str, param_writes=(), vectorize=False) -> bool:
+        """ calls function with its required positional arguments popped off the stack, X is the first argument. The
+        kwargs are ignored, pulling more values off the stack to fill them positionally sounds like a very bad idea,
+        if the user needs to call with kwargs they must enter the entire function like: 'function(x, y, z=3)' into X
+        @param name: the name that was on X, it is put back if there are not enough values on the stack
+        @param function: the function to call
+        @param label: the name for the message, like 'np.linspace'
+        @param param_writes: the argument indexes the function writes into, those arrays get a private copy
+        @param vectorize: True for user functions, a scalar only function gets an elementwise wrapper for arrays. With
+                          a sandbox the user function runs in the child, which does the elementwise calls itself
+        @return: True if the call was handled (this includes reporting too few arguments), False if the function
+                 can't be called this way or raised, the stack is unchanged in that case """
+        arity = self._arity(function)
+        if arity is None:
+            return False
+        required_args_count = arity[0]
+        if len(self._stack) < required_args_count:
+            self._message = f"Error: not enough values on the stack to perform the operation: '{name}'"
+            self.stack_put(name)
+            return True
+        popped = [self._stack.pop(0) for arg in range(required_args_count)]
+        args = list(popped)
+        # stack arrays are read only, give the function a private copy if it writes into the argument
+        for idx in param_writes:
+            if idx < len(args) and isinstance(args[idx], np.ndarray) and not args[idx].flags.writeable:
+                args[idx] = args[idx].copy()
+        args = tuple(args)
+        reads = function  # a function that plots has to run on the caller's thread, see _run_evaluation()
+        if vectorize is True and self._sandbox is not None:
+            variables = self._sandbox.variables_for(self._code_cache.compile(name, 'eval'), self._exec_globals)
+            function = lambda *arguments: self._sandbox.call(name, arguments, variables)
+            reads = None
+        elif vectorize is True and any(isinstance(arg, np.ndarray) and arg.ndim > 0 for arg in args):
+            function = self._array_version(function, args)
+        try:
+            result = self._run_evaluation(lambda: function(*args), reads)
+        except SandboxError as ex:  # the child hit a limit, report it rather than trying the name some other way
+            for arg in reversed(popped):
+                self.stack_put(arg)
+            self._message = f"Error: '{label}' failed in the sandbox: {ex}"
+            self.stack_put(name)
+            return True
+        except Exception as ex:
+            for arg in reversed(popped):
+                self.stack_put(arg)
+            return False
+        self._message = f"Evaluated: {label}{args} to {result}"
+        self.stack_put(result)
+        self._last_stack_operation = 'function'
+        log(self._message)
+        return True
+
+    def _array_version(self, function, args: tuple):
+        """ returns the user function to call with array arguments, the function itself if it handles arrays or an
+        elementwise wrapper (see _elementwise_shim). The probe runs on the first call with an array, the result is
+        kept until the function is re-defined or removed. A pure function keeps caching the whole array call """
+        memoized = function if isinstance(function, _MemoizedFunction) else None
+        if memoized is not None:
+            function = memoized.function  # probe the function itself, the cache is kept for the whole array call
+        try:
+            shim = self._user_function_shims[function]
+        except KeyError:
+            shim = self._user_function_shims[function] = _elementwise_shim(function, args)
+        if memoized is not None:
+            return memoized if shim is None else lambda *arguments: memoized.call(shim, arguments)
+        return function if shim is None else shim
+
+    def _arity(self, function) -> tuple | None:
+        """ returns the (required, optional) positional parameter counts of a function, see _positional_arity(). The
+        counts are cached by function identity, the cache is filled when functions are added or imported so calling
+        a function from the stack normally does no introspection """
+        try:
+            return self._function_arity[function]
+        except KeyError:
+            arity = self._function_arity[function] = _positional_arity(function)
+            return arity
+        except TypeError:  # not hashable
+            return _positional_arity(function)
+
+    def _import_x(self):
+        """ handles an import in X like 'import os', 'from os import path', or 'import numpy as np' """
+        x_temp = self._stack.pop(0)
+        try:
+            # figure out what was imported and track all imported functions and libraries
+            imported_name = None
+            imported_lib = None
+            imported_list = x_temp.split(' ')
+            if len(imported_list) == 2:                 # like 'import os'
+                imported_lib = imported_list[1]
+            elif len(imported_list) == 4:
+                if imported_list[3].strip() == '*':  # like 'from os import *'
+                    imported_lib = imported_list[1]
+                elif imported_list[2].strip() == 'as':    # like 'import numpy as np'
+                    imported_lib = imported_list[3]
+                else:                                  # like 'from os import path' single import
+                    imported_name = imported_list[3]
+
+            if imported_lib is not None:
+                self._exec(x_temp)  # do the actual import
+                self._definitions[x_temp] = x_temp  # the sandbox child imports it too
+                if imported_list[3:4] != ['*']:  # a star import binds the names directly, there is nothing to index
+                    self._index_library(imported_lib)
+                    self._reserved_names.add(imported_lib.split('.')[0])  # 'import os.path' binds 'os'
+                else:
+                    module = sys.modules[imported_lib]
+                    self._reserved_names.update(getattr(module, '__all__', None) or
+                                                [name for name in vars(module) if not name.startswith('_')])
+                self._imported_libs.add(imported_lib)
+                self._message = f"Imported lib: '{imported_lib}'"
+
+            if imported_name is not None:
+                if imported_name not in self._exec_globals:
+                    self._exec(x_temp)  # do the actual import
+                    self._definitions[x_temp] = x_temp
+                    imported = self._exec_globals[imported_name]
+                    if callable(imported):
+                        self._library_symbols[imported_name] = (imported_list[1], imported_name, imported)
+                        self._arity(imported)
+                    self._all_functions.add(imported_name)
+                    self._reserved_names.add(imported_name)
+                    self._message = f"Imported name: '{imported_name}'"
+                else:
+                    self._message = f"Warning: '{imported_name}' already in namespace, did not import."
+        except Exception as ex:
+            self._message = f"Error in enter_press: import: '{x_temp}' with exceptions ex: {ex}"
+            self.stack_put(x_temp)
+            self._last_stack_operation = 'error'
+
+    def _index_library(self, lib: str):
+        """ adds the public functions of an imported library to the symbol index so a calculator function name on X
+        finds its library function with one dict lookup instead of a dir() scan of every library. Only the names in
+        _all_functions are called this way, see enter_press(). Importing the same library again rebuilds its entries, a
+        name that is already indexed for an other library keeps pointing at that library (first import wins)
+        @param lib: the name the library is bound to in the namespace, like 'np' """
+        module = self._eval(lib)
+        self._library_symbols = {name: symbol for name, symbol in self._library_symbols.items() if symbol[0] != lib}
+        for name, value in vars(module).items():
+            if not name.startswith('_') and callable(value) and not isinstance(value, types.ModuleType):
+                self._library_symbols.setdefault(name, (lib, f"{lib}.{name}", value))
+                self._arity(value)
+
+    def _eval_or_exec_x(self):
+        """ evaluates the code in X and puts the result on the stack, if it is not an expression it is executed """
+        x_temp = self._stack.pop(0)
+        thawed = self._thaw_arrays_written_by(x_temp)
 
-            log(self._message)
+        # first try eval --------------------------
+        try:
+            result = self._eval(x_temp, sandboxed=True) # this works on input like 'np.arrange(10)'
+            self._message = f"Evaluated: {x_temp} to {result}"
+            result_type = type(result)
+            result_type_str = str(result_type)
+
+            good = {"<class 'type'>", "<class 'builtin_function_or_method'>", "<class 'function'>"}
+            if result_type_str in good:
+                # in this case the user probably wants to apply the builtin functon to Y
+                Y = self._stack.pop(0)
+                try:
+                    result = self._allowed_function(self._eval(x_temp))(Y)  # like 'np.arrange(Y)'
+                    self._message = f"Evaluated: {x_temp}({Y}) to {result}"
+                except Exception as ex:
+                    self._message = f"Error in enter_press: eval: '{x_temp}({Y})' with exceptions ex: {ex}"
+                    self.stack_put(Y)
+
+            self._last_stack_operation = 'eval'
+            self.stack_put(result)
+
+        # next try exec --------------------------
+        except SandboxError as ex:  # the child was killed, running the code as a statement would hit the limit again
+            self._message = f"Error in enter_press: eval: '{x_temp}' with exception: {ex}"
+            self.stack_put(x_temp)
+            self._last_stack_operation = 'error'
+        except Exception as ex:
+            try:
+                self._exec(x_temp, sandboxed=True)  # this works on input like 'for i in range(3): print(i)'
+                self._last_stack_operation = 'exec'
+                self._message = f"Executed: {x_temp}"
+            except Exception as ey:
+                self._message = f"Error in enter_press: exec: '{x_temp}' with exceptions ex: {ex}: ey: {ey}"
+                self.stack_put(x_temp)
+                # todo: set a flag to dup X on enter error, this is a string that cant be parsed ..
+                # but maybe the user wants to use it as a string
+                self._last_stack_operation = 'error'
+
+        self._refreeze_thawed(thawed)
 
     def _duplicate_x_value_in_y_position(self):
         """ duplicates the value in X to Y """
@@ -1108,16 +3426,16 @@ class Calculator:
                 x = x_hold
                 y = y_hold
                 if isinstance(x_hold, str):
-                    x = eval(x_hold, self._exec_globals)
+                    x = self._eval(x_hold)
                     if isinstance(x, str):
                         # sometimes when you eval a local var it returns a string, but it should probably be a number in
                         # this context
-                        x = eval(x, self._exec_globals)
+                        x = self._eval(x)
                 if isinstance(y_hold, str):
-                    y = eval(y_hold, self._exec_globals)
+                    y = self._eval(y_hold)
                     # see note above for X about this second eval
                     if isinstance(y, str):
-                        y = eval(y, self._exec_globals)
+                        y = self._eval(y)
 
             except Exception as ex:
                 # self._message = f"Function: '+' exception '{ex}' for input x: '{x_hold}' and y: '{y_hold}'"
@@ -1131,19 +3449,15 @@ class Calculator:
 
             else:
                 try:
-                    if operation == '+':
-                        result = y + x
-                    elif operation == '-':
-                        result = y - x
-                    elif operation == '*':
-                        result = y * x
-                    elif operation == '/':
-                        if x != 0:
-                            result = y / x
-                        else:
-                            result = float('inf')
-                    elif operation == '**':
-                        result = y ** x
+                    if self._setting_elementwise_lists is True:
+                        # numeric lists and tuples become arrays so + and * work per item, not concatenate / repeat
+                        x = self._elementwise_operand(x)
+                        y = self._elementwise_operand(y)
+                    if operation == '/' and isinstance(x, int | float) and isinstance(y, int | float) and x == 0:
+                        # the divide by zero check is for scalars only, numpy arrays give inf / nan per item
+                        result = float('inf')
+                    elif operation in _STACK_OPERATIONS:
+                        result = _STACK_OPERATIONS[operation](y, x)
                     else:
                         self._message = f"Warning in stack operation: unknown operation: '{operation}'"
                         result = None
@@ -1173,6 +3487,119 @@ class Calculator:
 
         log(self._message)
 
+    def stack_map(self):
+        """ applies the function named in X (like 'sqrt' or a user function name) to every other level of the stack in
+        one pass. If the levels are all numbers and the function has a numpy version (see _NUMPY_ONE_ARG) the whole
+        stack is done in one C loop, else the function is called once per level. ceil, floor and trunc use the math
+        library so numbers stay python ints, like one_arg_function_press. The map is one undo step """
+        self._message = None
+        if len(self._stack) < 2:
+            self._message = f"Error: stack map needs a function name in X and values in Y and up"
+            log(self._message)
+            return # ---------------------------------------------------------------------------------------------->
+        name = self._stack[0]
+        levels = _typed_levels(self._stack[1:])
+        try:
+            function = self._stack_function(name)
+            numbers = _numeric_levels(levels) if function in _NUMPY_ONE_ARG.values() else None
+            if isinstance(name, str) and name.strip() in _INT_RESULT_ONE_ARG:
+                numbers = None  # math returns python ints for numbers, like one_arg_function_press
+                function = self._int_result_function(name.strip())
+            result = function(numbers) if numbers is not None else None
+            if isinstance(result, np.ndarray):
+                results = result.tolist()
+            else:  # like frexp that returns a tuple of arrays, or levels that are not all numbers
+                results = [function(level) for level in levels]
+        except Exception as ex:
+            self._message = f"Error: stack map: '{name}' failed with: '{ex}'"
+            log(self._message)
+            return # ---------------------------------------------------------------------------------------------->
+        self._update_stack_history()
+        self._stack = CalcStack(results)
+        self._message = f"Stack map: {name} on {len(results)} levels"
+        log(self._message)
+
+    def stack_reduce(self, reduction=None):
+        """ reduces all the levels of the stack to one result in one pass.
+        @param reduction: 'sum', 'prod', 'mean', 'min' or 'max' (see _STACK_REDUCTIONS), these are numpy reductions
+                          when the levels are all numbers (exact python ints for sum and prod of ints) and pairwise
+                          for anything else (like a stack of arrays). If None the function named in X is used: a function of one argument gets
+                          all the levels (an array if they are all numbers), a function of two is applied pairwise
+                          from X up, like f(f(X, Y), Z) """
+        self._message = None
+        if reduction is None:
+            if len(self._stack) < 2:
+                self._message = f"Error: stack reduce needs a function name in X and values in Y and up"
+                log(self._message)
+                return # ------------------------------------------------------------------------------------------>
+            reduction = self._stack[0]
+            levels = _typed_levels(self._stack[1:])
+        else:
+            levels = _typed_levels(self._stack)
+        if len(levels) == 0:
+            self._message = f"Error: not enough values on the stack to perform the operation: '{reduction}'"
+            log(self._message)
+            return # ---------------------------------------------------------------------------------------------->
+
+        try:
+            numbers = _numeric_levels(levels)
+            if reduction in _STACK_REDUCTIONS:
+                numpy_reduction, levels_reduction = _STACK_REDUCTIONS[reduction]
+                if numbers is not None and numbers.dtype == np.int64 and reduction in ('sum', 'prod'):
+                    result = sum(levels) if reduction == 'sum' else math.prod(levels)  # exact, no int64 overflow
+                elif numbers is not None:
+                    result = numpy_reduction(numbers).item()
+                else:
+                    result = levels_reduction(levels)
+            else:
+                function = self._stack_function(reduction)
+                arity = self._arity(function)
+                if arity is not None and arity[0] == 1:
+                    result = function(numbers if numbers is not None else levels)
+                else:
+                    result = reduce(function, levels)
+        except Exception as ex:
+            self._message = f"Error: stack reduce: '{reduction}' failed with: '{ex}'"
+            log(self._message)
+            return # ---------------------------------------------------------------------------------------------->
+        self._update_stack_history()
+        self._stack = CalcStack([result])
+        self._message = f"Stack reduce: {reduction} of {len(levels)} levels = {result}"
+        log(self._message)
+
+    def _stack_function(self, name):
+        """ returns the function for stack map and stack reduce, a one arg math name (like 'sqrt') gets the numpy
+        version, any other name is looked up in the namespace (user functions, np.cumsum, ...)
+        @raise TypeError: if the name is not a callable """
+        if callable(name):
+            return name
+        name = name.strip()
+        if name in _NUMPY_ONE_ARG:
+            return _NUMPY_ONE_ARG[name]
+        function = self._eval(name)
+        if not callable(function):
+            raise TypeError(f"'{name}' is not a function")
+        return self._allowed_function(function)
+
+    def _int_result_function(self, name):
+        """ returns a function for the names in _INT_RESULT_ONE_ARG (ceil, floor, trunc) that uses the math library
+        for numbers, so they stay python ints, and numpy for arrays """
+        def int_result(value):
+            if isinstance(value, np.ndarray | np.generic):
+                return _NUMPY_ONE_ARG[name](value)
+            return getattr(self._math, name)(value)
+        return int_result
+
+    @staticmethod
+    def _elementwise_operand(value):
+        """ returns a list or tuple of numbers as an array (np.asarray, no copy if it already is one), anything else
+        is returned as is """
+        if isinstance(value, list | tuple):
+            array = _as_numeric_array(value)
+            if array is not None:
+                return array
+        return value
+
     def stack_to_list(self):
         """ converts all items on the stack into a list where X is at list position 0, Y is at list position 1, etc ...
          and puts the list back on the stack at X. Of note, this is python so the list can contain multiple types
@@ -1186,76 +3613,60 @@ class Calculator:
             except ValueError:
                 self.stack_put(x)
             self._message = None
-            stack_hold = self._stack    # surprise! it's already a list : )
+            stack_hold = self._stack
             self.clear_stack()
             if self._setting_invert_lists is True:
                 r_stack = list(reversed(stack_hold))
             else:
-                r_stack = stack_hold
+                r_stack = list(stack_hold)
             self.stack_put(r_stack)
             self._message = f"Stack to list: {r_stack}"
 
     def stack_to_array(self):
         """ converts all items on the stack into a numpy array where X is at array position 0,
         Y is at array position 1, etc ... and puts the array back on the stack at X.
-        Since this is an array, unlike a python list, all items must
-        be of the same type, either all strings or all numbers.
+        Since this is an array, unlike a python list, all items must be of the same kind.
 
-        Note: the data type of X will be used first to set the dtype for the array, if that fails then float is used,
-        if float fails the native data typs is used, for example if X is a list of strings, the array will be an
-        array of lists of strings (like [['1', '2', '3'], ['4', '5', '6']]) """
+        Note: the dtype is picked in one pass over the stack, numbers and numeric strings give an int, float or complex
+        array, arrays or lists of the same shape give an array with one more dimension (see stack_to_matrix) and
+        anything else gives an array of strings """
         if len(self._stack) > 0:
-            self._update_stack_history()
             self._message = None
+            levels = list(self._stack)
+            if self._setting_invert_lists is True:
+                levels.reverse()
             try:
-                number = self._convert_to_best_numeric(self._stack[0])
+                array = _levels_to_array(levels)
             except ValueError as ex:
-                pass  # whatever is at X, is not a number but that is ok
+                self._message = f"Error in stack to array, check for homogeneity in the stack: '{ex}'"
+                log(self._message)
+                return  # --------------------------------------------------------------------------------------------->
 
-            stack_hold = self._stack
-            r_stack = stack_hold
-            if self._setting_invert_lists is True:
-                r_stack = list(reversed(stack_hold))
+            self._update_stack_history()
+            self.clear_stack()
+            self.stack_put(array)
+            self._message = f"Stack to array: {array}"
 
-            # look at X data type, we will try to use that as the dtype for the array
-            dtype = type(self._stack[0])
-            if dtype == str: # since this is a calculator, prefer numbers to strings for arrays
-                try:
-                    num = self._convert_to_best_numeric(self._stack[0])
-                except ValueError:
-                    dtype = str
-                else:
-                    dtype = type(num)
+    def stack_to_matrix(self):
+        """ stacks the arrays (or lists or tuples) on the stack into one array with a new first axis, same length 1D
+        levels become the rows of a 2D matrix. The row order follows stack_to_array, the levels must all have the
+        same shape and be numeric """
+        if len(self._stack) > 0:
+            self._message = None
+            levels = list(self._stack)
+            if self._setting_invert_lists is True:
+                levels.reverse()
             try:
-                array = np.array(reversed, dtype=dtype)
-            except Exception as ex:
-
-                try: # try an int
-                    int_list = [int(x) for x in r_stack]
-                    array = np.array(int_list, dtype=int)
-
-                except Exception as ei:
-
-                    try: # try a float
-                        float_list = [float(x) for x in r_stack]
-                        array = np.array(float_list, dtype=float)
-                    except Exception as ef:
-
-                        try: # try a string
-                            string_list = [str(x) for x in r_stack]
-                            array = np.array(string_list, dtype=str)
-                        except Exception as es:
-                            self._message = (f"Error in stack to array, cant convert data type: '{dtype}', to array. "
-                                             f"check for homogeneity in the stack: '{[type(x) for x in r_stack]}'"
-                                             f"errors: '{ex}', '{ei}', '{ef}', '{es}'")
-                            # restore the stack
-                            self._stack = stack_hold
-                            log(self._message)
-                            return # ---------------------------------------------------------------------------------->
+                matrix = _levels_to_matrix(levels)
+            except ValueError as ex:
+                self._message = f"Error in stack to matrix: '{ex}'"
+                log(self._message)
+                return  # --------------------------------------------------------------------------------------------->
 
+            self._update_stack_history()
             self.clear_stack()
-            self.stack_put(array)
-            self._message = f"Stack to array: {array}"
+            self.stack_put(matrix)
+            self._message = f"Stack to matrix: shape {matrix.shape}"
 
     def iterable_to_stack(self):
         """ tries to map an iterable object at X to the stack so [1, 2] would map to x = 1 and y = 2.
@@ -1271,8 +3682,7 @@ class Calculator:
             x_hold = self._stack.pop(0)
             if self._setting_invert_lists is False:
                 x_hold = list(reversed(x_hold))
-            for item in x_hold:
-                self.stack_put(item)
+            self._stack.extend_top(x_hold)  # one pass, the last item ends up at X
             self._message = f"Iterable to stack: {x_hold}"
 
     def return_locals(self):
@@ -1286,6 +3696,7 @@ class Calculator:
         if key in self._locals:
             val = self._locals.pop(key)
             self._exec_globals.pop(key, None)
+            self._forget_in_sandbox([key])
             self._message = f"Removed local variable: {key}={val}"
         else:
             self._message = f"Error: cant remove local item: '{key}'"
@@ -1296,7 +3707,7 @@ class Calculator:
         self._update_stack_history()
         self._message = 'Clear Stack'
         log(self._message)
-        self._stack = []
+        self._stack = CalcStack()
 
     def clear_user_functions(self, function_name=None):
         """ removes the user functions from the namespace and the user functions set, if function_name is None
@@ -1308,7 +3719,15 @@ class Calculator:
         for func in to_remove:
             try:
                 self._user_functions.pop(func, None)
-                self._exec_globals.pop(func, None)
+                self._user_function_param_writes.pop(func, None)
+                self._reserved_names.discard(func)
+                self._pure_user_functions.discard(func)
+                self._macros.pop(func, None)
+                removed = self._exec_globals.pop(func, None)
+                self._function_arity.pop(removed, None)
+                if removed is not None:
+                    self._user_function_shims.pop(removed, None)
+                    self._definitions.pop(func, None)  # the sandbox child deletes it too
                 del func
             except Exception as ex:
                 self._message = f"Error: cant remove function: '{func}' with error: '{ex}'"
@@ -1322,9 +3741,12 @@ class Calculator:
         """
         self._message = None
         if clear_first:
+            for key in self._locals.keys():
+                self._exec_globals.pop(key, None)
+            self._forget_in_sandbox(self._locals)
             self._locals = dict()
-        self._locals.update(new_locals)
-        self._exec_globals.update(new_locals)
+        for key, value in new_locals.items():
+            self._set_local(key, value)
 
     def delete_last_char(self):
         """ deletes the last char entry on the stack """
@@ -1366,6 +3788,7 @@ class Calculator:
         log(f"Clear All Variables")
         for key in self._locals.keys():
             self._exec_globals.pop(key, None)
+        self._forget_in_sandbox(self._locals)
         self._locals = dict()
 
     def return_stack_for_display(self, index=None):
@@ -1373,10 +3796,13 @@ class Calculator:
          @param index: if None return the whole stack, if an integer return the stack item at that index or None
          @return: a string copy of the stack or the stack item at the index"""
         if index is None:
-            return copy(self._stack)
+            return list(self._stack)
         else:
             if index < len(self._stack):
-                return copy(self._stack[index])
+                value = self._stack[index]
+                if isinstance(value, np.ndarray):
+                    return value  # stack arrays are read only, no need to copy them for display
+                return copy(value)
             else:
                 return None
 
@@ -1384,6 +3810,11 @@ class Calculator:
         """ returns a set of all the user defined functions """
         return copy(self._user_functions)
 
+    @staticmethod
+    def return_stack_reductions() -> list:
+        """ returns the names of the stack wide reductions, like ['sum', 'prod', ...], for the right click menu """
+        return list(_STACK_REDUCTIONS)
+
     def return_buttons_for_display(self):
         """ returns a list all the buttons (functions, methods, operations, constants) known to the calculator """
         keys = list(self._button_functions.keys())
@@ -1393,6 +3824,32 @@ class Calculator:
         """ returns a dict of all the user defined functions """
         return self._user_functions
 
+    def stack_snapshot(self):
+        """ returns an immutable snapshot of the stack, this is a pointer grab, see restore_stack_snapshot() """
+        return self._stack.snapshot()
+
+    def restore_stack_snapshot(self, snapshot, message: str = None):
+        """ puts the stack back to a snapshot from stack_snapshot(), like after a cancelled operation
+        @param snapshot: the snapshot
+        @param message: the message for the message field """
+        self._stack = CalcStack.from_snapshot(snapshot)
+        self._last_stack_operation = None
+        self._message = message
+        if message is not None:
+            log(message)
+
+    def return_macros(self) -> dict:
+        """ returns the macros that were compiled into user functions like {'name': [tokens]} """
+        return self._macros
+
+    def is_recording_macro(self) -> bool:
+        """ returns True while a macro is being recorded """
+        return self._macro_tokens is not None
+
+    def return_pure_user_functions(self) -> set:
+        """ returns the names of the user functions whose results are cached """
+        return copy(self._pure_user_functions)
+
     def return_all_functions(self) -> dict:
         """ returns a dict of all functions known to the calculator. This is dynamic and will include
         all imports and user defined functions """
@@ -1402,14 +3859,21 @@ class Calculator:
         """ returns the message string """
         return self._message
 
+    def return_program_errors(self) -> int:
+        """ returns the number of tokens that reported an error in the last run_program(), for run_program_on_csv()
+        a file or result error counts too, 0 means the run succeeded """
+        return self._program_errors
+
     def _update_stack_history(self):
-        """ this method is used to update the stack history list to prevent memory runaway, copies the current stack
-        to the stack history list and pops the oldest stack if the list is longer than 100 (default) items """
-        if len(self._stack_history) > self._stack_history_length:
-            removed = self._stack_history.pop(0)
-            # log(f"Stack history limit of {self._stack_history_length} achieved.")
-            # log(f"Removed oldest stack from stack history: {removed}")
-        self._stack_history.append(self._stack.copy())
+        """ this method is used to update the stack history to prevent memory runaway, saves a snapshot of the
+        current stack to the stack history and evicts the oldest snapshots if the history is longer than 100 (default)
+        items or holds more than the memory budget. The stack is persistent so a snapshot is a pointer to the top node,
+        not a copy of the stack """
+        if not self._record_history:
+            return  # ------------------------------------------------------------------------------------------------->
+        evicted = self._stack_history.append(self._stack.snapshot())
+        if evicted > 0 and len(self._stack_history) < self._stack_history_length:  # evicted for the memory budget
+            log(f"Stack history: evicted {evicted} snapshot(s), {self._stack_history.footprint_message()}")
 
     def _constant_press(self, constant):
         """ puts a constant on the stack. This method is bound to the buttons dictionary for 'pi', 'euler', 'phi', etc
@@ -1453,27 +3917,268 @@ class Calculator:
         else:
             raise ValueError(f"Error: convert to best numeric, unknown type for x: '{x}'")
 
-    def add_user_function(self, function_string: str):
+    def add_user_function(self, function_string: str, pure: bool = None):
         """ adds a user defined function to the calculator object
-        @param function_string: the function string to add to the calculator object """
+        @param function_string: the function string to add to the calculator object
+        @param pure: True if the result only depends on the arguments, the results are then cached (see
+                     _MemoizedFunction), None keeps the setting the function had. Re-defining a function always
+                     starts with an empty cache """
         self._message = None
         try:
+            self._check_code_execution()
             exec(function_string, self._exec_globals)
             # get the name of the function
             function_name = function_string.split(' ')[1].split('(')[0]
+            function = self._exec_globals[function_name]
+            if pure is True:
+                self._pure_user_functions.add(function_name)
+            elif pure is False:
+                self._pure_user_functions.discard(function_name)
+            if function_name in self._pure_user_functions:
+                function = self._exec_globals[function_name] = _MemoizedFunction(function, self._function_cache_length)
+            self._function_arity[function] = _positional_arity(function)  # read the signature once, here
             self._user_functions.update({function_name: function_string})
             self._all_functions.add(function_name)
+            self._reserved_names.add(function_name)
+            self._user_function_param_writes.pop(function_name, None)
+            self._user_function_param_writes.update(_parameter_writes(function_string))
+            self._definitions.pop(function_name, None)  # only the latest def is replayed, after the ones it may use
+            self._definitions[function_name] = function_string
             self._message = f"Added user function: {function_string}"
         except Exception as ex:
             self._message = f"Error: adding user function: '{function_string}' with error: '{ex}'"
             log(self._message)
             raise Exception(self._message)
 
+    def set_user_function_pure(self, function_name: str, pure=True):
+        """ marks a user function as pure (its results are cached) or not, the function is re-defined from its text so
+        it starts with an empty cache
+        @param function_name: the name of the user function
+        @param pure: True to cache the results, False to call the function every time """
+        if function_name not in self._user_functions:
+            self._message = f"Error: no user function named: '{function_name}'"
+            log(self._message)
+            return  # ------------------------------------------------------------------------------------------------->
+        self.add_user_function(self._user_functions[function_name], pure=pure)
+        self._message = f"User function '{function_name}' results {'are' if pure else 'are not'} cached"
+
+    def _eval(self, source, sandboxed=False):
+        """ evaluates source in the calculator namespace. Plain math goes through the arithmetic evaluator (see
+        _compile_arithmetic), anything else through eval() with the compiled code cache, non string input goes
+        straight to eval() so the errors are the same as before
+        @param sandboxed: True for the code the user typed, it runs in the sandbox child if there is one
+        @raise PermissionError: if code execution is turned off and source is not plain math
+        @raise SandboxError: if the sandbox child hit a limit, it is restarted """
+        if isinstance(source, str):
+            if sandboxed is True and self._sandbox is not None and not _is_dotted_name(source):
+                return self._run_sandboxed(source, 'eval')  # --------------------------------------------------------->
+            try:
+                evaluate, plan = self._code_cache.compile(source, 'arithmetic')
+                if plan is not None:  # elementwise math, run it in chunks if the operands are large arrays
+                    run = lambda: plan.run(self._exec_globals, self._fused_pool, self._setting_fused_threads,
+                                           self._check_cancelled)
+                    large = any(isinstance(value, np.ndarray) and value.size >= _FUSED_MIN_SIZE
+                                for value in map(self._exec_globals.get, plan.names))
+                    result = self._run_evaluation(run) if large else run()
+                    if result is not None:
+                        return result  # ------------------------------------------------------------------------------>
+                return evaluate(self._exec_globals)  # raises _NotArithmetic for a call of a function that is not math
+            except _NotArithmetic as ex:
+                if self._setting_allow_code_execution is False:
+                    raise PermissionError(f"code execution is turned off, only plain math is evaluated: {ex}")
+            except SyntaxError:
+                pass  # let eval() raise it, or find that it is a statement for exec()
+            code = self._code_cache.compile(source, 'eval')
+            return self._run_evaluation(lambda: eval(code, self._exec_globals), code)
+        self._check_code_execution()
+        return self._run_evaluation(lambda: eval(source, self._exec_globals), source)
+
+    def _exec(self, source, sandboxed=False):
+        """ executes source in the calculator namespace using the compiled code cache
+        @param sandboxed: True for the code the user typed, it runs in the sandbox child if there is one
+        @raise PermissionError: if code execution is turned off
+        @raise SandboxError: if the sandbox child hit a limit, it is restarted """
+        self._check_code_execution()
+        if sandboxed is True and self._sandbox is not None and isinstance(source, str):
+            self._run_sandboxed(source, 'exec')
+        else:
+            code = self._code_cache.compile(source, 'exec') if isinstance(source, str) else source
+            self._run_evaluation(lambda: exec(code, self._exec_globals), code)
+
+    def _run_sandboxed(self, source: str, mode: str):
+        """ runs the eval or exec of source in the sandbox child, the values of the names it reads (and the names the
+        user functions it calls read) are sent along. The names an exec binds are copied back into the namespace. The
+        arrays the child gets are read only, like the stack values
+        @raise PermissionError: if code execution is turned off and source is not plain math """
+        if self._setting_allow_code_execution is False:
+            try:
+                self._code_cache.compile(source, 'arithmetic')
+            except _NotArithmetic as ex:
+                raise PermissionError(f"code execution is turned off, only plain math is evaluated: {ex}")
+        code = self._code_cache.compile(source, mode)  # a syntax error is raised here, without a round trip
+        variables = self._sandbox.variables_for(code, self._exec_globals)
+        if mode == 'eval':
+            return self._run_evaluation(lambda: self._sandbox.eval(source, variables))  # ----------------------------->
+        self._exec_globals.update(self._run_evaluation(lambda: self._sandbox.exec(source, variables)))
+
+    def _run_evaluation(self, work, reads=None):
+        """ runs work, the eval, exec or function call of an action, with the evaluation runner (see
+        setting_evaluation_runner()). The evaluations nested in one and the ones that read a gui library (like a
+        typed 'plt.show()') run directly on the caller's thread
+        @param work: a callable with no arguments
+        @param reads: the code object or the function that work runs, None if it can't touch a gui (like the sandbox)
+        @return: what work returned """
+        if self._evaluation_runner is None or self._evaluating or _reads_gui(reads, self._exec_globals):
+            return work()  # ------------------------------------------------------------------------------------------>
+        self._evaluating = True
+        try:
+            return self._evaluation_runner(work)
+        finally:
+            self._evaluating = False
+
+    def cancel(self, requested: bool = True):
+        """ asks the running action to stop, this can be called from any thread. It is cooperative so the calculator
+        state stays whole: a program stops before its next token, a CSV run before its next chunk and a large array
+        expression before its next chunk, with OperationCancelled. An evaluation in the sandbox is stopped by killing
+        the child. Other code runs to its end, turn on the sandbox (see setting_sandbox()) to be able to stop it
+        @param requested: False takes the request back, a new BackgroundJob does this before it starts """
+        if not requested:
+            self._cancel_requested.clear()
+            return  # ------------------------------------------------------------------------------------------------->
+        self._cancel_requested.set()
+        if self._sandbox is not None:
+            self._sandbox.cancel()
+
+    def _check_cancelled(self):
+        """ called between tokens and chunks, where the calculator state is whole
+        @raise OperationCancelled: if cancel() was called """
+        if self._cancel_requested.is_set():
+            self._cancel_requested.clear()
+            raise OperationCancelled("the operation was cancelled")
+
+    def _check_code_execution(self):
+        """ @raise PermissionError: if code execution is turned off """
+        if self._setting_allow_code_execution is False:
+            raise PermissionError("code execution is turned off, see setting_allow_code_execution()")
+
+    def _allowed_function(self, function):
+        """ returns function if it may be called with values from the stack, with code execution turned off only the
+        math functions can be (see _is_arithmetic_function)
+        @raise PermissionError: if code execution is turned off and function is not a math function """
+        if self._setting_allow_code_execution is False and not _is_arithmetic_function(function):
+            raise PermissionError(f"code execution is turned off, '{function}' is not a math function")
+        return function
+
+    def _thaw_arrays_written_by(self, code) -> set:
+        """ copy on write for the eval/exec paths: arrays on the stack, in the locals and in the undo history are
+        shared and read only, so before running code that writes into a variable (a[0] = 1, a.sort(), ...) the
+        variable gets a private writable copy in the namespace. The stack and the history keep the original.
+        @param code: the code that is about to be passed to eval or exec
+        @return: the set of names that got a copy, pass it to _refreeze_thawed() after the code ran """
+        thawed = set()
+        if not isinstance(code, str):
+            return thawed
+        try:
+            tree = self._code_cache.compile(code, 'parse')
+        except SyntaxError:
+            return thawed
+        for name in _names_written_in_place(tree, self._user_function_param_writes):
+            value = self._exec_globals.get(name)
+            if isinstance(value, np.ndarray) and not value.flags.writeable:
+                self._exec_globals[name] = value.copy()
+                thawed.add(name)
+        return thawed
+
+    def _refreeze_thawed(self, thawed: set):
+        """ stores the written copies back to the locals (read only again) after the code ran
+        @param thawed: the names returned by _thaw_arrays_written_by() """
+        for name in thawed:
+            if name in self._locals:
+                self._locals[name] = _freeze(self._exec_globals.get(name, self._locals[name]))
+
+    def setting_stack_history_max_bytes(self, max_bytes: int):
+        """ sets the approximate memory budget for the undo history, the oldest snapshots are evicted when the values
+        they hold add up to more than max_bytes """
+        self._stack_history_max_bytes = max_bytes
+        self._stack_history.max_bytes = max_bytes
+
+    def setting_stack_history_spill(self, hot_length=10, min_bytes=16_000_000):
+        """ sets how the undo history spills large arrays to disk, the newest hot_length snapshots always stay in RAM
+        and arrays smaller than min_bytes are never spilled. Set min_bytes to None to keep everything in RAM """
+        self._stack_history.hot_length = hot_length
+        self._stack_history.spill_min_bytes = min_bytes
+
+    def setting_code_cache_size(self, max_length: int):
+        """ sets how many compiled eval/exec strings are kept, the least recently used are dropped first """
+        self._code_cache.max_length = max_length
+        self._code_cache.trim()
+
+    def setting_function_cache_size(self, max_length: int):
+        """ sets how many results are kept for each pure user function, used when a function is (re-)defined """
+        self._function_cache_length = max_length
+        for function in self._exec_globals.values():
+            if isinstance(function, _MemoizedFunction):
+                function.max_length = max_length
+
     def setting_invert_lists(self, invert_lists: bool):
         """ sets the invert lists flag, if True, when using 'stack to list or stack to array' the stack will be
         inverted in the list, so stack[0] will be list[-1] if this setting is True"""
         self._setting_invert_lists = invert_lists
 
+    def setting_exact_iterables(self, exact: bool):
+        """ sets the exact iterables flag, if True the iterable functions (prod, fsum, dist, sumprod, ...) use the
+        math library (exactly rounded fsum, python int products) instead of the numpy reductions. This is a python
+        loop so it is much slower on large arrays """
+        self._setting_exact_iterables = exact
+
+    def setting_allow_code_execution(self, allow: bool):
+        """ sets the allow code execution flag, if False the text typed at X is only evaluated as plain math (numbers,
+        variables, operators and math function calls, see _compile_arithmetic), imports, statements and new user
+        functions are refused and only math functions can be called with values from the stack """
+        self._setting_allow_code_execution = allow
+
+    def setting_sandbox(self, enabled: bool, cpu_seconds: float = 10, memory_mb: int = 2048, timeout: float = None):
+        """ sets the sandbox mode, if True the code typed at X and the user functions called from the stack run in a
+        child process (see sandbox.Sandbox) limited to cpu_seconds of cpu time and memory_mb of address space per
+        evaluation. A runaway evaluation kills the child, not the session: the error is reported, the stack is as it
+        was and the child is started again on the next evaluation. Large arrays go to the child through shared
+        memory. The buttons, imports and library functions called from the stack still run in this process
+        @param timeout: the wall clock limit in seconds, None for twice cpu_seconds plus 10 s """
+        if self._sandbox is not None:
+            self._sandbox.close()
+            self._sandbox = None
+        if enabled:
+            self._sandbox = Sandbox(cpu_seconds, memory_mb * 2 ** 20 if memory_mb else None, timeout,
+                                    definitions=self._definitions)
+
+    def _forget_in_sandbox(self, names):
+        """ tells the sandbox the names were rebound or deleted, so the old values are not kept for the child """
+        if self._sandbox is not None:
+            self._sandbox.forget(names)
+
+    def setting_evaluation_runner(self, runner):
+        """ sets how the long evaluations are run: the eval and exec of the typed code, large array expressions and
+        the functions called with values from the stack. runner(work) runs work() and returns what it returns or
+        raises what it raises, a UI can run it on a worker thread (see BackgroundJob) and keep drawing. The rest of
+        the action and the code that reads a gui library (like plt) stay on the caller's thread
+        @param runner: a callable like runner(work), None runs the evaluations directly """
+        self._evaluation_runner = runner
+
+    def setting_fused_threads(self, threads: int):
+        """ sets the number of threads for elementwise expressions over large arrays (like 'a*b + c*np.sin(d)' with
+        millions of elements), the chunks are split over a thread pool. 1 runs the chunks on the calling thread
+        @param threads: the number of threads, 0 uses one per cpu """
+        threads = (os.cpu_count() or 1) if threads == 0 else max(threads, 1)
+        if self._fused_pool is not None:
+            self._fused_pool.shutdown(wait=False)
+        self._fused_pool = ThreadPoolExecutor(threads, thread_name_prefix='calc_fused') if threads > 1 else None
+        self._setting_fused_threads = threads
+
+    def setting_elementwise_lists(self, elementwise: bool):
+        """ sets the elementwise lists flag, if True the stack operations (+ - * / ** @ // % & | ^ << >>) promote lists
+        and tuples of numbers to numpy arrays so [1, 2] + [3, 4] is [4, 6] and not [1, 2, 3, 4] """
+        self._setting_elementwise_lists = elementwise
+
     def load_python_module(self, module_name: str):
         """ loads functions into user functions, loads classes into the exec_globals, loads module variables into
          user variables """
@@ -1493,7 +4198,8 @@ class Calculator:
 
         all_variables = {k: v for k, v in inspect.getmembers(sys.modules[module_name]) if not isinstance(v, (types.FunctionType, types.ModuleType)) and not k.startswith("__")}
 
-        self._locals.update(all_variables)
+        for key, value in all_variables.items():
+            self._set_local(key, value)
         log('here')
 
     def run_eval_on_stack_x(self,):
@@ -1501,9 +4207,10 @@ class Calculator:
         self._message = None
 
         x_temp = self._stack.pop(0)
+        thawed = self._thaw_arrays_written_by(x_temp)
 
         try:
-            result = eval(x_temp, self._exec_globals)  # this works on input like 'np.arrange(10)'
+            result = self._eval(x_temp, sandboxed=True)  # this works on input like 'np.arrange(10)'
 
             self._message = f"Evaluated: {x_temp} to {result}"
             result_type = type(result)
@@ -1514,7 +4221,7 @@ class Calculator:
                 # in this case the user probably wants to apply the builtin functon to Y
                 Y = self._stack.pop(0)
                 try:
-                    result = eval(x_temp, self._exec_globals)(Y)  # this works on input like 'np.arrange(Y)'
+                    result = self._allowed_function(self._eval(x_temp))(Y)  # like 'np.arrange(Y)'
                     self._message = f"Evaluated: {x_temp}({Y}) to {result}"
                 except Exception as ex:
                     self._message = f"Error in run_eval_on_stack_x: eval: '{x_temp}({Y})' with exceptions ex: {ex}"
@@ -1527,4 +4234,5 @@ class Calculator:
             self._message = f"Error in run_eval_on_stack_x: eval: '{x_temp}' with exceptions ex: {ex}"
             self.stack_put(x_temp)
 
+        self._refreeze_thawed(thawed)
         log(self._message)
\ No newline at end of file
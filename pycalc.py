@@ -0,0 +1,102 @@
+""" headless entry point for PyCalc, runs RPN programs without the Tk UI. Like:
+
+    python -m pycalc run prog.rpn other.rpn --repeat 1000
+    python -m pycalc csv prog.rpn rows.csv results.csv --columns 0 2 --levels 1
+
+A program is a text file of tokens, each token is handled like the UI hands it to the calculator and 'enter' presses
+enter, see calc.program_tokens() for the syntax. The final stack of each program is printed to stdout (X first) and
+the throughput to stderr. One calculator runs all the programs, each starts from an empty stack. The csv command
+runs one program on every row of a CSV file, see Calculator.run_program_on_csv() """
+import argparse
+import contextlib
+import sys
+import time
+
+import matplotlib
+
+matplotlib.use('Agg')  # no windows, plots can still be saved to a file
+
+
+def _calculator():
+    """ imports calc and returns a new Calculator, the launch banner and the import logging go to stderr """
+    with contextlib.redirect_stdout(sys.stderr):
+        import calc
+        return calc, calc.Calculator()
+
+
+def run(paths: list, repeat: int = 1, quiet: bool = False) -> int:
+    """ runs the programs in the files and prints their final stacks
+    @param paths: the program files
+    @param repeat: number of times to run each program, for timing
+    @param quiet: if True only the summary is printed
+    @return: the exit code, 1 if any program reported an error """
+    calc, calculator = _calculator()
+    programs = []
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as file:
+            programs.append((path, calc.program_tokens(file.read())))
+
+    exit_code = 0
+    runs = 0
+    tokens = 0
+    start = time.perf_counter()
+    for path, program in programs:
+        for _ in range(repeat):
+            stack = calculator.run_program(program, clear_stack=True)
+            runs += 1
+            tokens += len(program)
+        if calculator.return_program_errors() > 0:
+            exit_code = 1
+            print(f"{path}: {calculator.return_message()}", file=sys.stderr)
+        if not quiet:
+            print(f"{path}: {stack}")
+    seconds = time.perf_counter() - start
+    rate = runs / seconds if seconds > 0 else 0.0
+    print(f"Ran '{runs}' program(s), '{tokens}' tokens in '{seconds:0.3f}' s, '{rate:,.0f}' programs/s",
+          file=sys.stderr)
+    return exit_code
+
+
+def run_csv(path: str, input_path: str, output_path: str, columns: list = None, levels: int = 1, header: bool = False,
+            delimiter: str = ',', chunk_rows: int = 65_536) -> int:
+    """ runs the program in the file on every row of a CSV file, see Calculator.run_program_on_csv()
+    @return: the exit code, 1 if the program or the file reported an error """
+    calc, calculator = _calculator()
+    with open(path, 'r', encoding='utf-8') as file:
+        program = calc.program_tokens(file.read())
+    if columns is not None:
+        columns = [int(column) if column.isdigit() else column for column in columns]
+    with contextlib.redirect_stdout(sys.stderr):
+        calculator.run_program_on_csv(program, input_path, output_path, columns=columns, levels=levels,
+                                      header=header, delimiter=delimiter, chunk_rows=chunk_rows)
+    print(calculator.return_message(), file=sys.stderr)
+    return 1 if calculator.return_program_errors() > 0 else 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog='pycalc', description='PyCalc without the UI')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help='run RPN program files and print the final stacks')
+    run_parser.add_argument('paths', nargs='+', help='program files, tokens separated by white space')
+    run_parser.add_argument('--repeat', type=int, default=1, help='run each program this many times')
+    run_parser.add_argument('--quiet', action='store_true', help='only print the summary')
+    csv_parser = commands.add_parser('csv', help='run an RPN program on every row of a CSV file')
+    csv_parser.add_argument('path', help='the program file')
+    csv_parser.add_argument('input', help='the CSV file to read')
+    csv_parser.add_argument('output', help='the CSV file to write')
+    csv_parser.add_argument('--columns', nargs='+', help='column indexes or header names to push, default all')
+    csv_parser.add_argument('--levels', type=int, default=1, help='stack levels written per row, X first')
+    csv_parser.add_argument('--header', action='store_true', help='the first line holds the column names')
+    csv_parser.add_argument('--delimiter', default=',', help='the column separator')
+    csv_parser.add_argument('--chunk-rows', type=int, default=65_536, help='rows per chunk, bounds the memory')
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        return run(args.paths, repeat=max(1, args.repeat), quiet=args.quiet)
+    if args.command == 'csv':
+        return run_csv(args.path, args.input, args.output, columns=args.columns, levels=args.levels,
+                       header=args.header, delimiter=args.delimiter, chunk_rows=max(1, args.chunk_rows))
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
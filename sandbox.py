@@ -0,0 +1,327 @@
+""" runs the calculator's eval, exec and user function calls in a child process with resource limits, so a runaway
+expression (like an accidental '10**10**8') or a huge allocation in a user function kills the child and not the
+session. See Calculator.setting_sandbox().
+
+The child is started once and kept, each request sends the code, the variables it reads and the definitions (imports
+and user functions) the child has not seen yet. Large numpy arrays go through shared memory instead of the pipe. On a
+limit violation, a timeout or a cancel() the child is killed and started again on the next request, the latest definition
+of each name is replayed into it. The limits use the posix resource module, without it (windows) only the wall clock
+timeout works """
+import builtins
+import math
+import multiprocessing
+import pickle
+import signal
+import threading
+import time
+import types
+from multiprocessing import shared_memory
+
+try:
+    import resource
+except ImportError:
+    resource = None  # not on windows, the child then runs without the cpu and memory limits
+
+_SHARED_MIN_BYTES = 1 << 20  # arrays at least this big go through shared memory, smaller ones are pickled
+_POLL_SECONDS = 0.05  # the parent waits for a reply in steps, so a BackgroundJob can cancel the wait
+_MISSING = object()  # a value no binding has
+
+
+class SandboxError(RuntimeError):
+    """ the child process broke a limit, timed out, was cancelled or died. It is started again on the next request """
+
+
+class _SharedArray:
+    """ stands in for a numpy array in the pickled request or reply, the data is in the shared memory block """
+
+    def __init__(self, block_name: str, shape: tuple, dtype: str):
+        self.block_name = block_name
+        self.shape = shape
+        self.dtype = dtype
+
+
+def _share(value, blocks: list):
+    """ returns value, or a _SharedArray holding a copy of it if it is a large numpy array
+    @param blocks: the new shared memory block is appended, the caller closes it (and unlinks it if it is the
+                   reader's job to free it) """
+    import numpy as np
+    if not isinstance(value, np.ndarray) or value.nbytes < _SHARED_MIN_BYTES or value.dtype.hasobject:
+        return value  # ----------------------------------------------------------------------------------------------->
+    block = shared_memory.SharedMemory(create=True, size=value.nbytes)
+    blocks.append(block)
+    np.ndarray(value.shape, value.dtype, buffer=block.buf)[...] = value
+    return _SharedArray(block.name, value.shape, value.dtype.str)
+
+
+def _unshare(value, unlink=False):
+    """ returns value, or the array copied out of the shared memory block for a _SharedArray. The copy is needed, a
+    view would keep the block open
+    @param unlink: True frees the block, the reader does this for a reply """
+    if not isinstance(value, _SharedArray):
+        return value  # ----------------------------------------------------------------------------------------------->
+    import numpy as np
+    block = shared_memory.SharedMemory(name=value.block_name)
+    try:
+        array = np.ndarray(value.shape, np.dtype(value.dtype), buffer=block.buf).copy()
+    finally:
+        block.close()
+        if unlink:
+            block.unlink()
+    return array
+
+
+def code_names(code) -> set:
+    """ returns the global names a code object and the code nested in it (comprehensions, lambdas, defs) read """
+    names = set(code.co_names)
+    for constant in code.co_consts:
+        if isinstance(constant, types.CodeType):
+            names |= code_names(constant)
+    return names
+
+
+def _limit_cpu(cpu_seconds):
+    """ sets the soft cpu limit of the child to the cpu time used so far plus cpu_seconds, past it the kernel sends
+    SIGXCPU which ends the child """
+    if resource is None or not cpu_seconds:
+        return  # ----------------------------------------------------------------------------------------------------->
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    soft = int(math.ceil(usage.ru_utime + usage.ru_stime + cpu_seconds))
+    hard = resource.getrlimit(resource.RLIMIT_CPU)[1]
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+def _call(function, args: tuple, vectorize: bool):
+    """ calls a user function in the child. With vectorize a function that fails on array arguments is called once
+    per element, like Calculator._array_version() does in the parent """
+    import numpy as np
+    try:
+        return function(*args)
+    except Exception:
+        if not vectorize or not any(isinstance(arg, np.ndarray) and arg.ndim > 0 for arg in args):
+            raise
+    result = np.frompyfunc(function, len(args), 1)(*args)
+    typed = np.array(result.tolist()) if isinstance(result, np.ndarray) else result
+    return typed if getattr(typed, 'shape', None) == result.shape and typed.dtype.kind in 'biufc' else result
+
+
+def _picklable(value) -> bool:
+    """ True if value can be sent back, an exec can bind modules, functions and classes the parent does not need """
+    if isinstance(value, (types.ModuleType, types.FunctionType, type)):
+        return False  # ----------------------------------------------------------------------------------------------->
+    try:
+        pickle.dumps(value)
+        return True  # ------------------------------------------------------------------------------------------------>
+    except Exception:
+        return False
+
+
+def _child_main(connection, cpu_seconds: float, memory_bytes: int):
+    """ the child process, handles one request at a time until the pipe closes. The memory limit is set before
+    anything is imported, so it covers numpy and the user libraries too """
+    if resource is not None and memory_bytes:
+        hard = resource.getrlimit(resource.RLIMIT_AS)[1]
+        resource.setrlimit(resource.RLIMIT_AS, (memory_bytes if hard == resource.RLIM_INFINITY else
+                                                min(memory_bytes, hard), hard))
+    namespace = {name: value for name, value in vars(math).items() if not name.startswith('_')}
+    namespace['math'] = math
+    while True:
+        try:
+            request = connection.recv()
+        except EOFError:
+            return  # the parent closed the pipe ---------------------------------------------------------------------->
+        kind, payload, definitions, variables = request
+        blocks = []
+        try:
+            _limit_cpu(cpu_seconds)
+            if 'np' not in namespace:
+                namespace['np'] = __import__('numpy')
+            for source in definitions:
+                exec(source, namespace)
+            for name, value in variables.items():
+                value = namespace[name] = _unshare(value)
+                if isinstance(value, namespace['np'].ndarray):
+                    value.flags.writeable = False  # a write would only change the child's copy
+            if kind == 'eval':
+                reply = ('ok', _share(eval(payload, namespace), blocks))
+            elif kind == 'exec':
+                before = dict(namespace)
+                exec(payload, namespace)
+                changed = {name: _share(value, blocks) for name, value in namespace.items()
+                           if name != '__builtins__' and before.get(name, _MISSING) is not value}
+                reply = ('ok', {name: value for name, value in changed.items() if _picklable(value)})
+            else:
+                name, args, vectorize = payload
+                reply = ('ok', _share(_call(namespace[name], tuple(_unshare(arg) for arg in args), vectorize), blocks))
+        except MemoryError:
+            reply = ('error', 'MemoryError', f"out of memory, the sandbox limit is '{memory_bytes:,}' bytes")
+        except Exception as ex:
+            reply = ('error', type(ex).__name__, str(ex))
+        try:
+            connection.send(reply)
+        except Exception as ex:  # the result can't be pickled, like a lambda
+            for block in blocks:
+                block.unlink()
+            connection.send(('error', 'TypeError', f"the result can't be sent back from the sandbox: {ex}"))
+        for block in blocks:
+            block.close()  # the parent copies the data out and unlinks the block
+
+
+class Sandbox:
+    """ a persistent child process that runs the calculator's evaluations under cpu, memory and wall clock limits
+    @param cpu_seconds: the cpu time one request may use, None for no limit
+    @param memory_bytes: the address space of the child, None for no limit
+    @param timeout: the wall clock seconds the parent waits for one request, None for twice the cpu limit plus 10 s
+    @param definitions: like {'name': 'source'} the imports and user function defs, the caller keeps the latest one for
+                        each name and removes the deleted ones, every new child runs all of them """
+
+    def __init__(self, cpu_seconds: float = 10, memory_bytes: int = 2 << 30, timeout: float = None,
+                 definitions: dict = None):
+        self.cpu_seconds = cpu_seconds
+        self.memory_bytes = memory_bytes
+        self.timeout = timeout if timeout is not None else 2 * (cpu_seconds or 10) + 10
+        self.definitions = definitions if definitions is not None else {}
+        self.restarts = 0  # the number of times a child was killed, for the messages and the tests
+        self._context = multiprocessing.get_context('spawn')  # a fork would copy the calculator, threads and all
+        self._process = None
+        self._connection = None
+        self._definitions_sent = {}  # name: the source the child ran for it
+        self._shipped = {}  # name: the value the child holds for it, unchanged values are not sent again
+        self._forgotten = set()  # the names the child still holds but the caller rebound or deleted, see forget()
+        self._cancelled = threading.Event()  # set by cancel() from another thread, the waiting request stops
+
+    def eval(self, source: str, variables: dict):
+        """ evaluates source in the child
+        @param variables: the values of the names source reads, see variables_for() """
+        return self._request('eval', source, variables)
+
+    def exec(self, source: str, variables: dict) -> dict:
+        """ executes source in the child
+        @return: the names source bound or re-bound, values that can't be pickled (modules, functions) are left out """
+        return self._request('exec', source, variables)
+
+    def call(self, name: str, args: tuple, variables: dict, vectorize=True):
+        """ calls the user function name in the child, it must be in the definitions """
+        return self._request('call', (name, tuple(args), vectorize), variables)
+
+    @staticmethod
+    def variables_for(code, namespace: dict) -> dict:
+        """ returns the values the code reads from the namespace, including the ones read by the functions defined in
+        the namespace that it calls (the user functions). Modules and functions are left out, the child has its own
+        from the definitions """
+        values = {}
+        names = code_names(code)
+        seen = set()
+        while names:
+            name = names.pop()
+            seen.add(name)
+            value = namespace.get(name, _MISSING)
+            function = getattr(value, '__wrapped__', value)  # a pure user function is wrapped by its result cache
+            if isinstance(function, types.FunctionType) and function.__globals__ is namespace:
+                names |= code_names(function.__code__) - seen
+            elif value is not _MISSING and not callable(value) and not isinstance(value, types.ModuleType):
+                values[name] = value
+        return values
+
+    def cancel(self):
+        """ stops the request that is running, from another thread. The child is killed, the request raises
+        SandboxError and the next one starts a new child """
+        self._cancelled.set()
+
+    def forget(self, names):
+        """ drops the values sent for names, call it when the caller rebinds or deletes them, so neither process holds
+        on to the old value (like a large array). The child deletes them on the next request """
+        for name in names:
+            if self._shipped.pop(name, _MISSING) is not _MISSING:
+                self._forgotten.add(name)
+
+    def close(self):
+        """ stops the child, the next request starts a new one """
+        if self._process is not None:
+            self._connection.close()
+            self._process.kill()
+            self._process.join()
+        self._process = None
+        self._connection = None
+
+    def _start(self):
+        parent_end, child_end = self._context.Pipe()
+        self._process = self._context.Process(target=_child_main, name='calc_sandbox', daemon=True,
+                                              args=(child_end, self.cpu_seconds, self.memory_bytes))
+        self._process.start()
+        child_end.close()
+        self._connection = parent_end
+        self._definitions_sent = {}
+        self._shipped = {}
+        self._forgotten = set()
+
+    def _restart(self, reason: str):
+        """ kills the child and raises SandboxError with reason """
+        self.close()
+        self.restarts += 1
+        raise SandboxError(f"{reason}, the sandbox was restarted")
+
+    def _exit_reason(self) -> str:
+        self._process.join(1)
+        code = self._process.exitcode
+        if code is not None and -code == getattr(signal, 'SIGXCPU', None):
+            return f"the sandbox cpu limit of '{self.cpu_seconds}' s was reached"
+        if code is not None and -code == signal.SIGKILL:
+            return "the sandbox was killed, most likely out of memory"
+        return f"the sandbox ended with exit code '{code}'"
+
+    def _request(self, kind: str, payload, variables: dict):
+        if self._process is None or not self._process.is_alive():
+            self._start()
+        self._cancelled.clear()
+        send = {name: value for name, value in variables.items() if self._shipped.get(name, _MISSING) is not value}
+        removed = self._forgotten | {name for name in self._definitions_sent if name not in self.definitions}
+        definitions = [f"globals().pop({name!r}, None)" for name in sorted(removed)]
+        definitions += [source for name, source in self.definitions.items()
+                        if self._definitions_sent.get(name) != source]
+        blocks = []
+        try:
+            self._connection.send((kind, payload if kind != 'call' else
+                                   (payload[0], tuple(_share(arg, blocks) for arg in payload[1]), payload[2]),
+                                   definitions, {name: _share(value, blocks) for name, value in send.items()}))
+            self._definitions_sent = dict(self.definitions)
+            self._forgotten = set()
+            self._shipped.update(send)
+            reply = self._wait()
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+        if reply[0] == 'error':
+            error = getattr(builtins, reply[1], None)
+            if isinstance(error, type) and issubclass(error, Exception):
+                raise error(reply[2])
+            raise RuntimeError(f"{reply[1]}: {reply[2]}")
+        if kind == 'exec':
+            changed = {name: _unshare(value, unlink=True) for name, value in reply[1].items()}
+            self._shipped.update(changed)  # the child holds these already
+            return changed  # ----------------------------------------------------------------------------------------->
+        return _unshare(reply[1], unlink=True)
+
+    def _wait(self):
+        """ waits for the reply of the running request, kills the child on a timeout, a cancel(), when it dies or when
+        the wait is interrupted (like ctrl+c), the state of a child that did not finish is unknown """
+        deadline = time.monotonic() + self.timeout
+        try:
+            while not self._connection.poll(_POLL_SECONDS):
+                if not self._process.is_alive():
+                    break
+                if time.monotonic() > deadline:
+                    self._restart(f"the sandbox timeout of '{self.timeout}' s was reached")
+                if self._cancelled.is_set():
+                    self._restart("the sandbox evaluation was cancelled")
+            return self._connection.recv()  # ------------------------------------------------------------------------->
+        except (EOFError, OSError):
+            self._restart(self._exit_reason())
+        except SandboxError:
+            raise
+        except BaseException:
+            self.close()
+            self.restarts += 1
+            raise
@@ -1,7 +1,11 @@
 import calc
+import itertools
 import unittest
 import math
 import engnum
+import numpy as np
+import os
+import tempfile
 
 pi_50 = '3.14159265358979323846264338327950288419716939937510'
 c = calc.Calculator()
@@ -36,6 +40,703 @@ class TestAllCalculatorFunctions(unittest.TestCase):
         print(f"STACK: {c.return_stack_for_display()}")
         self.assertEqual(2, num)
 
+    def test_redo(self):
+        c.clear_stack()
+        c.user_entry(1)
+        c.user_entry(2)
+        c.user_entry('+')
+        self.assertEqual(c.return_stack_for_display(), [3])
+        c.undo_last_action()
+        self.assertEqual(c.return_stack_for_display(), [2, 1])
+        c.redo_last_undo()
+        self.assertEqual(c.return_stack_for_display(), [3])
+        c.undo_last_action()
+        c.user_entry(5)  # changing the stack invalidates the redo
+        c.redo_last_undo()
+        self.assertEqual(c.return_stack_for_display(), [5, 2, 1])
+
+    def test_history_snapshots_are_shared(self):
+        c.clear_stack()
+        for i in range(1000):
+            c.user_entry(i)
+        c.user_entry('swap')
+        c.user_entry('drop')
+        # the snapshots share every node below X with the live stack
+        self.assertIs(c._stack_history[-1].front.below.below, c._stack.snapshot().front.below)
+        self.assertIs(c._stack_history[-1].back, c._stack.snapshot().back)
+        self.assertEqual(c.return_stack_for_display(1), 997)
+
+    def test_history_memory_budget(self):
+        c.clear_stack()
+        c.setting_stack_history_max_bytes(3_500_000)
+        try:
+            for i in range(5):
+                c.clear_stack()
+                c.user_entry(np.zeros(125_000))  # 1 MB each
+                c.user_entry('dup')
+                c.user_entry('swap')  # the same array twice is only counted once
+            self.assertLessEqual(c._stack_history.nbytes, 3_500_000)
+            self.assertGreaterEqual(c._stack_history.nbytes, 2_000_000)
+            self.assertLess(len(c._stack_history), 10)
+            c.undo_last_action()
+            self.assertIn('History Size', c.return_message())
+        finally:
+            c.setting_stack_history_max_bytes(1_000_000_000)
+
+    def test_history_spills_cold_arrays(self):
+        c.clear_stack()
+        c.setting_stack_history_spill(hot_length=2, min_bytes=1000)
+        try:
+            c.user_entry(np.zeros(500))
+            for i in range(6):
+                c.user_entry(1)
+                c.user_entry('+')
+            self.assertGreater(c._stack_history.spilled_nbytes, 0)
+            for i in range(6):
+                c.undo_last_action()
+            x = c.return_stack_for_display(1)
+            self.assertIsInstance(x, np.memmap)  # came back from disk
+            self.assertEqual(x[0], 0.0)
+        finally:
+            c.setting_stack_history_spill()
+
+    def test_history_warm_touches_only_spilled_levels(self):
+        history = calc.StackHistory(hot_length=2, spill_min_bytes=1000)
+        stack = calc.CalcStack(range(20_000))
+        stack.insert(0, np.zeros(500))
+        snapshots = []
+        for i in range(6):
+            snapshots.append(stack.snapshot())
+            history.append(snapshots[-1])
+            stack[0] = i  # the array is only in the oldest snapshot, so it gets spilled
+        self.assertGreater(history.spilled_nbytes, 0)
+        for i in range(6):
+            warm = history.pop()
+        self.assertIsNot(warm, snapshots[0])  # the array came back from disk
+        self.assertIsInstance(calc.CalcStack.from_snapshot(warm)[0], np.memmap)
+        # the levels below the array are shared, not re-built
+        self.assertIs(warm.front.below, snapshots[0].front.below)
+        self.assertIs(warm.back, snapshots[0].back)
+
+        history = calc.StackHistory(hot_length=2, spill_min_bytes=1000)
+        stack = calc.CalcStack(range(20_000))
+        snapshots = []
+        for i in range(6):
+            stack.insert(0, i)
+            snapshots.append(stack.snapshot())
+            history.append(snapshots[-1])
+        for i in range(6):
+            warm = history.pop()
+        self.assertIs(warm, snapshots[0])  # nothing spilled, the snapshot is returned as is
+
+    def test_copy_on_write_arrays(self):
+        c.clear_stack()
+        c.user_entry(np.arange(5.0))
+        c.user_entry('cow_a=')
+        c.enter_press()
+        c.user_entry('dup')
+        c.user_entry('np.copyto(cow_a, 7)')  # writes into the variable, not into the shared array
+        c.enter_press()
+        self.assertEqual(float(c.return_locals()['cow_a'][0]), 7.0)
+        self.assertEqual(float(c.return_stack_for_display(1)[0]), 0.0)
+        self.assertFalse(c.return_stack_for_display(1).flags.writeable)
+        c.undo_last_action()
+        self.assertEqual(float(c.return_stack_for_display(1)[0]), 0.0)
+        mine = np.zeros(3)
+        c.user_entry(mine)  # the calculator keeps a read only view, the caller's array is not changed
+        c.load_locals({'cow_b': mine})
+        c.run_program([], stack=[mine])
+        self.assertTrue(mine.flags.writeable)
+        self.assertFalse(c.return_stack_for_display(0).flags.writeable)
+        self.assertFalse(c.return_locals()['cow_b'].flags.writeable)
+
+    def test_roll_deep_stack(self):
+        c.clear_stack()
+        c.user_entry(list(range(19999, -1, -1)))
+        c.user_entry('iterable_to_stack')
+        self.assertEqual(c.return_stack_for_display(0), 0)
+        self.assertEqual(c.return_stack_for_display(19999), 19999)
+        for i in range(3):
+            c.user_entry('roll_up')
+        self.assertEqual(c.return_stack_for_display()[:4], [19997, 19998, 19999, 0])
+        for i in range(5):
+            c.user_entry('roll_down')
+        self.assertEqual(c.return_stack_for_display()[:2], [2, 3])
+        self.assertEqual(c.return_stack_for_display()[-2:], [0, 1])
+
+    def test_roll_up_is_amortized_constant(self):
+        stack = calc.CalcStack()
+        for i in range(50_000):
+            stack.insert(0, i)  # pushes only grow the front chain
+        stack.insert(0, stack.pop(-1))  # the first bottom pop splits the chains once
+        back = stack.snapshot().back
+        self.assertGreater(calc._depth(back), 20_000)
+        for i in range(1000):
+            stack.insert(0, stack.pop(-1))
+        self.assertIs(stack.snapshot().back, calc._chain_split(back, 1000)[1])  # walked 1000 nodes, copied none
+        self.assertEqual(stack[0], 1000)
+        self.assertEqual(stack[-1], 1001)
+
+    def test_stack_container_matches_list(self):
+        rng = np.random.default_rng(5)
+        stack = calc.CalcStack(range(50))
+        reference = list(range(50))
+        for i in range(3000):
+            op = rng.integers(4)
+            idx = int(rng.integers(-len(reference), len(reference))) if len(reference) > 0 else 0
+            if op == 0:
+                stack.insert(idx, i)
+                reference.insert(idx, i)
+            elif op == 1 and len(reference) > 0:
+                self.assertEqual(stack.pop(idx), reference.pop(idx))
+            elif op == 2 and len(reference) > 0:
+                stack[idx] = -i
+                reference[idx] = -i
+            elif len(reference) > 0:
+                self.assertEqual(stack[idx], reference[idx])
+        self.assertEqual(list(stack), reference)
+
+    def test_code_cache(self):
+        c.clear_stack()
+        c._code_cache.clear()
+        c.user_entry('cc_k=3')
+        c.enter_press()
+        for i in range(20):
+            c.user_entry(i)
+            c.user_entry('cc_k*2')
+            c.user_entry('+')
+        self.assertEqual(c.return_stack_for_display(0), 19 + 6)
+        self.assertLessEqual(c._code_cache.misses, 3)
+        self.assertGreaterEqual(c._code_cache.hits, 19)
+        c.user_entry('code_cache')
+        self.assertIn('Hit Rate', c.return_message())
+
+    def test_enter_classifier(self):
+        c.clear_stack()
+        c.user_entry(np.arange(3))
+        c.enter_press()  # not a string and not a number, it goes to eval like before and that fails
+        self.assertIn('Error', c.return_message())
+        self.assertEqual(len(c.return_stack_for_display()), 1)
+        c.user_entry('sum')  # this used to compare X and Y elementwise
+        c.enter_press()
+        self.assertEqual(c.return_stack_for_display(0), 3)
+        c.user_entry('cls_a=2')
+        c.enter_press()
+        c.user_entry('cls_a == 2')  # a comparison, not an assignment
+        c.enter_press()
+        self.assertIs(c.return_stack_for_display(0), True)
+        self.assertEqual(calc._classify_entry(' 1.5 '), ('number', 1.5))
+        self.assertEqual(calc._classify_entry('b='), ('assignment', ('b', '')))
+        self.assertEqual(calc._classify_entry('from os import path')[0], 'import')
+
+    def test_library_symbol_index(self):
+        c.clear_stack()
+        self.assertEqual(c._library_symbols['linspace'][1], 'np.linspace')
+        c.user_entry('from numpy import geomspace')  # an imported name is a calculator function
+        c.enter_press()
+        c.user_entry(1)
+        c.user_entry(100)
+        c.user_entry('geomspace')
+        c.enter_press()
+        self.assertEqual(len(c.return_stack_for_display(0)), 50)  # num is optional so it is not taken from the stack
+        self.assertEqual(c.return_stack_for_display(0)[-1], 1.0)
+        c.clear_stack()
+        c.user_entry(3)
+        c.user_entry(5)
+        c.user_entry('mean')  # np.mean is indexed but not a calculator function, it is evaluated like before
+        c.enter_press()
+        self.assertIn('Error', c.return_message())
+        self.assertEqual(c.return_stack_for_display(), ['mean', 5, 3])
+        c.user_entry('import numpy as np')  # importing again rebuilds the entries for np
+        c.enter_press()
+        self.assertIs(c._library_symbols['linspace'][2], np.linspace)
+
+    def test_function_arity_cache(self):
+        c.clear_stack()
+        c.add_user_function('def arity_f(a, b=(1, 2), *args, **kwargs): return a * 10')
+        self.assertEqual(c._function_arity[c._exec_globals['arity_f']], (1, 1))  # the comma in the default is fine
+        self.assertEqual(c._function_arity[np.add], (2, 0))
+        c.user_entry(5)
+        c.user_entry(4)
+        c.user_entry('arity_f')
+        c.enter_press()
+        self.assertEqual(c.return_stack_for_display(), [40, 5])
+        c.clear_user_functions('arity_f')
+
+    def test_assignment_namespace(self):
+        c.clear_stack()
+        c.load_locals({f"ns_{i}": i for i in range(2000)})
+        c.user_entry('ns_new = 7')
+        c.enter_press()
+        self.assertEqual(c.return_locals()['ns_new'], 7)
+        self.assertEqual(c._exec_globals['ns_new'], 7)
+        c.user_entry('np = 1')  # imports, math, builtins and user functions are reserved
+        c.enter_press()
+        self.assertIn("cant assign", c.return_message())
+        self.assertIs(c._exec_globals['np'], np)
+        c.clear_all_variables()
+        self.assertNotIn('ns_1', c._exec_globals)
+
+    def test_one_arg_functions_vectorized(self):
+        c.clear_stack()
+        c.user_entry(np.arange(4.0) ** 2)
+        c.user_entry('sqrt')
+        result = c.return_stack_for_display(0)
+        self.assertIsInstance(result, np.ndarray)
+        self.assertEqual(result.tolist(), [0.0, 1.0, 2.0, 3.0])
+        c.user_entry((1.0, 4.0))
+        c.user_entry('log2')
+        self.assertEqual(c.return_stack_for_display(0), (0.0, 2.0))  # container type is kept
+        c.user_entry([20, 25])
+        c.user_entry('factorial')  # exact ints, not int64
+        self.assertEqual(c.return_stack_for_display(0), [math.factorial(20), math.factorial(25)])
+        for function, expected in (('ceil', [2, 3]), ('floor', [1, 2]), ('trunc', [1, -2])):
+            c.user_entry([1.5, 2.5] if function != 'trunc' else [1.5, -2.5])
+            c.user_entry(function)  # python ints like math, not numpy floats
+            result = c.return_stack_for_display(0)
+            self.assertEqual(result, expected)
+            self.assertEqual([type(item) for item in result], [int, int])
+
+    def test_two_arg_functions_broadcast(self):
+        c.clear_stack()
+        c.user_entry(np.array([3.0, 5.0]))  # I
+        c.user_entry(np.array([[4.0], [12.0]]))  # Q, broadcasts to 2 x 2
+        c.user_entry('hypot')
+        self.assertEqual(c.return_stack_for_display(0).tolist(), [[5.0, np.hypot(5, 4)], [np.hypot(3, 12), 13.0]])
+        c.user_entry((10, 5))
+        c.user_entry(3)
+        c.user_entry('comb')
+        self.assertEqual(c.return_stack_for_display(0), (120, 10))
+        c.user_entry(5)
+        c.user_entry(3)
+        c.user_entry('fmod')  # numbers still use the math library
+        self.assertEqual(c.return_stack_for_display(0), 2.0)
+
+    def test_iterable_functions_on_arrays(self):
+        c.clear_stack()
+        c.user_entry(np.full(1_000_000, 0.5))
+        c.user_entry('fsum')
+        self.assertEqual(c.return_stack_for_display(0), 500_000.0)
+        c.user_entry(list(range(1, 30)))
+        c.user_entry('prod')  # too big for int64, still exact
+        self.assertEqual(c.return_stack_for_display(0), math.factorial(29))
+        c.user_entry([1, 2])
+        c.user_entry(np.array([4, 6]))
+        c.user_entry('dist')  # Y and X
+        self.assertEqual(c.return_stack_for_display(0), 5.0)
+        c.setting_exact_iterables(True)
+        try:
+            c.user_entry([0.1] * 10)
+            c.user_entry('fsum')
+            self.assertEqual(c.return_stack_for_display(0), math.fsum([0.1] * 10))
+        finally:
+            c.setting_exact_iterables(False)
+
+    def test_iterable_functions_on_typed_numbers(self):
+        c.clear_stack()
+        c.user_entry('16')  # typed numbers are strings on X
+        c.user_entry('isqrt')
+        self.assertEqual(c.return_stack_for_display(), [4])
+        c.user_entry('5')
+        c.user_entry('fsum')  # a lone number is a one item iterable
+        self.assertEqual(c.return_stack_for_display(0), 5.0)
+        c.user_entry('2.5')
+        c.user_entry('prod')
+        self.assertEqual(c.return_stack_for_display(0), 2.5)
+
+    def test_operator_table_and_elementwise_lists(self):
+        c.clear_stack()
+        c.user_entry(7)
+        c.user_entry(2)
+        c.user_entry('//')
+        self.assertEqual(c.return_stack_for_display(0), 3)
+        c.user_entry(np.eye(2))
+        c.user_entry(np.array([1.0, 2.0]))
+        c.user_entry('@')
+        self.assertEqual(c.return_stack_for_display(0).tolist(), [1.0, 2.0])
+        c.user_entry([1, 2])
+        c.user_entry([3, 4])
+        c.user_entry('+')
+        self.assertEqual(c.return_stack_for_display(0), [1, 2, 3, 4])  # python lists concatenate by default
+        c.setting_elementwise_lists(True)
+        try:
+            c.user_entry([1, 2])
+            c.user_entry([3, 4])
+            c.user_entry('+')
+            self.assertEqual(c.return_stack_for_display(0).tolist(), [4, 6])
+        finally:
+            c.setting_elementwise_lists(False)
+
+    def test_stack_map_and_reduce(self):
+        c.clear_stack()
+        for value in (16, 9, 4):
+            c.user_entry(value)
+        c.stack_put('sqrt')
+        c.user_entry('stack_map')
+        self.assertEqual(c.return_stack_for_display(), [2.0, 3.0, 4.0])
+        c.user_entry('stack_sum')
+        self.assertEqual(c.return_stack_for_display(), [9.0])
+        c.undo_last_action()
+        self.assertEqual(c.return_stack_for_display(), [2.0, 3.0, 4.0])
+        c.clear_stack()
+        for value in range(1, 26):
+            c.user_entry(value)
+        c.user_entry('stack_prod')
+        self.assertEqual(c.return_stack_for_display(0), math.factorial(25))  # int levels stay exact
+        c.clear_stack()
+        c.user_entry('abc')
+        c.user_entry('enter')
+        c.stack_put('sqrt')
+        c.user_entry('stack_map')
+        self.assertEqual(c.return_stack_for_display(), ['sqrt', 'abc'])  # a failed map leaves the stack alone
+        c.clear_stack()
+        c.user_entry('1')  # typed numbers are strings on the stack
+        c.enter_press()
+        c.user_entry('2.5')
+        c.user_entry('stack_sum')
+        self.assertEqual(c.return_stack_for_display(), [3.5])
+        c.user_entry('16')
+        c.enter_press()
+        c.user_entry('4')
+        c.stack_put('sqrt')
+        c.user_entry('stack_map')
+        self.assertEqual(c.return_stack_for_display(), [2.0, 4.0, 3.5 ** 0.5])
+        c.clear_stack()
+        for value in (2.5, -1.5, 4):
+            c.user_entry(value)
+        c.stack_put('ceil')
+        c.user_entry('stack_map')
+        self.assertEqual(c.return_stack_for_display(), [4, -1, 3])
+        self.assertTrue(all(type(value) is int for value in c.return_stack_for_display()))  # like one_arg ceil
+        c.user_entry('stack_mean')
+        self.assertEqual(c.return_stack_for_display(), [2.0])
+        self.assertEqual(c.return_stack_reductions(), ['sum', 'prod', 'mean', 'min', 'max'])
+
+    def test_stack_to_array_and_matrix(self):
+        c.clear_stack()
+        c.user_entry(1)
+        c.user_entry(2.5)
+        c.user_entry('stack_to_array')
+        self.assertEqual(c.return_stack_for_display(0).dtype, np.float64)
+        self.assertEqual(c.return_stack_for_display(0).tolist(), [1.0, 2.5])
+        c.clear_stack()
+        c.user_entry(2 ** 40)
+        c.user_entry(3)
+        c.user_entry('stack_to_array')
+        self.assertEqual(c.return_stack_for_display(0).tolist(), [2 ** 40, 3])  # ints are not truncated or cast
+        c.clear_stack()
+        c.user_entry(np.arange(3))
+        c.user_entry([3, 4, 5])
+        c.user_entry('stack_to_matrix')
+        self.assertEqual(c.return_stack_for_display(0).tolist(), [[0, 1, 2], [3, 4, 5]])
+        c.clear_stack()
+        c.user_entry(np.arange(3))
+        c.user_entry(np.arange(2))
+        c.user_entry('stack_to_matrix')
+        self.assertEqual(len(c.return_stack_for_display()), 2)  # different lengths, the stack is left alone
+        self.assertIn('Error', c.return_message())
+
+    def test_arithmetic_evaluator(self):
+        c.clear_stack()
+        c.user_entry('ae_a=3')
+        c.enter_press()
+        for text in ('(3.3*4.7)/(1+2)', 'ae_a*sqrt(2)+1', '1 < ae_a < 5', 'np.pi*ae_a', '[1, ae_a]', 'divmod(7, 2)'):
+            self.assertEqual(c._eval(text), eval(text, c._exec_globals))
+        self.assertTrue(callable(c._code_cache.compile('ae_a*sqrt(2)+1', 'arithmetic')[0]))
+        c.setting_allow_code_execution(False)
+        try:
+            c.user_entry('ae_a*2')
+            c.enter_press()
+            self.assertEqual(c.return_stack_for_display(0), 6)
+            c.user_entry('__import__("os")')
+            c.enter_press()
+            self.assertEqual(c.return_stack_for_display(0), '__import__("os")')  # refused, left on the stack
+            self.assertIn('code execution is turned off', c.return_message())
+        finally:
+            c.setting_allow_code_execution(True)
+
+    def test_user_functions_refused_without_code_execution(self):
+        c.clear_stack()
+        c.add_user_function('def nc_twice(x):\n    return 2 * x')
+        c.setting_allow_code_execution(False)
+        try:
+            c.user_entry(4)
+            c.user_entry('nc_twice')
+            c.enter_press()
+            self.assertEqual(c.return_stack_for_display(), ['nc_twice', 4])  # refused, the stack is as it was
+            self.assertIn('code execution is turned off', c.return_message())
+        finally:
+            c.setting_allow_code_execution(True)
+            c.clear_user_functions('nc_twice')
+        c.clear_stack()
+        c.user_entry(4)
+        c.user_entry('nc_twice')
+        c.add_user_function('def nc_twice(x):\n    return 2 * x')
+        c.enter_press()
+        self.assertEqual(c.return_stack_for_display(), [8])
+        c.clear_user_functions('nc_twice')
+
+    def test_fused_array_expressions(self):
+        c.clear_stack()
+        size = calc._FUSED_MIN_SIZE + calc._FUSED_CHUNK // 2  # not a whole number of chunks
+        c.user_entry(np.linspace(0, 1, size))
+        c.user_entry('fu_a=')
+        c.enter_press()
+        c.user_entry(np.arange(size, dtype=np.int32))
+        c.user_entry('fu_b=')
+        c.enter_press()
+        for text in ('fu_a*fu_b + 2*np.sin(fu_a)', 'fu_b*3 - 1', 'fu_a**0.5 < fu_a'):
+            evaluate, plan = c._code_cache.compile(text, 'arithmetic')
+            self.assertIsNotNone(plan.run(c._exec_globals))  # large arrays, the chunked path is taken
+            expected = eval(text, c._exec_globals)
+            result = c._eval(text)
+            self.assertEqual(result.dtype, expected.dtype)
+            self.assertTrue(np.array_equal(result, expected))
+        self.assertIsNone(c._code_cache.compile('fu_a @ fu_a', 'arithmetic')[1])  # not elementwise
+
+    def test_user_function_on_arrays(self):
+        c.clear_stack()
+        c.add_user_function('def vec_ramp(x): return x if x > 0 else 0')
+        c.add_user_function('def vec_square(x): return x * x')
+        c.user_entry(np.array([-1.5, 2.0, 3.0]))
+        c.stack_put('vec_ramp')  # scalar only, runs once per element
+        c.enter_press()
+        result = c.return_stack_for_display(0)
+        self.assertEqual(result.dtype, np.float64)  # not an object array, the 0 for -1.5 is a float too
+        self.assertEqual(result.tolist(), [0.0, 2.0, 3.0])
+        self.assertIsNotNone(c._user_function_shims[c._exec_globals['vec_ramp']])
+        c.stack_put('vec_square')  # already works on arrays, called as is
+        c.enter_press()
+        self.assertEqual(c.return_stack_for_display(0).tolist(), [0.0, 4.0, 9.0])
+        self.assertIsNone(c._user_function_shims[c._exec_globals['vec_square']])
+        c.add_user_function('def vec_ramp(x): return np.maximum(x, 1)')  # re-defined, probed again
+        c.stack_put('vec_ramp')
+        c.enter_press()
+        self.assertEqual(c.return_stack_for_display(0).tolist(), [1.0, 4.0, 9.0])
+        self.assertIsNone(c._user_function_shims[c._exec_globals['vec_ramp']])
+        c.clear_user_functions('vec_ramp')
+        c.clear_user_functions('vec_square')
+
+    def test_pure_user_function_cache(self):
+        c.clear_stack()
+        c.add_user_function('def memo_f(x):\n    memo_calls.append(x)\n    return x * 2', pure=True)
+        c._exec_globals['memo_calls'] = calls = []
+        for value in (21, 21, np.arange(3.0), np.arange(3.0)):
+            c.user_entry(value)
+            c.stack_put('memo_f')
+            c.enter_press()
+        self.assertEqual(len(calls), 3)  # 21, the array probe and the array, the repeats came from the cache
+        self.assertEqual(c.return_stack_for_display(0).tolist(), [0.0, 2.0, 4.0])
+        self.assertEqual(c.return_stack_for_display(2), 42)
+        c.user_entry('memo_f(21) + 1')  # called from an expression too
+        c.enter_press()
+        self.assertEqual(c.return_stack_for_display(0), 43)
+        self.assertIn("Hits: '3'", c.return_function_cache_stats()['memo_f'])
+        c.add_user_function('def memo_f(x):\n    memo_calls.append(x)\n    return x * 3')  # re-defined, still pure
+        self.assertIn("Hits: '0'", c.return_function_cache_stats()['memo_f'])
+        c.clear_user_functions('memo_f')
+        self.assertEqual(c.return_function_cache_stats(), {})
+        self.assertEqual(c.return_pure_user_functions(), set())
+
+    def test_run_program(self):
+        self.assertEqual(calc.program_tokens('3 enter 4 *  # twelve\nnp.sum([1, 2]) enter'),
+                         ['3', 'enter', '4', '*', 'np.sum([1, 2])', 'enter'])
+        history = len(c._stack_history)
+        stack = c.run_program('3 enter 4 * sqrt 2 pow', clear_stack=True)
+        self.assertAlmostEqual(stack[0], 12.0)
+        self.assertEqual(len(stack), 1)
+        self.assertEqual(len(c._stack_history), history)  # no undo snapshots
+        self.assertTrue(c.return_message().startswith("Program: '7' tokens"))
+        self.assertEqual(c.return_program_errors(), 0)
+        c.run_program(['undefined_name_q', 'enter'], clear_stack=True)
+        self.assertIn("'1' error(s)", c.return_message())
+        self.assertEqual(c.return_program_errors(), 1)
+        c._record_history = False  # like a run that is already going, the nested run must not turn the history on
+        try:
+            c.run_program('1 enter 2 +', clear_stack=True)
+            self.assertFalse(c._record_history)
+            self.assertFalse(getattr(calc._log_state, 'quiet', False))  # only quiet while the program runs
+        finally:
+            c._record_history = True
+
+    def test_run_program_on_csv(self):
+        with tempfile.TemporaryDirectory() as folder:
+            source = os.path.join(folder, 'in.csv')
+            target = os.path.join(folder, 'out.csv')
+            data = np.arange(30.0).reshape(10, 3)
+            np.savetxt(source, data, delimiter=',', header='a,b,c', comments='')
+            rows = c.run_program_on_csv('+ 2 *', source, target, columns=['a', 'c'], header=True, chunk_rows=4)
+            self.assertEqual(rows, 10)
+            result = np.loadtxt(target, delimiter=',', skiprows=1)
+            self.assertEqual(result.tolist(), ((data[:, 0] + data[:, 2]) * 2).tolist())
+            np.savetxt(source, data, delimiter=',')
+            self.assertEqual(c.run_program_on_csv('+ +', source, target), 10)  # all columns, no header
+            self.assertEqual(np.loadtxt(target).tolist(), data.sum(axis=1).tolist())
+            self.assertEqual(c.run_program_on_csv('+ +', source, target, levels=2), 0)
+            self.assertTrue(c.return_message().startswith('Error'))
+            self.assertEqual(c.return_program_errors(), 1)
+            self.assertEqual(c.run_program_on_csv('+ nope_q enter', source, target, chunk_rows=4), 0)
+            self.assertEqual(c.return_program_errors(), 1)  # the token error of the first chunk
+            self.assertEqual(c.run_program_on_csv('+ +', source, target), 10)
+            self.assertEqual(c.return_program_errors(), 0)
+
+    def test_macro_recorder(self):
+        c.clear_stack()
+        c.add_user_function('def mac_hyp(a, b):\n    return (a * a + b * b) ** 0.5')
+        c.user_entry(3.0)
+        c.user_entry(4.0)
+        c.macro_record_start()
+        for char in 'mac_hyp':  # typed like the ui does, one key at a time
+            c.user_entry(char)
+        c.enter_press()
+        c.user_entry('2')
+        c.user_entry('*')
+        for char in 'sqrt':
+            c.user_entry(char)
+        c.enter_press()
+        tokens = c.macro_record_stop('mac_m')
+        self.assertEqual(tokens, ['mac_hyp', 'enter', '2', '*', 'sqrt'])
+        self.assertAlmostEqual(c.return_stack_for_display(0), 10 ** 0.5)
+        self.assertIn('mac_m', c.return_user_functions())
+        self.assertEqual(c.return_macros()['mac_m'], tokens)
+        c.user_entry(np.array([3.0, 12.0]))
+        c.user_entry(np.array([4.0, 5.0]))
+        c.stack_put('mac_m')
+        c.enter_press()
+        self.assertEqual(np.round(c.return_stack_for_display(0) ** 2, 6).tolist(), [10.0, 26.0])
+        for program, args in (('4 enter * +', (2.5,)), ('swap - 1/x', (2.5, 7.0)), ('dup * pi *', (2.5,))):
+            c.compile_macro('mac_p', program)  # the compiled function matches running the tokens
+            self.assertAlmostEqual(c._exec_globals['mac_p'](*args), c.run_program(program, stack=list(args))[0])
+        c.compile_macro('mac_t', ['mac_hyp(3, 4)', '+'])  # the brackets are closed, '+' is a button
+        self.assertEqual(c._exec_globals['mac_t'](2.0), 7.0)
+        c.compile_macro('mac_o', ['np.sum([1,', '2])', '+'])  # a bracket still open, the next token is typed
+        self.assertEqual(c._exec_globals['mac_o'](2.0), 5)
+        c.compile_macro('mac_f', '!')
+        self.assertEqual(c._exec_globals['mac_f'](5), 120)
+        self.assertEqual(list(c._exec_globals['mac_f']([3, 4])), [6, 24])  # like the ! button on a list
+        c.clear_stack()
+        c.user_entry([3, 4])
+        c.user_entry('!')
+        self.assertEqual(c.return_stack_for_display(0), [6, 24])
+        with self.assertRaises(Exception):
+            c.compile_macro('mac_bad', '1 enter 2 enter')  # leaves three values
+        c.clear_user_functions('mac_m')
+        self.assertNotIn('mac_m', c.return_macros())
+        for name in ('mac_p', 'mac_t', 'mac_o', 'mac_f', 'mac_hyp'):
+            c.clear_user_functions(name)
+
+    def test_background_job(self):
+        c.clear_stack()
+        c.user_entry(5)
+        c.user_entry(2)
+        job = calc.BackgroundJob(c, lambda: c.user_entry('+'), '+')
+        self.assertTrue(job.wait(5))
+        self.assertIn('7', job.finish())
+        self.assertEqual(c.return_stack_for_display(), [7])
+        job = calc.BackgroundJob(c, lambda: 6 * 7, 'answer')
+        self.assertTrue(job.wait(5))
+        self.assertEqual(job.result(), 42)
+        job = calc.BackgroundJob(c, lambda: c.run_program(itertools.cycle(['1', '+'])), 'program')  # no end
+        self.assertFalse(job.wait(0.2))
+        self.assertTrue(job.cancel())
+        self.assertTrue(job.wait(5))  # stopped between two tokens
+        self.assertIn('Cancelled', job.finish())
+        self.assertEqual(c.return_stack_for_display(), [7])  # put back like before the program
+        with self.assertRaises(calc.OperationCancelled):
+            job.result()
+        threads = []
+
+        def runner(work):  # like the ui, only the evaluation goes to a worker thread
+            threads.append(work)
+            worker = calc.BackgroundJob(c, work, 'eval')
+            worker.wait()
+            return worker.result()
+        c.setting_evaluation_runner(runner)
+        try:
+            c.clear_stack()
+            c.user_entry('sum(range(10))')
+            c.enter_press()
+            self.assertEqual(c.return_stack_for_display(), [45])
+            self.assertEqual(len(threads), 1)
+            c.user_entry('plt.isinteractive() or 1')  # reads a gui library, it stays on this thread
+            c.enter_press()
+            self.assertEqual(len(threads), 1)
+            c.user_entry('1/0')
+            c.enter_press()
+            self.assertIn('Error', c.return_message())  # the error of the worker is reported like before
+        finally:
+            c.setting_evaluation_runner(None)
+        c.clear_stack()
+        c.user_entry(7)
+        c.setting_sandbox(True, cpu_seconds=60)
+        try:
+            c.add_user_function('def bg_spin(x):\n    while True:\n        x = x + 1')
+            c.stack_put('bg_spin')
+            job = calc.BackgroundJob(c, c.enter_press, 'enter')
+            self.assertFalse(job.wait(0.5))
+            self.assertTrue(job.cancel())  # a python loop is stopped by killing the sandbox child
+            self.assertTrue(job.wait(5))
+            self.assertIn('Cancelled', job.finish())
+            self.assertEqual(c.return_stack_for_display(), ['bg_spin', 7])  # put back like before enter
+            c.clear_stack()
+            c.user_entry('bg_spin(1) if False else 5')  # a new child, the cancel does not stop the next evaluation
+            c.enter_press()
+            self.assertEqual(c.return_stack_for_display(), [5])
+        finally:
+            c.setting_sandbox(False)
+            c.clear_user_functions('bg_spin')
+
+    def test_sandbox(self):
+        c.clear_stack()
+        c.setting_sandbox(True, cpu_seconds=1, memory_mb=1024)
+        try:
+            c.load_locals({'sb_a': np.arange(300_000.0), 'sb_k': 3})  # 2.4 MB, goes through shared memory
+            c.add_user_function('def sb_scale(x):\n    return x * sb_k')
+            c.user_entry('sb_a.sum() * 2')
+            c.enter_press()
+            self.assertEqual(c.return_stack_for_display(), [2 * np.arange(300_000.0).sum()])
+            c.user_entry(2)
+            c.user_entry('sb_scale')
+            c.enter_press()
+            self.assertEqual(c.return_stack_for_display(0), 6)
+            c.user_entry('sb_a + 1')
+            c.enter_press()
+            self.assertEqual(c.return_stack_for_display(0)[-1], 300_000.0)
+            c.clear_stack()
+            c.user_entry(7)
+            c.user_entry('10**10**8')  # runs into the cpu limit, the child is killed and started again
+            c.enter_press()
+            self.assertIn('cpu limit', c.return_message())
+            self.assertEqual(c.return_stack_for_display(), ['10**10**8', 7])
+            c.clear_stack()
+            c.user_entry('np.ones(10**9)')  # 8 GB, over the memory limit
+            c.enter_press()
+            self.assertIn('out of memory', c.return_message())
+            c.clear_stack()
+            c.user_entry(4)
+            c.user_entry('sb_scale')
+            c.enter_press()
+            self.assertEqual(c.return_stack_for_display(), [12])  # the definitions are replayed into the new child
+            c.user_entry('sb_a.max()')
+            c.enter_press()
+            self.assertIs(c._sandbox._shipped['sb_a'], c.return_locals()['sb_a'])
+            c.load_locals({'sb_a': np.arange(3.0)})  # rebinding drops the old array, a deleted name drops its value
+            self.assertNotIn('sb_a', c._sandbox._shipped)
+            c.delete_local('sb_k')
+            self.assertNotIn('sb_k', c._sandbox._shipped)
+            c.add_user_function('def sb_scale(x):\n    return x * 5')  # only the latest def is kept and replayed
+            self.assertEqual(list(c._definitions).count('sb_scale'), 1)
+            c.clear_stack()
+            c.user_entry('sb_scale(sb_a.sum())')
+            c.enter_press()
+            self.assertEqual(c.return_stack_for_display(), [15])
+            self.assertNotIn('sb_k', c._sandbox.eval('dir()', {}))  # the child deleted it too
+            c.clear_user_functions('sb_scale')
+            self.assertNotIn('sb_scale', c._definitions)
+            self.assertNotIn('sb_scale', c._sandbox.eval('dir()', {}))
+        finally:
+            c.setting_sandbox(False)
+            c.clear_user_functions('sb_scale')
 
 
 class TestUserEntry(unittest.TestCase):
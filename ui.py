@@ -10,7 +10,7 @@ import numpy as np
 import struct
 import re
 
-from calc import Calculator
+from calc import Calculator, BackgroundJob, OperationCancelled
 import engnum
 import plots
 
@@ -28,6 +28,13 @@ except ImportError:
     log = print
 
 
+# an evaluation that takes longer than this (seconds) locks the calculator and keeps the window drawing while it runs,
+# see _run_evaluation()
+_JOB_WAIT = 0.05
+_JOB_EVENTS_SECONDS = 0.02  # how often the window handles its events while an evaluation runs
+_JOB_SHOW_SECONDS = 0.1  # how often the elapsed time of the evaluation is shown
+
+
 class OsType(Enum):
     LINUX = 0
     MAC = 1
@@ -135,6 +142,9 @@ class MainWindow:
 
         self._autosave_path = 'last_state_autosave.pycalc'
         self._c = Calculator()
+        self._c.setting_evaluation_runner(self._run_evaluation)
+        self._job = None  # the BackgroundJob of the evaluation that is running, see _run_evaluation()
+        self._action_label = ''  # the name of the action that is running, for the messages
         self._root = tk.Tk()
         self._root.title("PyCalc")
         self._settings = CalculatorUiSettings()  # for linting just instantiate this here overwrite if necessary
@@ -184,7 +194,9 @@ class MainWindow:
         # EDIT MENU ........................
 
         self._edit_menu.add_command(label='Undo (ctrl+z)', command=self.undo_last_action)
+        self._edit_menu.add_command(label='Redo (ctrl+y)', command=self.redo_last_undo)
         self._edit_menu.add_command(label='Clear stack', command=self.clear_stack)
+        self._edit_menu.add_command(label='Cancel running operation (esc)', command=self.cancel_job)
         self._edit_menu.add_separator()
         self._edit_menu.add_command(label='Clear all variables', command=self.menu_clear_all_variables)
 
@@ -235,6 +247,9 @@ class MainWindow:
         self._function_menu.add_command(label='Remove user function', command=self.popup_remove_user_function)
         self._function_menu.add_command(label='Show all user functions', command=self.popup_show_user_functions)
         self._function_menu.add_command(label='Show user function buttons', command=self.popup_function_buttons)
+        self._function_menu.add_command(label='Cache user function results', command=self.popup_pure_user_function)
+        self._function_menu.add_command(label='Show function cache stats', command=self.popup_function_cache_stats)
+        self._function_menu.add_command(label='Record macro (start / stop)', command=self.popup_record_macro)
         self._function_menu.add_separator()
         self._function_menu.add_command(label='Clear all user functions', command=self.popup_confirm_clear_all_user_functions)
         self._function_menu.add_separator()
@@ -250,6 +265,9 @@ class MainWindow:
         # bind enter key to  the enter method
         self._root.bind('<Return>', lambda event: self.enter_press())
 
+        # bind escape to cancel an operation that is running in the background
+        self._root.bind('<Escape>', lambda event: self.cancel_job())
+
         # bind the letter keys to the button press methods
         lower_case_letters = [chr(i) for i in range(97, 123)]
         upper_case_letters = [chr(i) for i in range(65, 91)]
@@ -286,10 +304,12 @@ class MainWindow:
         if self._os_type.name == OsType.MAC:
             self._root.bind('<Command-c>', lambda event: self.copy_stack_value())
             self._root.bind('<Command-z>', lambda event: self.undo_last_action())
+            self._root.bind('<Command-y>', lambda event: self.redo_last_undo())
             self._root.bind('<Command-s>', lambda event: self.menu_save_state())
         else: # Windows and other
             self._root.bind('<Control-c>', lambda event: self.copy_stack_value())
             self._root.bind('<Control-z>', lambda event: self.undo_last_action())
+            self._root.bind('<Control-y>', lambda event: self.redo_last_undo())
             self._root.bind('<Control-s>', lambda event: self.menu_save_state())
 
         """  ----------------------------  Stack, Messages, Locals, Buttons ---------------------------------------  """
@@ -482,6 +502,16 @@ class MainWindow:
         right_click_menu.add_command(label='Clear Stack', command=self.clear_stack)
         right_click_menu.add_command(label='Clear Selected', command=self.stack_clear_selected)
 
+        # map / reduce the whole stack, for map and reduce X holds the function name like 'sqrt'
+        right_click_menu.add_separator()
+        right_click_menu.add_command(label='Map function in X over stack', command=lambda: self.button_press('stack_map'))
+        right_click_menu.add_command(label='Reduce stack with function in X',
+                                     command=lambda: self.button_press('stack_reduce'))
+        reduce_menu = tk.Menu(right_click_menu, tearoff=0)
+        for reduction in Calculator.return_stack_reductions():
+            reduce_menu.add_command(label=reduction, command=lambda r=reduction: self.button_press(f'stack_{r}'))
+        right_click_menu.add_cascade(label='Reduce stack', menu=reduce_menu)
+
         right_click_menu.add_separator()
         right_click_menu.add_command(label='Set number of visible rows', command=self.popup_set_stack_message_vars_height)
 
@@ -489,6 +519,8 @@ class MainWindow:
 
     def _insert_value_to_stack_at_x(self):
         """ inserts the value of the selected item in the locals table to the stack at X """
+        if self._is_busy():
+            return  # ------------------------------------------------------------------------------------------------>
         selected = self._locals_table.selection()
         if len(selected) == 0:
             return
@@ -511,6 +543,8 @@ class MainWindow:
 
     def _copy_variable_value(self):
         """ copies the value of the selected item in the locals table to the clipboard """
+        if self._is_busy():
+            return  # ------------------------------------------------------------------------------------------------>
         selected = self._locals_table.selection()
         if len(selected) == 0:
             return
@@ -545,9 +579,14 @@ class MainWindow:
         entry.pack(expand=True, fill='x')
 
         def apply_value():
+            if self._is_busy():
+                return  # -------------------------------------------------------------------------------------------->
             new_value = entry.get()
-            self._c.user_entry(f"{key}={new_value}")
-            self._c.enter_press()
+
+            def assign():
+                self._c.user_entry(f"{key}={new_value}")
+                self._c.enter_press()
+            self._run_action(assign, key)
             self._update_message_display()
             self._update_locals_display()
             self._update_stack_display()
@@ -566,6 +605,8 @@ class MainWindow:
 
     def _remove_selected_item_from_locals_table(self):
         """ removes the selected item from the locals table """
+        if self._is_busy():
+            return  # ------------------------------------------------------------------------------------------------>
         selected = self._locals_table.selection()
         if len(selected) == 0:
             return
@@ -578,6 +619,8 @@ class MainWindow:
 
     def _edit_stack_value(self):
         """ opens a popup window to edit the value of the selected item in the stack table """
+        if self._is_busy():
+            return  # ------------------------------------------------------------------------------------------------>
         selected = self._stack_table.selection()
         if len(selected) == 0:
             return
@@ -602,6 +645,8 @@ class MainWindow:
 
 
         def apply_value():
+            if self._is_busy():
+                return  # -------------------------------------------------------------------------------------------->
             new_value = entry.get()
             # self._c.user_entry(f"{key}={new_value}")
             self._c.clear_stack_level()
@@ -780,6 +825,12 @@ class MainWindow:
                        command=lambda: self.button_press('stack_to_array'),
                        ).pack(fill='x')
 
+            # create a button for 'stack to matrix'
+            ttk.Button(self._special_buttons,
+                       text='stack to matrix',
+                       command=lambda: self.button_press('stack_to_matrix'),
+                       ).pack(fill='x')
+
             # create a button for rolling the stack
             ttk.Button(self._special_buttons,
                        text='roll up',
@@ -884,6 +935,8 @@ class MainWindow:
         label.pack(padx=10)
 
         def clear_all_user_functions():
+            if self._is_busy():
+                return  # -------------------------------------------------------------------------------------------->
             self._c.clear_user_functions()
             window.destroy()
 
@@ -895,6 +948,8 @@ class MainWindow:
         
     def popup_remove_user_function(self):
         """ popup that has a list of user functions and a button to remove the selected function """
+        if self._is_busy():
+            return  # ------------------------------------------------------------------------------------------------>
         # create a new window
         window = tk.Toplevel(self._root)
         window.title('Remove User Function')
@@ -906,6 +961,8 @@ class MainWindow:
         list_box.pack(expand=True, fill='both')
 
         def remove_user_function():
+            if self._is_busy():
+                return  # -------------------------------------------------------------------------------------------->
             selected = list_box.curselection()
             if len(selected) == 0:
                 return
@@ -919,8 +976,109 @@ class MainWindow:
         # create a button to cancel the remove function
         ttk.Button(window, text='Cancel', command=window.destroy).pack(padx=10)
 
+    def popup_pure_user_function(self):
+        """ popup that has a list of user functions and buttons to turn caching of the results of the selected function
+        on or off, only for pure functions (the result only depends on the arguments) """
+        if self._is_busy():
+            return  # ------------------------------------------------------------------------------------------------>
+        # create a new window
+        window = tk.Toplevel(self._root)
+        window.title('Cache User Function Results')
+
+        # create a list box to show the user functions, the cached ones are marked
+        pure = self._c.return_pure_user_functions()
+        keys = list(self._c.return_user_functions().keys())
+        list_box = tk.Listbox(window, height=10, width=50)
+        for key in keys:
+            list_box.insert('end', f"{key}    (cached)" if key in pure else key)
+        list_box.pack(expand=True, fill='both')
+
+        def set_pure(cached: bool):
+            if self._is_busy():
+                return  # -------------------------------------------------------------------------------------------->
+            selected = list_box.curselection()
+            if len(selected) == 0:
+                return
+            self._c.set_user_function_pure(keys[selected[0]], cached)
+            self._update_message_display()
+            window.destroy()
+
+        # create buttons to turn caching on and off for the selected function
+        ttk.Button(window, text='Cache results', command=lambda: set_pure(True)).pack(padx=10)
+        ttk.Button(window, text='Do not cache', command=lambda: set_pure(False)).pack(padx=10)
+
+        # create a button to cancel
+        ttk.Button(window, text='Cancel', command=window.destroy).pack(padx=10)
+
+    def popup_function_cache_stats(self):
+        """ opens a popup window to show the hits, misses and evictions of the cached user functions """
+        if self._is_busy():
+            return  # ------------------------------------------------------------------------------------------------>
+        # create a new window
+        window = tk.Toplevel(self._root)
+        window.title('Function Cache Stats')
+
+        # create a text field with one line per cached function
+        entry = tk.Text(window, height=10, width=80)
+        stats = self._c.return_function_cache_stats()
+        for key, value in stats.items():
+            entry.insert('end', f"{value}\n")
+        if len(stats) == 0:
+            entry.insert('end', "No cached user functions, see Functions -> Cache user function results\n")
+        entry.pack(expand=True, fill='both')
+
+        # create a button to close the window
+        ttk.Button(window, text='Close', command=window.destroy).pack(padx=10)
+
+    def popup_record_macro(self):
+        """ starts recording a macro, if one is being recorded opens a popup to name it, the macro is compiled into a
+        user function so it gets a function button """
+        if self._is_busy():
+            return  # ------------------------------------------------------------------------------------------------>
+        if not self._c.is_recording_macro():
+            self._c.macro_record_start()
+            self._update_message_display()
+            return  # ------------------------------------------------------------------------------------------------>
+
+        # create a new window
+        window = tk.Toplevel(self._root)
+        window.title('Save Macro')
+
+        # create an entry for the function name
+        ttk.Label(window, text='Function name for the recorded macro:').pack(padx=10)
+        entry = ttk.Entry(window, width=40)
+        entry.insert(0, 'macro_1')
+        entry.pack(padx=10)
+        entry.focus()
+
+        def save_macro():
+            if self._is_busy():
+                return  # -------------------------------------------------------------------------------------------->
+            try:
+                self._c.macro_record_stop(entry.get().strip())
+            except Exception as ex:
+                self._update_message_display(f"Error saving macro: {ex}")
+            else:
+                self._update_message_display()
+            window.destroy()
+
+        def discard_macro():
+            if self._is_busy():
+                return  # -------------------------------------------------------------------------------------------->
+            self._c.macro_record_stop()
+            self._update_message_display()
+            window.destroy()
+
+        # create buttons to compile the macro or to throw it away, cancel keeps recording
+        ttk.Button(window, text='Save', command=save_macro).pack(padx=10)
+        entry.bind('<Return>', lambda event: save_macro())
+        ttk.Button(window, text='Discard', command=discard_macro).pack(padx=10)
+        ttk.Button(window, text='Keep recording', command=window.destroy).pack(padx=10)
+
     def popup_edit_user_function(self):
         """opens a popup window that has a list of functions thhat when clicked displayes the function in a text field"""
+        if self._is_busy():
+            return  # ------------------------------------------------------------------------------------------------>
         # create a new window
 
         # -------- Local Methods for Popup Edit User Functions --------
@@ -956,6 +1114,8 @@ class MainWindow:
 
         def save_changes():
             """ saves the changes made to the function """
+            if self._is_busy():
+                return  # -------------------------------------------------------------------------------------------->
             try:
                 selected = list_box.curselection()
                 if len(selected) == 0:
@@ -979,6 +1139,8 @@ class MainWindow:
             update_list_box()
 
         def to_stack(exe=False):
+            if self._is_busy():
+                return  # -------------------------------------------------------------------------------------------->
             # grab selected
             selected = list_box.curselection()
             if len(selected) == 0:
@@ -987,7 +1149,7 @@ class MainWindow:
             self._c.user_entry(key)
             self._update_stack_display()
             if exe is True:
-                self._c.enter_press()
+                self._run_action(self._c.enter_press, key)
                 self._update_stack_display()
                 self._update_message_display()
 
@@ -1039,6 +1201,8 @@ class MainWindow:
 
     def popup_add_function(self, function_string=None, parent_object=None, cb_method=None):
         """ opens a popup window to add a function to the calculator """
+        if self._is_busy():
+            return  # ------------------------------------------------------------------------------------------------>
         # create a new window
         if parent_object is None:
             parent = self._root
@@ -1061,6 +1225,8 @@ class MainWindow:
         entry.pack(expand=True, fill='both')
 
         def apply_function():
+            if self._is_busy():
+                return  # -------------------------------------------------------------------------------------------->
             function_string = entry.get('1.0', 'end')
             try:
                 self._c.add_user_function(function_string)
@@ -1082,6 +1248,8 @@ class MainWindow:
 
     def popup_show_user_functions(self):
         """ opens a popup window to show the user defined functions """
+        if self._is_busy():
+            return  # ------------------------------------------------------------------------------------------------>
         # create a new window
         window = tk.Toplevel(self._root)
         window.title('User Functions')
@@ -1100,6 +1268,8 @@ class MainWindow:
 
     def popup_show_all_functions(self):
         """ opens a popup window to show the all functions available to the calculator """
+        if self._is_busy():
+            return  # ------------------------------------------------------------------------------------------------>
         # create a new window
         window = tk.Toplevel(self._root)
         window.title('All Functions')
@@ -1134,6 +1304,8 @@ class MainWindow:
 
     def popup_function_buttons(self):
         """ opens a popup window to show the all user functions available to the calculator """
+        if self._is_busy():
+            return  # ------------------------------------------------------------------------------------------------>
         # create a new window
         window = tk.Toplevel(self._root)
         window.title('Function Buttons')
@@ -1312,9 +1484,14 @@ class MainWindow:
 
     def _popup_function_button_press(self, function: str):
         """ this method gets bound to the function buttons in the popup window """
-        self._c.enter_press()
-        self._c.user_entry(function)
-        self._c.enter_press()
+        if self._is_busy():
+            return  # ------------------------------------------------------------------------------------------------>
+
+        def press():
+            self._c.enter_press()
+            self._c.user_entry(function)
+            self._c.enter_press()
+        self._run_action(press, function)
         self._update_stack_display()
         self._update_message_display()
         self._update_locals_display()
@@ -1419,6 +1596,8 @@ class MainWindow:
 
     def copy_stack_value(self):
         """ copies the value of the selected stack item to the clipboard """
+        if self._is_busy():
+            return  # ------------------------------------------------------------------------------------------------>
         selected = self._stack_table.selection()
         if len(selected) == 0:
             return
@@ -1430,6 +1609,8 @@ class MainWindow:
 
     def stack_clear_selected(self):
         """ clears the selected value from the stack """
+        if self._is_busy():
+            return  # ------------------------------------------------------------------------------------------------>
         selected = self._stack_table.selection()
         if len(selected) == 0:
             return
@@ -1441,12 +1622,24 @@ class MainWindow:
         self._update_message_display(msg)
 
     def undo_last_action(self):
+        if self._is_busy():
+            return  # ------------------------------------------------------------------------------------------------>
         self._c.undo_last_action()
         self._update_stack_display()
         self._update_message_display()
         self._update_locals_display()
 
+    def redo_last_undo(self):
+        if self._is_busy():
+            return  # ------------------------------------------------------------------------------------------------>
+        self._c.redo_last_undo()
+        self._update_stack_display()
+        self._update_message_display()
+        self._update_locals_display()
+
     def show_plot(self):
+        if self._is_busy():
+            return  # ------------------------------------------------------------------------------------------------>
         self._c.show_plot(self._settings.plot_options_string)
         self._update_message_display()
         self._update_stack_display()
@@ -1454,6 +1647,8 @@ class MainWindow:
 
     def popup_x_plot(self):
         """ applies the plot options and closes the window """
+        if self._is_busy():
+            return  # ------------------------------------------------------------------------------------------------>
         plots_dict = dict()
         len_str = ' ('
 
@@ -1467,6 +1662,8 @@ class MainWindow:
 
         def plot_y():
             """ applies the plot options and closes the window """
+            if self._is_busy():
+                return  # -------------------------------------------------------------------------------------------->
             y = get_trace_key_from_svar(y_svar)
             locals = self._c.return_locals()
             Y = locals.get(y, None)
@@ -1580,6 +1777,8 @@ class MainWindow:
 
     def popup_xy_plot(self):
             """ opens a popup window to show the xy plot options """
+            if self._is_busy():
+                return  # -------------------------------------------------------------------------------------------->
 
             # create a new window
             window = tk.Toplevel(self._root)
@@ -1729,6 +1928,8 @@ class MainWindow:
 
             def plot_xy():
                 """ applies the plot options and closes the window """
+                if self._is_busy():
+                    return  # ---------------------------------------------------------------------------------------->
                 x = get_trace_key_from_svar(x_svar)
                 y = get_trace_key_from_svar(y_svar)
                 locals = self._c.return_locals()
@@ -1780,6 +1981,8 @@ class MainWindow:
 
     def popup_load_python_module(self):
         """ opens a popup window to load a python module into the calculator """
+        if self._is_busy():
+            return  # ------------------------------------------------------------------------------------------------>
         window = tk.Toplevel(self._root)
         window.title('Load Python Module')
         window.geometry('550x300')
@@ -1797,6 +2000,8 @@ class MainWindow:
 
         def add_module():
             """ adds a module to the list box """
+            if self._is_busy():
+                return  # -------------------------------------------------------------------------------------------->
             module_name = module_entry.get().strip()
             if module_name == '':
                 return
@@ -1992,6 +2197,8 @@ class MainWindow:
 
     def paste(self, value):
         """ handles pasting from the clipboard """
+        if self._is_busy():
+            return  # ------------------------------------------------------------------------------------------------>
         if isinstance(value, str):
             if '\t' in value:  # tab delimited string, likely from a
                 array = self.str_to_numpy_array_simple(value, delimiter='\t')
@@ -2194,6 +2401,8 @@ class MainWindow:
         """ saves the locals stack and settings to a file of the users choice
          @param save_path: str, the path to save the state to, if None a file dialog will be opened
          """
+        if self._is_busy():
+            return  # ------------------------------------------------------------------------------------------------>
         # open a file dialog to save the state
         file_extension = ".pycalc"
 
@@ -2236,6 +2445,8 @@ class MainWindow:
 
     def menu_load_state(self):
         """ loads the settings and state from a file of the users choice """
+        if self._is_busy():
+            return  # ------------------------------------------------------------------------------------------------>
         # open a file dialog to load the state
         try:
             file = filedialog.askopenfile(mode='rb', defaultextension=".pycalc")
@@ -2279,31 +2490,41 @@ class MainWindow:
         # note: you cant update the UI here because this method is called before all UI objects are created
 
     def menu_clear_all_variables(self):
+        if self._is_busy():
+            return  # ------------------------------------------------------------------------------------------------>
         self._c.clear_all_variables()
         self._update_stack_display()
         self._update_message_display()
         self._update_locals_display()
 
     def clear_stack(self):
+        if self._is_busy():
+            return  # ------------------------------------------------------------------------------------------------>
         self._c.clear_stack()
         self._update_stack_display()
         self._update_message_display()
         self._update_locals_display()
 
     def clear_x(self):
+        if self._is_busy():
+            return  # ------------------------------------------------------------------------------------------------>
         self._c.clear_stack_level(0)
         self._update_stack_display()
         self._update_message_display()
         self._update_locals_display()
 
     def delete_last_char(self):
+        if self._is_busy():
+            return  # ------------------------------------------------------------------------------------------------>
         self._c.delete_last_char()
         self._update_stack_display()
         self._update_message_display()
         self._update_locals_display()
 
     def enter_press(self):
-        msg = self._c.enter_press()
+        if self._is_busy():
+            return  # ------------------------------------------------------------------------------------------------>
+        self._run_action(self._c.enter_press, 'enter')
         self._update_stack_display()
         self._update_message_display()
         self._update_locals_display()
@@ -2312,17 +2533,74 @@ class MainWindow:
 
     # define a method for button pushes that take a string as an argument and calls self._c.user_entry
     def button_press(self, input: str):
-        self._c.user_entry(input)
+        if self._is_busy():
+            return  # ------------------------------------------------------------------------------------------------>
+        self._run_action(lambda: self._c.user_entry(input), input)
         self._update_stack_display()
         self._update_message_display()
         self._update_locals_display()
 
     def button_eval_x(self):
-        self._c.run_eval_on_stack_x()
+        if self._is_busy():
+            return  # ------------------------------------------------------------------------------------------------>
+        self._run_action(self._c.run_eval_on_stack_x, 'eval')
         self._update_stack_display()
         self._update_message_display()
         self._update_locals_display()
 
+    def _run_action(self, action, label: str) -> bool:
+        """ runs a calculator action on the Tk thread, the long evaluation in it (an eval, exec or user function) runs
+        on a worker thread, see _run_evaluation(). Plots and the other gui calls stay on the Tk thread. A cancelled
+        action puts the stack back to what it was before it, the caller updates the displays
+        @param action: a callable with no arguments that changes the calculator
+        @param label: a name for the messages
+        @return: False if the action was cancelled """
+        snapshot = self._c.stack_snapshot()
+        self._action_label = label
+        try:
+            action()
+        except OperationCancelled as ex:
+            self._c.restore_stack_snapshot(snapshot, f"Cancelled: {ex}, the stack was restored")
+            return False  # ------------------------------------------------------------------------------------------>
+        return True
+
+    def _run_evaluation(self, work):
+        """ the evaluation runner of the calculator (see Calculator.setting_evaluation_runner()), runs work on a worker
+        thread. Most evaluations are done within the first wait, so typing is not slowed down. For a longer one the
+        window keeps handling its events here, the elapsed time is shown and escape cancels it, the actions that touch
+        the calculator are refused until it is done (see _is_busy)
+        @param work: a callable with no arguments
+        @return: what work returned, what it raised is raised here """
+        job = BackgroundJob(self._c, work, self._action_label)
+        if not job.wait(_JOB_WAIT):
+            self._job = job
+            self._root.config(cursor='watch')
+            shown = 0.0
+            try:
+                while not job.wait(_JOB_EVENTS_SECONDS):
+                    if job.elapsed() >= shown:
+                        self._update_message_display(f"Working on: '{job.label}' for '{job.elapsed():0.1f}' s, "
+                                                     f"press escape to cancel")
+                        shown = job.elapsed() + _JOB_SHOW_SECONDS
+                    self._root.update()
+            finally:
+                self._job = None
+                self._root.config(cursor='')
+        return job.result()
+
+    def _is_busy(self) -> bool:
+        """ returns True while an evaluation runs, the calculator actions are refused until it is done """
+        if self._job is None:
+            return False  # ------------------------------------------------------------------------------------------>
+        self._update_message_display(f"Busy with: '{self._job.label}', press escape to cancel")
+        return True
+
+    def cancel_job(self):
+        """ stops the evaluation that is running, the stack is put back to what it was before the action, see
+        Calculator.cancel() """
+        if self._job is not None and self._job.cancel():
+            self._update_message_display(f"Cancelling: '{self._job.label}'")
+
     def _apply_standard_view(self):
 
         if self._settings.ui_visible_state != UiVisibleState.STANDARD: